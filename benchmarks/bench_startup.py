@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""Startup benchmark
+
+Measure the cold start cost of dyndnsupdate.py as run by cron :
+  * the import time of the module
+  * the wall time of a run which exit on a state cache hit
+  * the time between the process spawn and the first HTTP request received
+    by a local server
+
+The results are printed as JSON. With budget options, the exit code is 1 if
+a median exceeds its budget, so regressions can be caught by the CI.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'dyndnsupdate.py')
+
+
+class FirstRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Record the arrival time of each request"""
+
+    arrivals = []
+
+    def do_GET(self):
+        FirstRequestHandler.arrivals.append(time.perf_counter())
+        body = b'good 1.1.1.1'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# time the import from a fresh interpreter, -X importtime needs python 3.7
+IMPORT_TIMER = ('import time; start = time.perf_counter(); import dyndnsupdate; '
+                'print((time.perf_counter() - start) * 1000.0)')
+
+
+def measure_import(runs):
+    """Return the import times of the module in milliseconds"""
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_TIMER], cwd=ROOT,
+                                         universal_newlines=True)
+        results.append(float(output.split()[-1]))
+    return results
+
+
+def measure_first_request(runs):
+    """Return the delays between spawn and first request in milliseconds"""
+    server = http.server.HTTPServer(('127.0.0.1', 0), FirstRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    command = [sys.executable, SCRIPT, '--no-output',
+               '--dyn-server', 'http://127.0.0.1:{}/'.format(server.server_address[1]),
+               '--dyn-address', '1.1.1.1', '--dyn-hostname', 'bench.example.com']
+    results = []
+    try:
+        for _ in range(runs):
+            FirstRequestHandler.arrivals = []
+            start = time.perf_counter()
+            subprocess.run(command, check=True)
+            results.append((FirstRequestHandler.arrivals[0] - start) * 1000.0)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def measure_state_hit(runs):
+    """Return the wall times of runs stopped by the state cache in milliseconds"""
+    with tempfile.TemporaryDirectory() as directory:
+        state_file = os.path.join(directory, 'state.json')
+        with open(state_file, 'w') as f:
+            json.dump({'http://127.0.0.1/ bench.example.com': dict(ip='1.1.1.1', timestamp=time.time(),
+                                                                   answer='good 1.1.1.1')}, f)
+        command = [sys.executable, SCRIPT, '--no-output', '--state-file', state_file,
+                   '--dyn-server', 'http://127.0.0.1/',
+                   '--dyn-address', '1.1.1.1', '--dyn-hostname', 'bench.example.com']
+        results = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, check=True)
+            results.append((time.perf_counter() - start) * 1000.0)
+    return results
+
+
+def summary(values):
+    return dict(median=round(statistics.median(values), 3),
+                min=round(min(values), 3),
+                max=round(max(values), 3),
+                runs=len(values))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the startup cost of dyndnsupdate.py')
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='number of runs of each measure')
+    parser.add_argument('--budget-import-ms', type=float,
+                        help='maximum median import time')
+    parser.add_argument('--budget-state-hit-ms', type=float,
+                        help='maximum median wall time of a run stopped by the state cache')
+    parser.add_argument('--budget-first-request-ms', type=float,
+                        help='maximum median delay before the first request')
+    args = parser.parse_args()
+
+    results = dict(python=sys.version.split()[0],
+                   import_ms=summary(measure_import(args.runs)),
+                   state_hit_ms=summary(measure_state_hit(args.runs)),
+                   first_request_ms=summary(measure_first_request(args.runs)))
+    budgets = dict(import_ms=args.budget_import_ms,
+                   state_hit_ms=args.budget_state_hit_ms,
+                   first_request_ms=args.budget_first_request_ms)
+    results['over_budget'] = sorted(name for name, budget in budgets.items()
+                                    if budget is not None and results[name]['median'] > budget)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    sys.exit(1 if results['over_budget'] else 0)
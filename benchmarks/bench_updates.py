@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""Update benchmark
+
+Measure the cost of real update queries sent to a local stand-in server
+(see mockserver.py) in each mode of dyndnsupdate.py :
+  * cli : one process per update, as run by cron
+  * single : one DynDNSUpdate instance, and so one connection, per update
+  * daemon : one instance updating repeatedly over a persistent connection
+  * bulk : a records file sent in batches with bounded concurrency
+  * async : single hostname batches sent concurrently by AsyncUpdater
+
+Each mode runs in its own process so its peak memory can be measured. The
+per-update latency percentiles, the throughput, the failed updates and the
+peak RSS are printed as JSON, with the import time of the module.
+
+With --baseline, the results are compared to a previous output and the exit
+code is 1 if a metric is worse than the tolerance, so regressions can be
+caught by the CI :
+
+    ./benchmarks/bench_updates.py --tls --latency 0.005 --output new.json --baseline old.json
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+import bench_startup
+import mockserver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'dyndnsupdate.py')
+
+MODES = ['cli', 'single', 'daemon', 'bulk', 'async']
+
+# metric name => True if a higher value is better
+COMPARED = dict(p50_ms=False, p90_ms=False, throughput_per_s=True, max_rss_kb=False)
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summary(latencies, updates, errors, wall):
+    """Summarize the measures of one mode"""
+    latencies_ms = [latency * 1000.0 for latency in latencies]
+    result = dict(updates=updates, errors=errors, wall_s=round(wall, 3),
+                  throughput_per_s=round(updates / wall, 1) if wall else None)
+    if latencies_ms:
+        result.update(('p{}_ms'.format(int(fraction * 100)), round(percentile(latencies_ms, fraction), 3))
+                      for fraction in [0.5, 0.9, 0.99])
+        result.update(mean_ms=round(sum(latencies_ms) / len(latencies_ms), 3),
+                      max_ms=round(max(latencies_ms), 3))
+    return result
+
+
+def options(server_url, retry):
+    """The configure() options of the benchmarked instances"""
+    return dict(server_url=server_url, dyndns_myip='1.1.1.1', dyndns_hostname='bench.example.com',
+                tls_cafile=mockserver.CERTFILE, retry_attempts=retry, retry_base_delay=0, verbose=-1)
+
+
+def run_single(dyndnsupdate, args):
+    latencies = []
+    errors = 0
+    for _ in range(args.count):
+        program = dyndnsupdate.DynDNSUpdate()
+        program.configure(**options(args.server_url, args.retry))
+        start = time.perf_counter()
+        errors += program.main() != 0
+        latencies.append(time.perf_counter() - start)
+        program.close()
+    return latencies, args.count, errors
+
+
+def run_daemon(dyndnsupdate, args):
+    program = dyndnsupdate.DynDNSUpdate()
+    program.configure(**options(args.server_url, args.retry))
+    latencies = []
+    errors = 0
+    try:
+        for _ in range(args.count):
+            start = time.perf_counter()
+            errors += program.main() != 0
+            latencies.append(time.perf_counter() - start)
+    finally:
+        program.close()
+    return latencies, args.count, errors
+
+
+def run_bulk(dyndnsupdate, args):
+    program = dyndnsupdate.DynDNSUpdate()
+    program.configure(**options(args.server_url, args.retry))
+    lines = ['hostname,ip'] + ['h{}.example.com,1.1.{}.{}'.format(i, i // 256 % 256, i % 256)
+                               for i in range(args.count)]
+    output = io.StringIO()
+    program.bulk(lines, output, concurrency=args.concurrency)
+    program.close()
+    errors = sum(json.loads(line)['status'] != 'success' for line in output.getvalue().splitlines())
+    # the latency of each query is not visible from the bulk mode
+    return [], args.count, errors
+
+
+def run_async(dyndnsupdate, args):
+    updater = dyndnsupdate.AsyncUpdater(tls=dyndnsupdate.TLSOptions(cafile=mockserver.CERTFILE),
+                                        concurrency=args.concurrency, server_concurrency=args.concurrency)
+    batches = [dyndnsupdate.UpdateBatch(args.server_url, None, None, '1.1.1.1', ['h{}.example.com'.format(i)])
+               for i in range(args.count)]
+    latencies = []
+
+    async def timed(batch):
+        start = time.perf_counter()
+        result = await updater.update(batch)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    async def run_all():
+        return await asyncio.gather(*[timed(batch) for batch in batches])
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(run_all())
+    finally:
+        updater.close()
+        loop.close()
+    errors = sum(result.status != 200 or 'good' not in result.answer for result in results)
+    return latencies, args.count, errors
+
+
+def worker(args):
+    """Run one mode in this process and print its measures"""
+    sys.path.insert(0, ROOT)
+    import dyndnsupdate
+    runner = {'single': run_single, 'daemon': run_daemon, 'bulk': run_bulk, 'async': run_async}[args.worker]
+    start = time.perf_counter()
+    latencies, updates, errors = runner(dyndnsupdate, args)
+    wall = time.perf_counter() - start
+    print(json.dumps(summary(latencies, updates, errors, wall)))
+
+
+def wait_process(process):
+    """Wait for a child process
+
+    @return : the exit code, negative for a signal, and the peak RSS of the
+                child in KB
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    if hasattr(os, 'waitstatus_to_exitcode'):
+        code = os.waitstatus_to_exitcode(status)
+    elif os.WIFSIGNALED(status):
+        code = -os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    process.returncode = code
+    # macOS counts in bytes
+    return code, usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def measure_cli(server_url, args):
+    command = [sys.executable, SCRIPT, '--no-output', '--retry', str(args.retry), '--retry-delay', '0',
+               '--ca-file', mockserver.CERTFILE, '--dyn-server', server_url,
+               '--dyn-address', '1.1.1.1', '--dyn-hostname', 'bench.example.com']
+    latencies = []
+    errors = 0
+    max_rss = 0
+    start = time.perf_counter()
+    for _ in range(args.cli_count):
+        run_start = time.perf_counter()
+        status, rss = wait_process(subprocess.Popen(command))
+        latencies.append(time.perf_counter() - run_start)
+        errors += status != 0
+        max_rss = max(max_rss, rss)
+    result = summary(latencies, args.cli_count, errors, time.perf_counter() - start)
+    result['max_rss_kb'] = max_rss
+    return result
+
+
+def measure_worker(mode, server_url, args):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode, '--server-url', server_url,
+               '--count', str(args.count), '--concurrency', str(args.concurrency), '--retry', str(args.retry)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    output = process.stdout.read()
+    process.stdout.close()
+    status, rss = wait_process(process)
+    if status != 0:
+        raise RuntimeError('the {} benchmark failed with status {}'.format(mode, status))
+    result = json.loads(output)
+    result['max_rss_kb'] = rss
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """List the metrics worse than the baseline beyond the tolerance"""
+    regressions = []
+    for mode, metrics in sorted(results['modes'].items()):
+        for name, higher_is_better in sorted(COMPARED.items()):
+            value = metrics.get(name)
+            reference = baseline.get('modes', dict()).get(mode, dict()).get(name)
+            if not value or not reference:
+                continue
+            if higher_is_better and value < reference * (1 - tolerance) or \
+                    not higher_is_better and value > reference * (1 + tolerance):
+                regressions.append(dict(mode=mode, metric=name, value=value, baseline=reference))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the update cost of dyndnsupdate.py')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated modes to measure among ' + ', '.join(MODES))
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='number of updates of each in-process mode')
+    parser.add_argument('--cli-count', type=int, default=20,
+                        help='number of updates of the cli mode')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='maximum simultaneous queries of the bulk and async modes')
+    parser.add_argument('--retry', type=int, default=1,
+                        help='maximum attempts of each update')
+    parser.add_argument('--import-runs', type=int, default=5,
+                        help='number of measures of the import time, 0 to skip it')
+    parser.add_argument('--output',
+                        help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline',
+                        help='a previous JSON output to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the relative degradation tolerated before a regression is reported')
+    parser.add_argument('--worker', choices=MODES[1:], help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    mockserver.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        sys.exit(0)
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = sorted(set(modes) - set(MODES))
+    if unknown:
+        parser.error('unknown modes ' + ', '.join(unknown))
+
+    results = dict(python=sys.version.split()[0],
+                   server=dict(tls=args.tls, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, error_kind=args.error_kind),
+                   modes=dict())
+    if args.import_runs > 0:
+        results['import_ms'] = bench_startup.summary(bench_startup.measure_import(args.import_runs))
+    with mockserver.server_from_arguments(args) as server:
+        for mode in modes:
+            if mode == 'cli':
+                results['modes'][mode] = measure_cli(server.url, args)
+            else:
+                results['modes'][mode] = measure_worker(mode, server.url, args)
+        results['server']['requests'] = server.counters['requests']
+
+    code = 0
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            results['regressions'] = compare(results, json.load(baseline_file), args.tolerance)
+        code = 1 if results['regressions'] else 0
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    sys.exit(code)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""A local stand-in of a DynDNS server for the benchmarks
+
+The server answers the update protocol over HTTP or HTTPS with persistent
+connections. A latency, with an optional jitter, is added to each answer and
+a fraction of the queries can fail to measure the cost of the retries :
+  * http : an HTTP 500 status
+  * 911 : the temporary server error of the protocol
+  * drop : the connection is closed without answer
+
+It can be started alone to benchmark other clients :
+
+    ./benchmarks/mockserver.py --port 8245 --tls --latency 0.02 --error-rate 0.01
+"""
+
+import argparse
+import http.server
+import os
+import random
+import socketserver
+import ssl
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a self-signed certificate for localhost and 127.0.0.1
+CERTFILE = os.path.join(ROOT, 'tests', 'mocks', 'localhost.crt')
+KEYFILE = os.path.join(ROOT, 'tests', 'mocks', 'localhost.key')
+
+ERROR_KINDS = ['http', '911', 'drop']
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server with one thread per connection"""
+
+    daemon_threads = True
+    # the benchmarks open many connections at once
+    request_queue_size = 128
+    # the TLS context of the accepted connections, None for plain HTTP
+    tls_context = None
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        if self.tls_context is not None:
+            # the handshake is done by the connection thread, not by the accepting one
+            sock = self.tls_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+
+class UpdateHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the update queries according to the server settings"""
+
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        super().setup()
+
+    def do_GET(self):
+        server = self.server.standin
+        server.count('requests')
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('errors')
+            if server.error_kind == 'drop':
+                self.close_connection = True
+                return
+            if server.error_kind == 'http':
+                self.answer(500, b'')
+                return
+            self.answer(200, b'911')
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        hostnames = query.get('hostname', [''])[0].split(',')
+        myip = query.get('myip', [self.client_address[0]])[0]
+        self.answer(200, '\n'.join('good ' + myip for _ in hostnames).encode())
+
+    def answer(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DynDNSStandIn(object):
+    """A threaded DynDNS server running in the background"""
+
+    def __init__(self, host='127.0.0.1', port=0, tls=False, latency=0, jitter=0,
+                 error_rate=0, error_kind='911', certfile=CERTFILE, keyfile=KEYFILE):
+        if error_kind not in ERROR_KINDS:
+            raise ValueError('unknown error kind "{}"'.format(error_kind))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_kind = error_kind
+        self.counters = dict(requests=0, errors=0)
+        self.__mutex = threading.Lock()
+        self.__server = ThreadingHTTPServer((host, port), UpdateHandler)
+        self.__server.standin = self
+        if tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.__server.tls_context = context
+        self.proto = 'https' if tls else 'http'
+        self.host, self.port = self.__server.server_address[:2]
+        self.__thread = None
+
+    @property
+    def url(self):
+        return '{}://{}:{}/'.format(self.proto, self.host, self.port)
+
+    def count(self, name):
+        with self.__mutex:
+            self.counters[name] += 1
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def add_server_arguments(parser):
+    """Declare the settings of the stand-in server"""
+    parser.add_argument('--tls', action='store_true',
+                        help='serve HTTPS with a self-signed certificate')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='the number of seconds added to each answer')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='the maximum random number of seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='the fraction of the queries which fail')
+    parser.add_argument('--error-kind', choices=ERROR_KINDS, default='911',
+                        help='how the queries fail')
+    parser.add_argument('--cert', default=CERTFILE,
+                        help='the certificate of the HTTPS server')
+    parser.add_argument('--key', default=KEYFILE,
+                        help='the private key of the certificate')
+
+
+def server_from_arguments(args, port=0):
+    """Build a stand-in server from the parsed arguments"""
+    return DynDNSStandIn(port=port, tls=args.tls, latency=args.latency, jitter=args.jitter,
+                         error_rate=args.error_rate, error_kind=args.error_kind,
+                         certfile=args.cert, keyfile=args.key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the DynDNS update protocol locally')
+    parser.add_argument('--port', type=int, default=8245,
+                        help='the port to listen on')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_arguments(args, port=args.port).start()
+    print('Serving on {}'.format(server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print('{requests} requests, {errors} errors'.format(**server.counters))
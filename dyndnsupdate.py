@@ -29,316 +29,4450 @@ A simple DynDNS client
 """
 
 # System imports
-import argparse
-from base64 import b64encode
-import http.client
+from base64 import b64decode, b64encode
+import collections
+import errno
+import importlib
+import itertools
+import json
 import logging
+import os
 import re
-import socket
-import ssl
+import signal
+import struct
 import sys
-import urllib
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on Windows, the state file is then only atomically replaced
+    fcntl = None
+
+
+class LazyModule(object):
+    """A module which is really imported on first attribute access
+
+    Most runs of the program stop before any network activity (state cache
+    hit, bad arguments...), so the heavy network modules are not loaded at
+    startup. The stand-in stays private to this module : nothing is
+    registered in sys.modules before the real import, and the first access
+    is serialized so threads can share it.
+    """
+
+    def __init__(self, name, submodules=None):
+        """Constructor : Store the names to import
+
+        @param[str] name : the absolute name of the module
+        @param[list] submodules : the names of the submodules to import
+                                    with the package
+        """
+        self.__name = name
+        self.__submodules = submodules or []
+        self.__module = None
+        self.__mutex = threading.Lock()
+
+    def __load(self):
+        with self.__mutex:
+            if self.__module is None:
+                for submodule in self.__submodules:
+                    importlib.import_module(self.__name + '.' + submodule)
+                self.__module = importlib.import_module(self.__name)
+        return self.__module
+
+    def __getattr__(self, name):
+        module = self.__module
+        if module is None:
+            module = self.__load()
+        return getattr(module, name)
+
+
+def lazy_import(name, submodules=None):
+    """Import a module which will be really loaded on first attribute access
+
+    @param[str] name : the absolute name of the module
+    @param[list] submodules : the names of the submodules to import with it
+    @return[LazyModule] : the module
+    """
+    return LazyModule(name, submodules)
+
+
+class LazyPattern(object):
+    """A regular expression compiled on first use
+
+    This class behave like a compiled pattern object, but the compilation
+    cost is only paid by the runs which really validate some input.
+    """
+
+    def __init__(self, pattern, flags=0):
+        """Constructor : Store the pattern to compile
+
+        @param[str] pattern : the regular expression
+        @param[int] flags : the re flags
+        """
+        self.pattern = pattern
+        self.flags = flags
+        self.__compiled = None
+
+    def __getattr__(self, name):
+        if self.__compiled is None:
+            self.__compiled = re.compile(self.pattern, self.flags)
+        return getattr(self.__compiled, name)
+
+
+# Lazy imports
+argparse = lazy_import('argparse')
+atexit = lazy_import('atexit')
+configparser = lazy_import('configparser')
+cProfile = lazy_import('cProfile')
+csv = lazy_import('csv')
+hmac = lazy_import('hmac')
+random = lazy_import('random')
+asyncio = lazy_import('asyncio')
+http = lazy_import('http', ['client'])
+queue = lazy_import('queue')
+select = lazy_import('select')
+socket = lazy_import('socket')
+ssl = lazy_import('ssl')
+tempfile = lazy_import('tempfile')
+tracemalloc = lazy_import('tracemalloc')
+urllib = lazy_import('urllib', ['parse'])
 
 # Global project declarations
 __version__ = '2.0.0'
 
+# the maximum number of hostnames the protocol accept in one query
+MAX_HOSTNAMES = 20
+
+# one hostname to update
+UpdateRecord = collections.namedtuple('UpdateRecord',
+                                        ['server_url', 'username', 'password', 'myip', 'hostname'])
+# a group of hostnames which can be updated by a single query
+UpdateBatch = collections.namedtuple('UpdateBatch',
+                                        ['server_url', 'username', 'password', 'myip', 'hostnames'])
+
+
+def plan_batches(records, max_hostnames=MAX_HOSTNAMES):
+    """Group update records into the smallest number of queries
+
+    Records sharing the same server, credentials and ip address are
+    coalesced into batches of at most max_hostnames hostnames.
+
+    @param[iterable] records : the UpdateRecord to group
+    @param[int] max_hostnames : the maximum number of hostnames per batch
+    @return[list] : the UpdateBatch to send, in order of first appearance
+    """
+    groups = collections.OrderedDict()
+    for record in records:
+        key = (record.server_url, record.username, record.password, record.myip)
+        hostnames = groups.setdefault(key, collections.OrderedDict())
+        hostnames[record.hostname] = True
+
+    batches = []
+    for key, hostnames in groups.items():
+        hostnames = list(hostnames)
+        for i in range(0, len(hostnames), max_hostnames):
+            batches.append(UpdateBatch(*key, hostnames=hostnames[i:i + max_hostnames]))
+    return batches
+
+
+def split_answer(hostnames, answer):
+    """Map the server answer of a batched query to each hostname
+
+    The server answer with one line per hostname, in the same order as in
+    the query. A single line answer apply to all hostnames, and so does an
+    empty answer.
+
+    @param[list] hostnames : the hostnames sent in the query
+    @param[str] answer : the server's answer body
+    @return[list] : the (hostname, answer line) pairs in the order of
+                    hostnames, the line is None for the hostnames after the
+                    last line of a too short answer
+    """
+    lines = [line.strip() for line in answer.strip().splitlines() if line.strip()]
+    if len(lines) <= 1:
+        lines = (lines or ['']) * len(hostnames)
+    return list(zip(hostnames, lines + [None] * (len(hostnames) - len(lines))))
+
+
+# the columns of a bulk input file, in the order of a CSV file without header
+BULK_FIELDS = ['hostname', 'ip', 'server', 'username', 'password']
+
+
+def read_records(lines, fmt=None):
+    """Decode a stream of bulk update records
+
+    The input is either CSV, with an optional header line naming the
+    BULK_FIELDS columns, or JSON lines of objects with the same keys.
+    Lines are consumed one at a time so the input can be of any size.
+
+    @param[iterable] lines : the lines of the input file
+    @param[str] fmt : 'csv', 'jsonl' or None to guess it from the first line
+    @return[generator] : (line number, dict of fields or error message)
+    """
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    lines = itertools.chain([first], lines)
+    if fmt is None:
+        fmt = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+
+    if fmt == 'jsonl':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, 'invalid JSON : {}'.format(str(e))
+                continue
+            yield number, row if isinstance(row, dict) else 'a JSON object is expected'
+        return
+
+    reader = csv.reader(lines)
+    columns = BULK_FIELDS
+    for row in reader:
+        if not row or not ''.join(row).strip():
+            continue
+        row = [cell.strip() for cell in row]
+        if reader.line_num == 1 and 'hostname' in row:
+            columns = row
+            continue
+        yield reader.line_num, dict(zip(columns, row))
+
+
+def validate_records(rows, server_url=None, username=None, password=None):
+    """Check the fields of bulk update records
+
+    @param[iterable] rows : (line number, dict of fields or error message)
+    @param[str] server_url : the server of records without one
+    @param[str] username : the username of records without server
+    @param[str] password : the password of records without server
+    @return[generator] : (line number, UpdateRecord or error message)
+    """
+    for number, row in rows:
+        if not isinstance(row, dict):
+            yield number, row
+            continue
+        hostname = row.get('hostname') or ''
+        ip = row.get('ip') or row.get('myip') or ''
+        server = row.get('server') or server_url or ''
+        if row.get('server'):
+            user, secret = row.get('username') or None, row.get('password') or None
+        else:
+            user, secret = row.get('username') or username, row.get('password') or password
+        if not DynDNSUpdate.RE_HOST.match(hostname):
+            yield number, 'incorrect hostname "{}"'.format(hostname)
+        elif not DynDNSUpdate.RE_IP.match(ip):
+            yield number, 'incorrect ip address "{}"'.format(ip)
+        elif not DynDNSUpdate.RE_URL.match(server):
+            yield number, 'incorrect server url "{}"'.format(server)
+        else:
+            yield number, UpdateRecord(server, user, secret, ip, hostname)
+
+
+def chunk_records(records, max_hostnames=MAX_HOSTNAMES):
+    """Coalesce consecutive records into batches
+
+    Unlike plan_batches, only neighbour records sharing the same server,
+    credentials and ip address are grouped, so at most one batch is held
+    in memory and the input order is kept.
+
+    @param[iterable] records : (line number, UpdateRecord or error message)
+    @param[int] max_hostnames : the maximum number of hostnames per batch
+    @return[generator] : (line numbers, UpdateBatch or error message)
+    """
+    numbers, key, hostnames = [], None, []
+    for number, record in records:
+        if isinstance(record, UpdateRecord):
+            record_key = (record.server_url, record.username, record.password, record.myip)
+            if record_key == key and len(hostnames) < max_hostnames:
+                numbers.append(number)
+                hostnames.append(record.hostname)
+                continue
+        if hostnames:
+            yield numbers, UpdateBatch(*key, hostnames=hostnames)
+        numbers, key, hostnames = [], None, []
+        if isinstance(record, UpdateRecord):
+            numbers, key, hostnames = [number], record_key, [record.hostname]
+        else:
+            yield [number], record
+    if hostnames:
+        yield numbers, UpdateBatch(*key, hostnames=hostnames)
+
+
+def last_result_line(path):
+    """Find where an interrupted bulk update has to be resumed
+
+    @param[str] path : the JSON lines results file of the previous run
+    @return[int] : the last input line number written, 0 if none
+    """
+    last = 0
+    try:
+        with open(path, 'r') as results:
+            for line in results:
+                try:
+                    last = max(last, int(json.loads(line)['line']))
+                except (ValueError, KeyError, TypeError):
+                    # a line truncated by the interruption
+                    continue
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def open_results(path):
+    """Open a bulk update results file to append new results
+
+    @param[str] path : the JSON lines results file
+    @return[file] : the file, ready for writing after any truncated line
+    """
+    with open(path, 'ab+') as results:
+        if results.seek(0, os.SEEK_END) > 0:
+            results.seek(-1, os.SEEK_END)
+            if results.read(1) != b'\n':
+                results.write(b'\n')
+    return open(path, 'a')
+
+
+# the meaning of the DynDNS return codes
+# 'success' : the hostname is up to date
+# 'retry' : temporary server error, the query can be sent again later
+# 'error' : the hostname is incorrect, sending it again is useless
+# 'fatal' : the account is unusable, all queries must stop
+RETURN_CODES = {
+    'good': 'success',
+    'nochg': 'success',
+    'dnserr': 'retry',
+    '911': 'retry',
+    'notfqdn': 'error',
+    'nohost': 'error',
+    'numhost': 'error',
+    'badauth': 'fatal',
+    'badagent': 'fatal',
+    'abuse': 'fatal',
+    '!donator': 'fatal',
+}
+
+# the maximum number of bytes read from a server answer
+MAX_ANSWER_SIZE = 4096
+
+# the result of an update for one hostname
+HostResult = collections.namedtuple('HostResult', ['hostname', 'code', 'ip', 'outcome', 'answer'])
+
+
+def parse_answer(hostnames, answer):
+    """Decode the server answer into per hostname results
+
+    An empty answer is considered as a success because some servers only use
+    the HTTP status. A missing line or an unknown return code, like an HTML
+    page, is an error so it is never recorded as up to date.
+
+    @param[list] hostnames : the hostnames sent in the query
+    @param[str] answer : the server's answer body
+    @return[list] : the HostResult in the same order as hostnames
+    """
+    results = []
+    for hostname, line in split_answer(hostnames, answer):
+        if line is None:
+            results.append(HostResult(hostname, None, None, 'error', None))
+            continue
+        code, _, ip = line.partition(' ')
+        outcome = RETURN_CODES.get(code, 'error') if line else 'success'
+        results.append(HostResult(hostname, code, ip.strip() or None, outcome, line))
+    return results
+
+
+def http_outcome(status):
+    """Classify the HTTP status of an update query
+
+    Only the server errors and 429 Too Many Requests are temporary, sending
+    again a query refused with another client error is useless.
+
+    @param[int] status : the HTTP status
+    @return[str] : 'success' for 200, 'fatal' for 401, else 'retry' or 'error'
+    """
+    if status == 200:
+        return 'success'
+    if status == 401:
+        return 'fatal'
+    if status == 429 or status >= 500:
+        return 'retry'
+    return 'error'
+
+
+def classify_response(hostnames, status, answer=None, error=None):
+    """Classify the outcome of an update query for each hostname
+
+    The transport errors are temporary, except the TLS ones which would
+    fail again. The HTTP status is classified by http_outcome() and the
+    answer of the successful queries by parse_answer().
+
+    @param[list] hostnames : the hostnames sent in the query
+    @param[int] status : the HTTP status, None if the query failed
+    @param[str] answer : the server's answer body
+    @param[Exception|str] error : the reason of the failure
+    @return[list] : the HostResult in the same order as hostnames
+    """
+    if status == 200:
+        return parse_answer(hostnames, answer)
+    if status is None:
+        outcome = 'error' if isinstance(error, ssl.SSLError) else 'retry'
+    else:
+        outcome = http_outcome(status)
+    code = 'badauth' if status == 401 else None
+    return [HostResult(hostname, code, None, outcome, None) for hostname in hostnames]
+
+
+class RetryPolicy(object):
+    """Compute the delays between the attempts of a failed query
+
+    The delays grow exponentially and are randomized with the "full jitter"
+    algorithm so a fleet of clients does not retry all at the same moment
+    after a server outage.
+    """
+
+    def __init__(self, attempts=3, base_delay=2, max_delay=60):
+        """Constructor : Build a retry policy
+
+        @param[int] attempts : the maximum number of attempts of a query
+        @param[float] base_delay : the maximum delay before the first retry
+        @param[float] max_delay : the upper bound of all delays
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delays(self):
+        """Generate the delay before each retry
+
+        @return[generator] : the delays in seconds
+        """
+        for attempt in range(self.attempts - 1):
+            yield random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# how the addresses of both families are sent to the server
+# 'myip' : comma separated in the myip parameter
+# 'myipv6' : the IPv6 address in a separate myipv6 parameter
+# 'separate' : one query per address family
+IPV6_MODES = ['myip', 'myipv6', 'separate']
+
+
+def address_family(address):
+    """Tell the version of an ip address
+
+    @param[str] address : an IPv4 or IPv6 address
+    @return[int] : 4 or 6
+    """
+    return 6 if ':' in address else 4
+
+
+def split_addresses(myip):
+    """Map the comma separated addresses of a myip value to their family
+
+    @param[str] myip : one address or the addresses of both families
+    @return[dict] : 4 or 6 => address
+    """
+    return dict((address_family(address), address.strip()) for address in (myip or '').split(',') if address.strip())
+
+
+def query_fields(fields, hostnames, myip, ipv6_mode='myip'):
+    """Build the DynDNS parameters of an update query
+
+    @param[dict] fields : the dyndns fields
+    @param[list] hostnames : the hostnames to update
+    @param[str] myip : one address or the comma separated addresses of
+                        both families
+    @param[str] ipv6_mode : how to send both families, one of IPV6_MODES
+    @return[dict] : the query parameters
+    """
+    fields = dict(fields, hostname=','.join(hostnames), myip=myip)
+    if ipv6_mode == 'myipv6':
+        # a family without address is left unchanged by the server
+        addresses = split_addresses(myip)
+        del fields['myip']
+        if 4 in addresses:
+            fields['myip'] = addresses[4]
+        if 6 in addresses:
+            fields['myipv6'] = addresses[6]
+    return fields
+
+
+def default_fields():
+    """Build the default parameters of the DYNDNS protocol
+
+    @return[dict] : the protocol field name => default value
+    """
+    # for detail see https://help.dyn.com/remote-access-api/perform-update/
+    fields = dict()
+
+    # Identify update type
+    # "dyndns", "statdns"
+    fields['system'] = 'dyndns'
+
+    # A comma separated list of host to update (max 20)
+    fields['hostname'] = ''
+
+    # The IP address to set.
+    # If not set or incorrect the server will choose himself an IP
+    fields['myip'] = ''
+
+    # Parameter enables or disables wildcards for this host.
+    # Values : "ON","NOCHG","OFF"
+    fields['wildcard'] = 'NOCHG'
+
+    # Specify an eMail eXchanger
+    fields['mx'] = ''
+
+    # Requests the MX in the previous parameter to be set up as a backup MX
+    # by listing the host itself as an MX with a lower preference value.
+    # Values : "ON","NOCHG","OFF"
+    fields['backmx'] = 'NOCHG'
+
+    # Set the hostname to offline mode
+    # "YES" turn on offline redirect for host
+    # "NOCHG" no make change
+    fields['offline'] = 'NOCHG'
+
+    # No already use
+    fields['url'] = ''
+    return fields
+
+
+# the functions called around the traced phases of the program
+SPAN_HOOKS = []
+
+
+def add_span_hook(hook):
+    """Register a tracing hook
+
+    The hook is called as hook(name, attributes) when a span starts and may
+    return a function called as end(error) when it finishes, error being
+    the exception which interrupted the span or None. The spans are
+    'configure', 'build_query', 'connect' and 'getresponse'.
+
+    @param[callable] hook : the function to call
+    """
+    SPAN_HOOKS.append(hook)
+
+
+def remove_span_hook(hook):
+    """Unregister a tracing hook
+
+    @param[callable] hook : a function given to add_span_hook()
+    """
+    if hook in SPAN_HOOKS:
+        SPAN_HOOKS.remove(hook)
+
+
+class Span(object):
+    """A traced phase of the program
+
+    The exceptions raised by the hooks are logged and ignored so a tracing
+    backend can never break an update.
+    """
+
+    def __init__(self, name, attributes):
+        """Constructor : Build a span
+
+        @param[str] name : the name of the phase
+        @param[dict] attributes : the details given to the hooks
+        """
+        self.name = name
+        self.attributes = attributes
+        self.__ends = []
+
+    def __enter__(self):
+        for hook in list(SPAN_HOOKS):
+            try:
+                end = hook(self.name, self.attributes)
+            except Exception as e:
+                logging.getLogger('dynupdate').debug('-> span hook failed : %s', str(e))
+                continue
+            if end is not None:
+                self.__ends.append(end)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for end in reversed(self.__ends):
+            try:
+                end(exc_value)
+            except Exception as e:
+                logging.getLogger('dynupdate').debug('-> span hook failed : %s', str(e))
+        return False
+
+
+class NullSpan(object):
+    """The span used when no hook is registered"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **attributes):
+    """Trace a phase of the program
+
+    @param[str] name : the name of the phase
+    @param[dict] attributes : the details given to the hooks
+    @return[Span] : a context manager around the phase
+    """
+    if not SPAN_HOOKS:
+        return NULL_SPAN
+    return Span(name, attributes)
+
+
+def build_query(url_parts, api_url, fields, username=None, password=None):
+    """Forge the url and the headers of an update query
+
+    @param[dict] url_parts : the server url as matched by RE_URL
+    @param[str] api_url : the path of the update endpoint
+    @param[dict] fields : the dyndns fields to send
+    @param[str] username : the optional username for HTTP authentication
+    @param[str] password : the optional password for HTTP authentication
+    @return[tuple] : the url and the headers dict
+    """
+    with span('build_query', server=url_parts['url'], hostname=fields.get('hostname')):
+        return _build_query(url_parts, api_url, fields, username, password)
+
+
+def _build_query(url_parts, api_url, fields, username=None, password=None):
+    """Forge the url and the headers of an update query, see build_query()
+    """
+    # build the header dict
+    headers = {'User-Agent': 'dyndns-update/' + __version__}
+    # authentification
+    if username and password:
+        # build the auth string
+        auth_str = username + ':' + password
+        # encode it as a base64 string to put in http header
+        auth = b64encode(auth_str.encode()).decode("ascii")
+        # fill the header
+        headers['Authorization'] = 'Basic ' + auth
+
+    dyndns_params = urllib.parse.urlencode(sorted(fields.items()))
+    url = '{base_url}{api_path}?{params}'.format(base_url=url_parts['url'].rstrip('/'),
+                                                api_path=api_url,
+                                                params=dyndns_params)
+    return url, headers
+
+
+def build_payload(proto, host, port, target, headers):
+    """Serialize an HTTP GET request like http.client does
+
+    @param[str] proto : the protocol, 'http' or 'https'
+    @param[str] host : the remote server host
+    @param[int] port : the remote server port
+    @param[str] target : the request target
+    @param[dict] headers : the HTTP headers
+    @return[bytes] : the raw request
+    """
+    default_port = http.client.HTTPS_PORT if proto == 'https' else http.client.HTTP_PORT
+    lines = ['GET {} HTTP/1.1'.format(target)]
+    lines.append('Host: {}'.format(host if port == default_port else '{}:{}'.format(host, port)))
+    lines.append('Accept-Encoding: identity')
+    for name, value in headers.items():
+        lines.append('{}: {}'.format(name, value))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def split_url(url):
+    """Extract the connection parameters of an url
+
+    @param[str] url : the url to parse
+    @return[tuple] : the url parts as matched by RE_URL, the protocol, the
+                        host and the port, or None if the url is incorrect
+    """
+    match = DynDNSUpdate.RE_URL.match(url)
+    if not match:
+        return None
+    url_parts = match.groupdict()
+    proto = url_parts['proto'] or 'http'
+    if url_parts['port']:
+        port = int(url_parts['port'].lstrip(':'))
+    else:
+        port = http.client.HTTPS_PORT if proto == 'https' else http.client.HTTP_PORT
+    return url_parts, proto, url_parts['host'], port
+
+
+# the TLS settings of a secure connection
+TLSOptions = collections.namedtuple('TLSOptions', ['insecure', 'cafile', 'capath', 'certfile', 'keyfile'])
+TLSOptions.__new__.__defaults__ = (False, None, None, None, None)
+
+
+class TLSContextCache(object):
+    """A cache of SSL contexts
+
+    Building an SSL context load the whole CA bundle, which is expensive on
+    small devices. This class build only one context per set of TLS options.
+    """
+
+    def __init__(self):
+        """Constructor : Build an empty cache
+        """
+        self.__contexts = dict()
+        self.__lock = threading.Lock()
+
+    def get(self, options):
+        """Return the SSL context matching the given options
+
+        @param[TLSOptions] options : the TLS settings
+        @return[ssl.SSLContext] : the shared SSL context
+        """
+        with self.__lock:
+            context = self.__contexts.get(options)
+            if context is None:
+                context = self.__build(options)
+                self.__contexts[options] = context
+            return context
+
+    @staticmethod
+    def __build(options):
+        """Create a new SSL context
+
+        @param[TLSOptions] options : the TLS settings
+        @return[ssl.SSLContext] : the new SSL context
+        """
+        if options.insecure:
+            context = ssl._create_unverified_context()
+        else:
+            context = ssl.create_default_context(cafile=options.cafile, capath=options.capath)
+        if options.certfile:
+            context.load_cert_chain(options.certfile, options.keyfile)
+        return context
+
+    def clear(self):
+        """Drop all cached contexts
+        """
+        with self.__lock:
+            self.__contexts.clear()
+
+
+# the delay in seconds before starting the next connection attempt (RFC 8305)
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+def interleave_families(infos):
+    """Order addresses by alternating their families (RFC 8305 section 4)
+
+    @param[list] infos : the getaddrinfo results, in preference order
+    @return[list] : the same results, the first of each family first
+    """
+    families = collections.OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in list(queues):
+            ordered.append(queue.pop(0))
+            if not queue:
+                queues.remove(queue)
+    return ordered
+
+
+def happy_eyeballs_connect(infos, timeout=None, delay=HAPPY_EYEBALLS_DELAY):
+    """Connect to the first answering address (RFC 8305)
+
+    A new attempt is started every delay seconds, or as soon as the previous
+    one failed, without waiting for the slower ones. The first established
+    socket is returned and all other attempts are cancelled.
+
+    @param[list] infos : the getaddrinfo results to try, in preference order
+    @param[float] timeout : the overall timeout in seconds, None to wait
+    @param[float] delay : the number of seconds between two attempts
+    @return[socket.socket] : the connected socket, in blocking mode
+    """
+    candidates = interleave_families(infos)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    attempts = dict()
+    error = None
+    next_attempt = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            if candidates and (not attempts or now >= next_attempt):
+                family, sock_type, proto, _, address = candidates.pop(0)
+                sock = socket.socket(family, sock_type, proto)
+                sock.setblocking(False)
+                code = sock.connect_ex(address)
+                if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    attempts[sock] = address
+                    next_attempt = now + delay
+                else:
+                    sock.close()
+                    error = OSError(code, os.strerror(code))
+                continue
+            if not attempts:
+                raise error or OSError('no address to connect to')
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+            wait = [deadline] if deadline is not None else []
+            if candidates:
+                wait.append(next_attempt)
+            _, writable, _ = select.select([], list(attempts), [],
+                                            max(0, min(wait) - now) if wait else None)
+            for sock in writable:
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    del attempts[sock]
+                    sock.setblocking(True)
+                    return sock
+                del attempts[sock]
+                sock.close()
+                error = OSError(code, os.strerror(code))
+                # a failure starts the next attempt at once
+                next_attempt = time.monotonic()
+    finally:
+        for sock in attempts:
+            sock.close()
+
+
+async def happy_eyeballs_connect_async(infos, delay=HAPPY_EYEBALLS_DELAY):
+    """Connect to the first answering address from a coroutine (RFC 8305)
+
+    This is happy_eyeballs_connect() for the event loop, the timeout is left
+    to the caller.
+
+    @param[list] infos : the getaddrinfo results to try, in preference order
+    @param[float] delay : the number of seconds between two attempts
+    @return[socket.socket] : the connected socket, in non-blocking mode
+    """
+    loop = asyncio.get_event_loop()
+    candidates = interleave_families(infos)
+    attempts = dict()
+    error = None
+    try:
+        while candidates or attempts:
+            if candidates:
+                family, sock_type, proto, _, address = candidates.pop(0)
+                sock = socket.socket(family, sock_type, proto)
+                sock.setblocking(False)
+                attempts[asyncio.ensure_future(loop.sock_connect(sock, address))] = sock
+            # a failure starts the next attempt at once
+            done, _ = await asyncio.wait(list(attempts), timeout=delay if candidates else None,
+                                            return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                sock = attempts.pop(attempt)
+                if attempt.exception() is None:
+                    return sock
+                sock.close()
+                error = attempt.exception()
+        raise error or OSError('no address to connect to')
+    finally:
+        for attempt, sock in attempts.items():
+            attempt.cancel()
+            sock.close()
+
+
+async def open_connection(host, port, ssl=None, resolutions=None):
+    """Open an asyncio stream pair, racing the host addresses when possible
+
+    With a resolution cache, the cached addresses are raced by this module.
+    Otherwise asyncio resolve the host each time, and only implements happy
+    eyeballs since python 3.8, older versions try the addresses one after
+    the other.
+
+    @param[str] host : the remote server host
+    @param[int] port : the remote server port
+    @param[ssl.SSLContext] ssl : the SSL context for a secure connection
+    @param[ResolutionCache] resolutions : an optional cache of host name
+                                            resolutions
+    @return[tuple] : the (reader, writer) pair
+    """
+    if resolutions is not None:
+        loop = asyncio.get_event_loop()
+        # getaddrinfo blocks on a cache miss
+        infos = await loop.run_in_executor(None, resolutions.resolve, host, port)
+        try:
+            sock = await happy_eyeballs_connect_async(infos)
+        except OSError:
+            # the server may have moved, resolve it again next time
+            resolutions.invalidate(host, port)
+            raise
+        tls = dict(ssl=ssl, server_hostname=host) if ssl is not None else dict()
+        try:
+            return await asyncio.open_connection(sock=sock, **tls)
+        except BaseException:
+            sock.close()
+            raise
+    if sys.version_info >= (3, 8):
+        return await asyncio.open_connection(host, port, ssl=ssl, happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY,
+                                                interleave=1)
+    return await asyncio.open_connection(host, port, ssl=ssl)
+
+
+class ResolutionCache(object):
+    """A cache of host name resolutions
+
+    getaddrinfo does not expose the TTL of the records, so the answers are
+    kept for a fixed number of seconds. An expired answer is still used
+    when the resolution fails, so a resolver outage does not prevent the
+    updates.
+    """
+
+    def __init__(self, ttl=60):
+        """Constructor : Build an empty cache
+
+        @param[int] ttl : the number of seconds to keep an answer
+        """
+        self.ttl = ttl
+        self.__answers = dict()
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger('dynupdate')
+
+    def resolve(self, host, port):
+        """Return the addresses of a host
+
+        @param[str] host : the host name or address
+        @param[int] port : the port to connect to
+        @return[list] : the getaddrinfo results for stream sockets
+        """
+        key = (host, port)
+        with self.__lock:
+            cached = self.__answers.get(key)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if cached is None:
+                raise
+            self.__logger.debug('-> resolution of %s failed (%s), using expired addresses', host, str(e))
+            return cached[1]
+        with self.__lock:
+            self.__answers[key] = (time.monotonic() + self.ttl, infos)
+        return infos
+
+    def invalidate(self, host, port):
+        """Forget the addresses of a host
+
+        @param[str] host : the host name or address
+        @param[int] port : the port to connect to
+        """
+        with self.__lock:
+            self.__answers.pop((host, port), None)
+
+
+class ConnectionPool(object):
+    """A pool of persistent HTTP connections
+
+    This class keep one opened connection per remote server, so successive
+    queries to the same server reuse the same TCP (and TLS) session thanks to
+    HTTP keep-alive. A connection dropped by the server is transparently
+    replaced by a fresh one.
+
+    Secure connections share their SSL context, and the TLS session of the
+    last connection to a server is resumed by the next one to get abbreviated
+    handshakes.
+
+    Server names are resolved once per ResolutionCache TTL, and all their
+    addresses are raced with happy eyeballs.
+
+    The pool is thread-safe : a connection is used by one query at a time,
+    concurrent queries to the same server open their own connection and
+    up to MAX_IDLE of them are kept for the next queries.
+    """
+
+    # the maximum number of idle connections kept per server
+    MAX_IDLE = 4
+
+    def __init__(self, tls_contexts=None, resolutions=None):
+        """Constructor : Build an empty pool
+
+        @param[TLSContextCache] tls_contexts : an optional cache of SSL
+                                                contexts to share
+        @param[ResolutionCache] resolutions : an optional cache of host
+                                                name resolutions to share
+        """
+        self.__connections = dict()
+        self.__sessions = dict()
+        self.__mutex = threading.Lock()
+        if tls_contexts is None:
+            tls_contexts = TLSContextCache()
+        self.tls_contexts = tls_contexts
+        if resolutions is None:
+            resolutions = ResolutionCache()
+        self.resolutions = resolutions
+        self.__logger = logging.getLogger('dynupdate')
+
+    def request(self, proto, host, port, method, url, headers, timeout=5, tls=None, timings=None):
+        """Send an HTTP query by using a pooled connection
+
+        At most MAX_ANSWER_SIZE bytes of the body are read.
+
+        @param[str] proto : the protocol, 'http' or 'https'
+        @param[str] host : the remote server host
+        @param[int] port : the remote server port
+        @param[str] method : the HTTP method
+        @param[str] url : the url to query
+        @param[dict] headers : the HTTP headers
+        @param[int] timeout : the connection timeout in seconds
+        @param[TLSOptions] tls : the TLS settings for https
+        @param[dict] timings : an optional dict filled with the duration in
+                                seconds of each phase of the query
+        @return[tuple] : the HTTP response object and its body
+        """
+        if tls is None:
+            tls = TLSOptions()
+        key = (proto, host, port, tls)
+        # take the connection out of the pool while it is in use
+        with self.__mutex:
+            idle = self.__connections.get(key)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self.__create(key, timeout)
+        try:
+            res, data = self.__send(key, conn, method, url, headers, timings)
+        except ConnectionPool.reconnect_exceptions() as e:
+            conn.close()
+            if not reused:
+                raise
+            self.__logger.debug('-> persistent connection closed by server (%s), reconnecting', str(e))
+            conn = self.__create(key, timeout)
+            try:
+                res, data = self.__send(key, conn, method, url, headers, timings)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        # keep the connection only if the server allows it and it is clean
+        if getattr(res, 'will_close', True) or not getattr(res, 'isclosed', lambda: True)():
+            conn.close()
+            return res, data
+        with self.__mutex:
+            idle = self.__connections.setdefault(key, [])
+            if len(idle) < ConnectionPool.MAX_IDLE:
+                idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return res, data
+
+    @staticmethod
+    def reconnect_exceptions():
+        """Return the exceptions raised when the server closed an idle connection
+
+        @return[tuple] : the exception classes
+        """
+        return (http.client.RemoteDisconnected,
+                http.client.CannotSendRequest,
+                ConnectionResetError,
+                BrokenPipeError)
+
+    def __create(self, key, timeout):
+        """Build a new connection
+
+        @param[tuple] key : the pool key (proto, host, port, tls)
+        @param[int] timeout : the connection timeout in seconds
+        @return[HTTPConnection] : the new connection, not yet connected
+        """
+        proto, host, port, tls = key
+        if proto != 'https':
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+            context = None
+        else:
+            context = self.tls_contexts.get(tls)
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=context)
+        # replace the default connect to time each step and resume the previous TLS session
+        conn.connect = lambda: self.__connect(conn, key, context)
+        return conn
+
+    def __connect(self, conn, key, context):
+        """Open the socket of a connection
+
+        @param[HTTPConnection] conn : the connection to connect
+        @param[tuple] key : the pool key
+        @param[ssl.SSLContext] context : the SSL context to use for https
+        """
+        with span('connect', proto=key[0], host=conn.host, port=conn.port):
+            self.__open(conn, key, context)
+
+    def __open(self, conn, key, context):
+        """Resolve, connect and handshake, see __connect()
+        """
+        timings = getattr(conn, 'timings', None)
+        start = time.perf_counter()
+        infos = self.resolutions.resolve(conn.host, conn.port)
+        resolved = time.perf_counter()
+        try:
+            sock = happy_eyeballs_connect(infos, conn.timeout)
+        except OSError:
+            # the server may have moved, resolve it again next time
+            self.resolutions.invalidate(conn.host, conn.port)
+            raise
+        sock.settimeout(conn.timeout)
+        connected = time.perf_counter()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            # python < 3.6 can not resume TLS sessions
+            resume = dict(session=self.__sessions.get(key)) if hasattr(ssl, 'SSLSession') else dict()
+            try:
+                sock = context.wrap_socket(sock, server_hostname=conn.host, **resume)
+            except Exception:
+                sock.close()
+                raise
+            # http.client forget the socket of a response which close the connection
+            conn.tls_socket = sock
+            if getattr(sock, 'session_reused', False):
+                self.__logger.debug('-> TLS session resumed')
+        conn.sock = sock
+        if timings is not None:
+            timings['resolve'] = resolved - start
+            timings['connect'] = connected - resolved
+            timings['handshake'] = time.perf_counter() - connected
+
+    def __save_session(self, key, conn):
+        """Remember the TLS session of a connection for the next one
+
+        @param[tuple] key : the pool key
+        @param[HTTPSConnection] conn : an HTTPS connection
+        """
+        if not hasattr(ssl, 'SSLSession'):
+            return
+        session = getattr(getattr(conn, 'tls_socket', None), 'session', None)
+        if isinstance(session, ssl.SSLSession):
+            self.__sessions[key] = session
+
+    def __send(self, key, conn, method, url, headers, timings):
+        """Send the query and read the whole response
+
+        @param[tuple] key : the pool key
+        @param[HTTPConnection] conn : the connection to use
+        @param[dict] timings : an optional dict to fill with phase durations
+        @return[tuple] : the HTTP response object and its body
+        """
+        if timings is not None:
+            for phase in ['resolve', 'connect', 'handshake']:
+                timings[phase] = 0.0
+            conn.timings = timings
+        start = time.perf_counter()
+        conn.request(method, url, headers=headers)
+        sent = time.perf_counter()
+        with span('getresponse', proto=key[0], host=key[1], port=key[2]):
+            res = conn.getresponse()
+        first_byte = time.perf_counter()
+        # TLS 1.3 session tickets are received with the first response bytes
+        if key[0] == 'https':
+            self.__save_session(key, conn)
+        # the body must be entirely read before the connection can be reused
+        data = res.read(MAX_ANSWER_SIZE + 1)
+        if len(data) > MAX_ANSWER_SIZE:
+            self.__logger.debug('-> answer truncated to %d bytes', MAX_ANSWER_SIZE)
+            data = data[:MAX_ANSWER_SIZE]
+            res.will_close = True
+        if timings is not None:
+            # the lazy connection is established by request()
+            connection = timings['resolve'] + timings['connect'] + timings['handshake']
+            timings['send'] = max(0.0, sent - start - connection)
+            timings['first_byte'] = first_byte - sent
+            timings['read'] = time.perf_counter() - first_byte
+        return res, data
+
+    def close(self):
+        """Close all pooled connections
+        """
+        with self.__mutex:
+            connections = [conn for idle in self.__connections.values() for conn in idle]
+            self.__connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def __len__(self):
+        with self.__mutex:
+            return sum(len(idle) for idle in self.__connections.values())
+
+
+class Metrics(object):
+    """Collect the latency and the outcome of update queries
+
+    This class aggregate the duration of each phase of the queries into
+    histograms, count the return codes per server, and export them in the
+    Prometheus text format. Each query can also be appended to a JSON lines
+    file.
+    """
+
+    # the phases of a query
+    PHASES = ['rate_limit', 'resolve', 'connect', 'handshake', 'send', 'first_byte', 'read', 'total']
+
+    # the histogram upper bounds in seconds
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, prometheus_file=None, json_file=None):
+        """Constructor : Build an empty collector
+
+        @param[str] prometheus_file : the path of a textfile collector file
+        @param[str] json_file : the path of a JSON lines file
+        """
+        self.__prometheus_file = prometheus_file
+        self.__json_file = json_file
+        self.__histograms = collections.OrderedDict()
+        self.__outcomes = collections.Counter()
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger('dynupdate')
+
+    def observe(self, server, timings, codes):
+        """Record one query
+
+        @param[str] server : the server url
+        @param[dict] timings : the duration in seconds of each phase
+        @param[list] codes : the return code for each hostname of the query
+        """
+        with self.__lock:
+            for phase in Metrics.PHASES:
+                if phase not in timings:
+                    continue
+                histogram = self.__histograms.get((server, phase))
+                if histogram is None:
+                    histogram = self.__histograms[(server, phase)] = dict(buckets=[0] * len(Metrics.BUCKETS),
+                                                                            sum=0.0, count=0)
+                value = timings[phase]
+                for i, bound in enumerate(Metrics.BUCKETS):
+                    if value <= bound:
+                        histogram['buckets'][i] += 1
+                histogram['sum'] += value
+                histogram['count'] += 1
+            for code in codes:
+                self.__outcomes[(server, code)] += 1
+        if self.__json_file:
+            event = dict(time=time.time(), server=server, codes=codes,
+                            timings=dict((phase, round(value, 6)) for phase, value in timings.items()))
+            try:
+                with open(self.__json_file, 'a') as json_file:
+                    json_file.write(json.dumps(event, sort_keys=True) + '\n')
+            except OSError as e:
+                self.__logger.warning('Unable to write metrics file : %s', str(e))
+
+    @staticmethod
+    def __labels(**labels):
+        """Format Prometheus labels
+
+        @return[str] : the labels string
+        """
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items())) + '}'
+
+    def prometheus(self):
+        """Export the metrics in the Prometheus text format
+
+        @return[str] : the exposition text
+        """
+        lines = ['# HELP dyndnsupdate_query_phase_seconds Duration of each phase of the update queries',
+                 '# TYPE dyndnsupdate_query_phase_seconds histogram']
+        with self.__lock:
+            for (server, phase), histogram in self.__histograms.items():
+                for bound, count in zip(Metrics.BUCKETS, histogram['buckets']):
+                    lines.append('dyndnsupdate_query_phase_seconds_bucket{} {}'.format(
+                        self.__labels(server=server, phase=phase, le=bound), count))
+                lines.append('dyndnsupdate_query_phase_seconds_bucket{} {}'.format(
+                    self.__labels(server=server, phase=phase, le='+Inf'), histogram['count']))
+                lines.append('dyndnsupdate_query_phase_seconds_sum{} {}'.format(
+                    self.__labels(server=server, phase=phase), repr(histogram['sum'])))
+                lines.append('dyndnsupdate_query_phase_seconds_count{} {}'.format(
+                    self.__labels(server=server, phase=phase), histogram['count']))
+            lines.append('# HELP dyndnsupdate_updates_total Number of hostname updates by return code')
+            lines.append('# TYPE dyndnsupdate_updates_total counter')
+            for (server, code), count in sorted(self.__outcomes.items()):
+                lines.append('dyndnsupdate_updates_total{} {}'.format(self.__labels(server=server, code=code), count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Atomically write the Prometheus textfile
+        """
+        if not self.__prometheus_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.__prometheus_file))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.dyndnsupdate.')
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(self.prometheus())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.__prometheus_file)
+        except OSError as e:
+            self.__logger.warning('Unable to write metrics file : %s', str(e))
+
+
+class StateCache(object):
+    """A persistent store of the last successful updates
+
+    This class remember for each server url, hostname and address family
+    the last ip address which was successfully pushed. It is used to skip update
+    queries when nothing has changed since the previous run.
+
+    The file is always replaced atomically, and read-modify-write cycles are
+    protected by an exclusive lock so concurrent runs can share the same file.
+    """
+
+    def __init__(self, path, max_age=86400):
+        """Constructor : Build a state cache
+
+        @param[str] path : the path of the JSON state file
+        @param[int] max_age : the number of seconds after which an entry
+                                must be refreshed even if unchanged
+        """
+        self.__path = path
+        self.__max_age = max_age
+        self.__logger = logging.getLogger('dynupdate')
+
+    @staticmethod
+    def key(server_url, hostname, family=4):
+        """Build the identifier of an entry
+
+        @param[str] server_url : the url of the dyndns server
+        @param[str] hostname : the dyn hostname
+        @param[int] family : the address family, 4 or 6
+        @return[str] : the entry key
+        """
+        return server_url + ' ' + hostname + (' ipv6' if family == 6 else '')
+
+    def get(self, server_url, hostname, family=4, state=None):
+        """Return the stored entry
+
+        @param[str] server_url : the url of the dyndns server
+        @param[str] hostname : the dyn hostname
+        @param[int] family : the address family, 4 or 6
+        @param[dict] state : the entries returned by load(), read from the
+                                file if not given
+        @return[dict] : the entry with keys 'ip', 'timestamp', 'answer'
+                        or None if unknown
+        """
+        if state is None:
+            state = self.load()
+        return state.get(StateCache.key(server_url, hostname, family))
+
+    def load(self):
+        """Read all the entries at once
+
+        @return[dict] : the content of the state file, to give to is_fresh()
+                        when checking many hostnames
+        """
+        with self.__lock(fcntl.LOCK_SH if fcntl else None):
+            return self.__load()
+
+    def is_fresh(self, server_url, hostname, ip, now=None, state=None):
+        """Check if an update is unnecessary
+
+        @param[str] server_url : the url of the dyndns server
+        @param[str] hostname : the dyn hostname
+        @param[str] ip : the ip address to set
+        @param[dict] state : the entries returned by load(), read from the
+                                file if not given
+        @return[bool] : True if the same ip was pushed recently enough
+        """
+        if state is None:
+            state = self.load()
+        entry = state.get(StateCache.key(server_url, hostname, address_family(ip)))
+        if entry is None or entry.get('ip') != ip:
+            return False
+        if now is None:
+            now = time.time()
+        return now - entry.get('timestamp', 0) < self.__max_age
+
+    def set(self, server_url, hostnames, ip, answer, now=None):
+        """Record a successful update
+
+        @param[str] server_url : the url of the dyndns server
+        @param[list] hostnames : the updated dyn hostnames
+        @param[str] ip : the ip address which was pushed, or the comma
+                            separated addresses of both families
+        @param[str|dict] answer : the server's answer, or a dict of the
+                                    answer for each hostname
+        """
+        if now is None:
+            now = time.time()
+        with self.__lock(fcntl.LOCK_EX if fcntl else None):
+            state = self.__load()
+            for address in split_addresses(ip).values():
+                for hostname in hostnames:
+                    state[StateCache.key(server_url, hostname, address_family(address))] = dict(
+                        ip=address,
+                        timestamp=now,
+                        answer=answer[hostname] if isinstance(answer, dict) else answer)
+            self.__save(state)
+
+    def __lock(self, operation):
+        """Acquire a lock on the state file
+
+        @param[int] operation : the fcntl lock type
+        @return[file] : a context manager releasing the lock when closed
+        """
+        lock_file = open(self.__path + '.lock', 'a')
+        if operation is not None:
+            fcntl.flock(lock_file.fileno(), operation)
+        return lock_file
+
+    def __load(self):
+        """Read the state file
+
+        @return[dict] : the content of the state file
+        """
+        try:
+            with open(self.__path, 'r') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as e:
+            self.__logger.warning('Ignoring unreadable state file "%s" : %s', self.__path, str(e))
+            return dict()
+        if not isinstance(state, dict):
+            self.__logger.warning('Ignoring malformed state file "%s"', self.__path)
+            return dict()
+        return state
+
+    def __save(self, state):
+        """Atomically replace the state file
+
+        @param[dict] state : the new content of the state file
+        """
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.dyndnsupdate.')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(state, tmp_file, sort_keys=True)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.__path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class UpdateJournal(object):
+    """A durable journal of the updates which could not be sent
+
+    Each pending update and each completion is appended as a JSON line, so
+    an interrupted write only loses its own line. The updates are recorded
+    by server and account, and only the newest address of each hostname and
+    address family is kept : the journal is compacted by atomically
+    rewriting the live entries when it grows, whatever the outage length.
+
+    The fsync policy trades durability for speed : 'always' sync each write,
+    'batch' only when sync() is called and 'never' leave it to the system.
+    """
+
+    FSYNC_POLICIES = ['always', 'batch', 'never']
+
+    # the number of obsolete lines tolerated before a compaction
+    COMPACT_MIN_LINES = 64
+
+    def __init__(self, path, fsync='always'):
+        """Constructor : Build a journal
+
+        @param[str] path : the path of the JSON lines journal file
+        @param[str] fsync : the fsync policy, one of FSYNC_POLICIES
+        """
+        if fsync not in UpdateJournal.FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy "{}"'.format(fsync))
+        self.__path = path
+        self.__fsync = fsync
+        self.__logger = logging.getLogger('dynupdate')
+
+    def append(self, server_url, hostnames, ip, now=None, username=None):
+        """Record updates which must be sent later
+
+        @param[str] server_url : the url of the dyndns server
+        @param[list] hostnames : the dyn hostnames to update
+        @param[str] ip : the ip address to set, or the comma separated
+                            addresses of both families
+        @param[str] username : the account of the updates
+        """
+        if now is None:
+            now = time.time()
+        addresses = sorted(split_addresses(ip).items())
+        with self.__lock(fcntl.LOCK_EX if fcntl else None):
+            entries, lines = self.__load()
+            records = []
+            for hostname in hostnames:
+                for family, address in addresses:
+                    key = (server_url, username, hostname, family)
+                    if entries.get(key, dict()).get('ip') != address:
+                        entries.pop(key, None)
+                        entries[key] = dict(ip=address, timestamp=now)
+                        records.append(dict(server=server_url, username=username, hostname=hostname,
+                                            ip=address, timestamp=now))
+            self.__commit(entries, lines, records)
+
+    def done(self, server_url, hostnames, since, username=None, ip=None):
+        """Record the completion of updates
+
+        Only the entries recorded before the completed update started are
+        removed, a newer address appended meanwhile is kept. The entries of
+        the families which were not sent are kept too.
+
+        @param[str] server_url : the url of the dyndns server
+        @param[list] hostnames : the updated dyn hostnames
+        @param[float] since : the time at which the update started
+        @param[str] username : the account of the updates
+        @param[str] ip : the addresses which were set, None for all the
+                            families
+        """
+        families = sorted(split_addresses(ip)) if ip else [4, 6]
+        with self.__lock(fcntl.LOCK_EX if fcntl else None):
+            entries, lines = self.__load()
+            records = []
+            for hostname in hostnames:
+                for family in families:
+                    key = (server_url, username, hostname, family)
+                    if entries.get(key, dict()).get('timestamp', since) < since:
+                        del entries[key]
+                        records.append(dict(server=server_url, username=username, hostname=hostname,
+                                            family=family, done=since))
+            self.__commit(entries, lines, records)
+
+    def pending(self, server_url=None, username=None):
+        """Return the updates waiting to be sent
+
+        @param[str] server_url : only return the updates of this server, and
+                                    of the account username on it
+        @param[str] username : the account of the updates of server_url
+        @return[list] : the UpdateRecord in order of recording, without
+                        password, with the addresses of both families
+                        joined by a comma
+        """
+        with self.__lock(fcntl.LOCK_SH if fcntl else None):
+            entries, _ = self.__load()
+        hosts = collections.OrderedDict()
+        for (server, account, hostname, family), entry in entries.items():
+            if server_url is None or (server, account) == (server_url, username):
+                hosts.setdefault((server, account, hostname), dict())[family] = entry['ip']
+        return [UpdateRecord(server, account, None, ','.join(addresses[family] for family in sorted(addresses)),
+                                hostname)
+                for (server, account, hostname), addresses in hosts.items()]
+
+    def sync(self):
+        """Flush the journal to the disk, required by the 'batch' policy
+        """
+        if self.__fsync == 'never':
+            return
+        try:
+            fd = os.open(self.__path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __lock(self, operation):
+        """Acquire a lock on the journal file
+
+        @param[int] operation : the fcntl lock type
+        @return[file] : a context manager releasing the lock when closed
+        """
+        lock_file = open(self.__path + '.lock', 'a')
+        if operation is not None:
+            fcntl.flock(lock_file.fileno(), operation)
+        return lock_file
+
+    def __load(self):
+        """Replay the journal file
+
+        @return[tuple] : the OrderedDict of (server, username, hostname,
+                            family) => live entry and the number of lines of
+                            the file
+        """
+        entries = collections.OrderedDict()
+        lines = 0
+        try:
+            with open(self.__path, 'r') as journal_file:
+                for line in journal_file:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                        host = (record['server'], record.get('username'), record['hostname'])
+                    except (ValueError, KeyError, TypeError):
+                        # a line truncated by a crash
+                        continue
+                    if 'done' in record:
+                        # the older lines complete all the families
+                        for family in [record['family']] if 'family' in record else [4, 6]:
+                            key = host + (family,)
+                            if key in entries and entries[key]['timestamp'] < record['done']:
+                                del entries[key]
+                    elif 'ip' in record:
+                        # the older lines may hold the addresses of both families
+                        for family, address in sorted(split_addresses(record['ip']).items()):
+                            key = host + (family,)
+                            entries.pop(key, None)
+                            entries[key] = dict(ip=address, timestamp=record.get('timestamp', 0))
+        except FileNotFoundError:
+            pass
+        return entries, lines
+
+    def __commit(self, entries, lines, records):
+        """Append records to the journal file, or compact it if too long
+
+        @param[OrderedDict] entries : the live entries after the records
+        @param[int] lines : the number of lines of the journal file
+        @param[list] records : the dict to write as JSON lines
+        """
+        if not records:
+            return
+        if lines + len(records) > 2 * len(entries) + UpdateJournal.COMPACT_MIN_LINES:
+            self.__compact(entries)
+            return
+        with open(self.__path, 'ab+') as journal_file:
+            # a previous write may have been interrupted in the middle of a line
+            if journal_file.seek(0, os.SEEK_END) > 0:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b'\n':
+                    journal_file.write(b'\n')
+            journal_file.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records).encode())
+            journal_file.flush()
+            if self.__fsync == 'always':
+                os.fsync(journal_file.fileno())
+
+    def __compact(self, entries):
+        """Atomically replace the journal file by its live entries
+
+        @param[OrderedDict] entries : the live entries
+        """
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.dyndnsupdate.')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(''.join(json.dumps(dict(entry, server=server, username=username, hostname=hostname),
+                                                    sort_keys=True) + '\n'
+                                        for (server, username, hostname, _), entry in entries.items()))
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.__path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.__logger.debug('-> journal compacted to %d entries', len(entries))
+
+
+class RateLimiter(object):
+    """A token bucket limiting the queries of each account
+
+    Each (server host, username) pair owns a bucket of burst tokens refilled
+    at a constant rate, each query taking one token. The buckets are kept in
+    a small JSON file protected by an exclusive lock so all the processes
+    using the same file share one budget, or in memory when no path is given.
+
+    A query which finds its bucket empty reserves the next token and must
+    wait for it, unless the wait is longer than max_wait : the query must then
+    be abandoned and nothing is consumed.
+    """
+
+    # the error of the queries abandoned because of the limit
+    ERROR = 'rate limit reached'
+
+    def __init__(self, rate, burst=1, path=None, max_wait=0):
+        """Constructor : Build a rate limiter
+
+        @param[float] rate : the number of tokens refilled by second
+        @param[int] burst : the size of the buckets
+        @param[str] path : the path of the JSON state file, None to keep the
+                            buckets in memory
+        @param[float] max_wait : the maximum number of seconds a query may
+                                    wait, 0 to fail fast
+        """
+        if rate <= 0:
+            raise ValueError('the rate must be positive')
+        if burst < 1:
+            raise ValueError('the burst must be at least 1')
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.max_wait = float(max_wait)
+        self.__path = path
+        self.__buckets = dict()
+        self.__mutex = threading.Lock()
+        self.__logger = logging.getLogger('dynupdate')
+
+    @staticmethod
+    def key(host, username=None):
+        """Build the identifier of a bucket
+
+        @param[str] host : the host of the dyndns server
+        @param[str] username : the account name
+        @return[str] : the bucket key
+        """
+        return host + ' ' + (username or '')
+
+    def acquire(self, host, username=None, now=None):
+        """Take a token from the bucket of an account
+
+        @param[str] host : the host of the dyndns server
+        @param[str] username : the account name
+        @return[float] : the number of seconds to wait before sending the
+                            query, or None if it must not be sent
+        """
+        if now is None:
+            now = time.time()
+        with self.__mutex, self.__lock():
+            buckets = self.__load()
+            key = RateLimiter.key(host, username)
+            bucket = buckets.get(key, dict(tokens=self.burst, timestamp=now))
+            # tolerate a clock going backward
+            elapsed = max(0, now - bucket.get('timestamp', now))
+            tokens = min(self.burst, bucket.get('tokens', self.burst) + elapsed * self.rate)
+            delay = max(0, (1 - tokens) / self.rate)
+            if delay > self.max_wait:
+                return None
+            buckets[key] = dict(tokens=tokens - 1, timestamp=now)
+            # the full buckets are the same as unknown ones
+            for name, bucket in list(buckets.items()):
+                if bucket.get('tokens', 0) + (now - bucket.get('timestamp', 0)) * self.rate >= self.burst:
+                    del buckets[name]
+            self.__save(buckets)
+        return delay
+
+    def reserve(self, host, username=None):
+        """Take a token for a query and log the limited queries
+
+        An unusable state file does not block the queries, the limit is then
+        not applied.
+
+        @param[str] host : the host of the dyndns server
+        @param[str] username : the account name
+        @return[float] : the number of seconds to wait before sending the
+                            query, or None if it must not be sent
+        """
+        try:
+            delay = self.acquire(host, username)
+        except OSError as e:
+            self.__logger.warning('Unable to use the rate limit file : %s', str(e))
+            return 0
+        account = username or '(anonymous)'
+        if delay is None:
+            self.__logger.warning('Rate limit reached for account %s on %s, postponing the update', account, host)
+        elif delay > 0:
+            self.__logger.info('Rate limit reached for account %s on %s, waiting %.1f seconds', account, host, delay)
+        return delay
+
+    def __lock(self):
+        """Acquire an exclusive lock on the state file
+
+        @return[file] : a context manager releasing the lock when closed
+        """
+        if self.__path is None:
+            return open(os.devnull, 'r')
+        lock_file = open(self.__path + '.lock', 'a')
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def __load(self):
+        """Read the buckets
+
+        @return[dict] : bucket key => dict with keys 'tokens' and 'timestamp'
+        """
+        if self.__path is None:
+            return self.__buckets
+        try:
+            with open(self.__path, 'r') as state_file:
+                buckets = json.load(state_file)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as e:
+            self.__logger.warning('Ignoring unreadable rate limit file "%s" : %s', self.__path, str(e))
+            return dict()
+        if not isinstance(buckets, dict) or not all(isinstance(bucket, dict) for bucket in buckets.values()):
+            self.__logger.warning('Ignoring malformed rate limit file "%s"', self.__path)
+            return dict()
+        return buckets
+
+    def __save(self, buckets):
+        """Atomically replace the buckets
+
+        @param[dict] buckets : the new buckets
+        """
+        if self.__path is None:
+            self.__buckets = buckets
+            return
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.dyndnsupdate.')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(buckets, tmp_file, sort_keys=True)
+            os.replace(tmp_path, self.__path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def setup_logging():
+    """Replace the handlers of the program logger by the default ones
+
+    @return[tuple] : the stdout and the stderr handlers
+    """
+    logger = logging.getLogger('dynupdate')
+    logger.setLevel(logging.DEBUG)
+
+    # remove all previously defined handlers
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    # default format for all handlers
+    out_formatter = logging.Formatter("%(levelname)s [%(name)s] : %(message)s")
+    # register stdout handler
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(out_formatter)
+    stdout_handler.setLevel(logging.INFO)
+    logger.addHandler(stdout_handler)
+    # register stderr handler
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(out_formatter)
+    stderr_handler.setLevel(logging.CRITICAL+1)
+    logger.addHandler(stderr_handler)
+    return stdout_handler, stderr_handler
+
+
+def apply_log_options(handlers, options):
+    """Set the level of the handlers from the verbose and errors_to_stderr options
+
+    @param[tuple] handlers : the stdout and the stderr handlers
+    @param[dict] options : the program options
+    """
+    stdout_handler, stderr_handler = handlers
+    if 'verbose' in options:
+        if options['verbose'] < 0:
+            stdout_handler.setLevel(logging.CRITICAL + 1)
+        else:
+            stdout_handler.setLevel(logging.INFO - options['verbose']*10)
+    if 'errors_to_stderr' in options and options['errors_to_stderr']:
+        stderr_handler.setLevel(logging.ERROR)
+
+
+class DynDNSUpdate(object):
+    """An instance of a dyn client
+
+    This class represent a instance of a dyn dns client until it make
+    his http query to update a remote dns server entry
+    """
+
+    # define the http protocol string
+    REG_E_PROTO = 'https?'
+
+    # match a exact ipv4 address
+    REG_E_IPV4 = r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9][0-9]|[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9][0-9]|[0-9])'
+
+    # match a exact ipv6 address in its full or compressed forms
+    REG_E_IPV6 = ('(?:(?:[0-9a-fA-F]{1,4}:){7}[0-9a-fA-F]{1,4}|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,7}:|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,5}(?::[0-9a-fA-F]{1,4}){1,2}|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,4}(?::[0-9a-fA-F]{1,4}){1,3}|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,3}(?::[0-9a-fA-F]{1,4}){1,4}|' +
+                    '(?:[0-9a-fA-F]{1,4}:){1,2}(?::[0-9a-fA-F]{1,4}){1,5}|' +
+                    '[0-9a-fA-F]{1,4}:(?::[0-9a-fA-F]{1,4}){1,6}|' +
+                    ':(?:(?::[0-9a-fA-F]{1,4}){1,7}|:))')
+
+    # according to RFC 1123 define an hostname
+    REG_E_HOST = r'(?:(?:[a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*(?:[A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])'
+
+    # match the exact value of a port number
+    REG_E_PORT = '(?:[0-9]{1,4}|[1-5][0-9]{4}|6[0-4][0-9]{3}|65[0-4][0-9]{2}|655[0-2][0-9]|6553[0-5])'
+
+    # match a resource's path
+    REG_E_PATH = '/(?:(?:[a-zA-Z0-9-_~.%]+/?)*)?'
+
+    # match some http parameters
+    REG_E_QUERY = r'\?(?:&?[a-zA-Z0-9-_~.%]+=?[a-zA-Z0-9-_~.%]*)+'
+
+    # an URL is defined by :
+    # PROTO+AUTH+IP|HOST+PORT+PATH+QUERY
+    REG_E_URL = ('^(?P<url>(?:(?P<proto>' + REG_E_PROTO + ')://)?' +  # HTTP
+               '(?P<host>' + REG_E_IPV4 + '|' + REG_E_HOST + ')' +  # HOST or IP
+               '(?P<port>:' + REG_E_PORT + ')?' +  # PORT
+               '(?P<path>' + REG_E_PATH + ')?' +  # PATH
+               ')$')
+
+    # an ip address is version 4 or 6
+    REG_E_IP = '^(?:(?P<ipv4>' + REG_E_IPV4 + ')|(?P<ipv6>' + REG_E_IPV6 + '))$'  # IP matching
+
+    # re match object, compiled on first use
+    RE_URL = LazyPattern(REG_E_URL)
+    RE_IP = LazyPattern(REG_E_IP)
+    RE_HOST = LazyPattern('^' + REG_E_HOST + '$')
+
+    def __init__(self, connection_pool=None, metrics=None, log_handlers=None):
+        """Constructor : Build an launcher for dynupdate
+
+        @param[ConnectionPool] connection_pool : an optional pool of
+                                    connections to share between instances
+        @param[Metrics] metrics : an optional collector shared between
+                                    instances, flushed by its owner
+        @param[tuple] log_handlers : the stdout and stderr handlers already
+                                    set up by the owner of the instance,
+                                    see setup_logging()
+        """
+        # Network required
+        self.__server_url = None
+        self.__server_api_url = '/nic/update'
+        self.__server_username = None
+        self.__server_password = None
+        self.__tls = TLSOptions()
+        # The HTTP timeout
+        self.__timeout = 5
+        # persistent connections
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        self.__pool = connection_pool
+        # daemon mode stop flag
+        self.__stop_event = threading.Event()
+        # last successful updates
+        self.__state = None
+        # retry of temporary failures
+        self.__retry = RetryPolicy()
+        # latency and outcome metrics
+        self.__metrics = metrics
+        self.__shared_metrics = metrics is not None
+        # public ip address discovery, by address family
+        self.__discoveries = dict()
+        # the address families to update when no address is given
+        self.__ip_families = [4]
+        # how to send the addresses of both families
+        self.__ipv6_mode = 'myip'
+        # the interface which hold the public ip address
+        self.__interface = None
+        # updates kept during outages
+        self.__journal = None
+        self.__journal_limit = 5
+        self.__journal_delay = 1
+        # check the current DNS records before updating
+        self.__resolver = None
+        # client side limit of the queries of the account
+        self.__rate_limiter = None
+        # True once a query of the current run waited for the rate limit
+        self.__rate_waited = False
+
+        # init logger
+        self.__logger = logging.getLogger('dynupdate')
+        self.__log_handlers = log_handlers or setup_logging()
+
+        # DYNDNS protocol
+        self.__fields = default_fields()
+
+    def configure(self, **options):
+        """Parse input main program options (restrict to program strict execution)
+
+        @param[dict] options : array of option key => value
+        @return[bool] : True if the options are valid
+        """
+        with span('configure'):
+            return self.__configure(**options)
+
+    def __configure(self, **options):
+        """Apply the options, see configure()
+        """
+        apply_log_options(self.__log_handlers, options)
+        self.__logger.debug('configured with args %s', options)
+        # disable SSL certificate verification
+        if 'tls_insecure' in options and options['tls_insecure']:
+            self.__tls = self.__tls._replace(insecure=True)
+        # custom CA and client certificate
+        for option in ['cafile', 'capath', 'certfile', 'keyfile']:
+            if 'tls_' + option in options and options['tls_' + option]:
+                self.__tls = self.__tls._replace(**{option: options['tls_' + option]})
+        if self.__tls.keyfile and not self.__tls.certfile:
+            self.__logger.error('A client key requires a client certificate')
+            return False
+        # http timeout
+        if 'timeout' in options and options['timeout']:
+            self.__timeout = options['timeout']
+        if 'resolve_ttl' in options and options['resolve_ttl'] is not None:
+            self.__pool.resolutions.ttl = int(options['resolve_ttl'])
+        # http settings
+        if 'server_url' in options and options['server_url']:
+            match = DynDNSUpdate.RE_URL.match(options['server_url'])
+            if match:
+                self.__server_url = match.groupdict()
+            else:
+                self.__logger.error('given server url "%s" is incorrect', options['server_url'])
+                return False
+        if 'server_api_url' in options and options['server_api_url']:
+            self.__server_api_url = options['server_api_url']
+        if 'server_username' in options and options['server_username']:
+            self.__server_username = options['server_username']
+        if 'server_password' in options and options['server_password']:
+            self.__server_password = options['server_password']
+
+        # retries
+        if 'retry_attempts' in options and options['retry_attempts'] is not None:
+            self.__retry.attempts = max(1, int(options['retry_attempts']))
+        if 'retry_base_delay' in options and options['retry_base_delay'] is not None:
+            self.__retry.base_delay = float(options['retry_base_delay'])
+        if 'retry_max_delay' in options and options['retry_max_delay'] is not None:
+            self.__retry.max_delay = float(options['retry_max_delay'])
+
+        # metrics
+        if not self.__shared_metrics and (options.get('metrics_prometheus_file') or
+                                            options.get('metrics_json_file')):
+            self.__metrics = Metrics(prometheus_file=options.get('metrics_prometheus_file'),
+                                        json_file=options.get('metrics_json_file'))
+
+        # local interface address
+        if 'dyndns_interface' in options and options['dyndns_interface']:
+            self.__interface = options['dyndns_interface']
+
+        # address families
+        if options.get('ip_family'):
+            families = dict([('4', [4]), ('6', [6]), ('dual', [4, 6])])
+            if options['ip_family'] not in families:
+                self.__logger.error('given ip family "%s" is incorrect', options['ip_family'])
+                return False
+            self.__ip_families = families[options['ip_family']]
+        if options.get('ipv6_mode'):
+            if options['ipv6_mode'] not in IPV6_MODES:
+                self.__logger.error('given ipv6 mode "%s" is incorrect', options['ipv6_mode'])
+                return False
+            self.__ipv6_mode = options['ipv6_mode']
+
+        # public ip discovery
+        if options.get('discover_ip') or options.get('discovery_urls') or options.get('discovery_urls6'):
+            for family in self.__ip_families:
+                urls = options.get('discovery_urls' if family == 4 else 'discovery_urls6')
+                self.__discoveries[family] = IPDiscovery(urls=urls, family=family,
+                                                            quorum=int(options.get('discovery_quorum', 1)),
+                                                            ttl=int(options.get('discovery_ttl', 300)),
+                                                            timeout=self.__timeout,
+                                                            tls_contexts=self.__pool.tls_contexts)
+
+        # DNS records check
+        if options.get('dns_check') or options.get('dns_resolvers'):
+            self.__resolver = DNSResolver(servers=options.get('dns_resolvers'),
+                                            timeout=float(options.get('dns_timeout', 2)))
+
+        # state cache
+        if 'state_file' in options and options['state_file']:
+            max_age = options.get('state_max_age', 86400)
+            self.__state = StateCache(options['state_file'], max_age=int(max_age))
+
+        # journal of failed updates
+        if 'journal_file' in options and options['journal_file']:
+            try:
+                self.__journal = UpdateJournal(options['journal_file'], fsync=options.get('journal_fsync') or 'always')
+            except ValueError as e:
+                self.__logger.error('Incorrect journal setting : %s', str(e))
+                return False
+        if 'journal_replay_limit' in options and options['journal_replay_limit'] is not None:
+            self.__journal_limit = max(1, int(options['journal_replay_limit']))
+        if 'journal_replay_delay' in options and options['journal_replay_delay'] is not None:
+            self.__journal_delay = float(options['journal_replay_delay'])
+
+        # rate limit
+        if options.get('rate_limit') is not None:
+            try:
+                self.__rate_limiter = RateLimiter(float(options['rate_limit']) / 60,
+                                                    burst=int(options.get('rate_burst', 5)),
+                                                    path=options.get('rate_file'),
+                                                    max_wait=float(options.get('rate_max_wait', 30)))
+            except ValueError as e:
+                self.__logger.error('Incorrect rate limit setting : %s', str(e))
+                return False
+
+        # dyn dns parsing
+        addresses = split_addresses(self.__fields['myip'])
+        for option in ['dyndns_myip', 'dyndns_myipv6']:
+            if option not in options or not options[option]:
+                continue
+            for address in options[option].split(','):
+                match = DynDNSUpdate.RE_IP.match(address.strip())
+                if not match or (option == 'dyndns_myipv6' and not match.group('ipv6')):
+                    self.__logger.error('given ip address "%s" is incorrect', address)
+                    return False
+                addresses[4 if match.group('ipv4') else 6] = match.group(0)
+        self.__fields['myip'] = ','.join(addresses[family] for family in sorted(addresses))
+        if 'dyndns_hostname' in options and options['dyndns_hostname']:
+            hostnames = options['dyndns_hostname']
+            if not isinstance(hostnames, list):
+                hostnames = hostnames.split(',')
+            # remove duplicates but keep the order
+            hostnames = list(collections.OrderedDict.fromkeys(h.strip() for h in hostnames if h.strip()))
+            if len(hostnames) > MAX_HOSTNAMES:
+                self.__logger.debug('%d hostnames will be sent in batches of %d', len(hostnames), MAX_HOSTNAMES)
+            self.__fields['hostname'] = ','.join(hostnames)
+
+        if 'dyndns_wildcard' in options and options['dyndns_wildcard']:
+            if options['dyndns_wildcard'] in ['ON', 'OFF', 'NOCHG']:
+                self.__logger.warning('Deprecated: Flag wildcard can be currently ignored')
+                self.__fields['wildcard'] = options['dyndns_wildcard']
+            else:
+                self.__logger.error('Incorrect value for dyndns_wildcard option')
+                return False
+        return True
+
+              #
+              # if opt[0] == '--backmx':
+              #   self.__fields['backmx'] = 'YES'
+              # if opt[0] == '--no-backmx':
+              #   self.__fields['backmx'] = 'NO'
+              # if opt[0] == '--offline':
+              #   self.__fields['offline'] = 'YES'
+              # if opt[0] == '--static':
+              #   self.__fields['system'] = 'statdns'
+              # if opt[0] == '--url':
+              #   self.__fields['url'] = opt[1]
+
+    def main(self):
+        """Entry point of the program
+
+        @return[integer] : the exit code, 14 if the run succeeded after
+                            waiting for the rate limit
+        """
+        self.__rate_waited = False
+        if not self.__server_url:
+            self.__logger.error('Missing required setting "server_url" in configure()')
+            return 3
+        required_fields = ['myip', 'hostname']
+        if self.__discoveries or self.__interface is not None:
+            required_fields.remove('myip')
+        for required_field in required_fields:
+            if not self.__fields[required_field]:
+                self.__logger.error('Missing required setting "%s" in configure()', required_field)
+                return 3
+
+        self.__logger.debug('debug: config fields ' + str(self.__fields))
+        myip = self.__fields['myip'] or self.__find_myip()
+        if not myip:
+            return 1
+
+        hostnames = self.__fields['hostname'].split(',')
+        addresses = split_addresses(myip)
+        # the families to update by hostname, an unchanged family is not sent again
+        pending = collections.OrderedDict()
+        state = self.__load_state()
+        for family, address in sorted(addresses.items()):
+            changed = [hostname for hostname in hostnames if not self.__is_up_to_date(state, hostname, address)]
+            if family == 4:
+                changed = self.__check_dns(changed, address, state)
+            for hostname in changed:
+                pending.setdefault(hostname, []).append(family)
+        if not pending:
+            self.__logger.info('IP address %s is unchanged, skipping update', myip)
+            return 0
+
+        records = []
+        for hostname, families in pending.items():
+            if self.__ipv6_mode == 'separate':
+                values = [addresses[family] for family in families]
+            else:
+                values = [','.join(addresses[family] for family in families)]
+            records.extend(UpdateRecord(self.__server_url['url'], self.__server_username,
+                                        self.__server_password, value, hostname)
+                            for value in values)
+        code = 0
+        batches = plan_batches(records)
+        for i, batch in enumerate(batches):
+            batch_code = self.__update(batch)
+            code = max(code, batch_code)
+            if batch_code == 13:
+                # the next batches share the same budget, keep them for later
+                for later in batches[i + 1:]:
+                    self.__postpone(list(later.hostnames), later.myip)
+            # the account is unusable, do not insist
+            if batch_code in [11, 12, 13]:
+                break
+        # the server is reachable again, send the updates of previous outages
+        if code not in [10, 11, 12, 13]:
+            code = max(code, self.__replay(hostnames))
+        if self.__journal is not None:
+            self.__journal.sync()
+        self.__flush_metrics()
+        if code == 0 and self.__rate_waited:
+            code = 14
+        return code
+
+    def __replay(self, hostnames):
+        """Send a limited number of the batches kept in the journal
+
+        @param[list] hostnames : the hostnames already updated by this run
+        @return[integer] : the exit code of the replay
+        """
+        if self.__journal is None:
+            return 0
+        try:
+            entries = self.__journal.pending(self.__server_url['url'], self.__server_username)
+        except OSError as e:
+            self.__logger.warning('Unable to read journal file : %s', str(e))
+            return 0
+        records = [entry._replace(password=self.__server_password)
+                    for entry in entries if entry.hostname not in hostnames]
+        if self.__ipv6_mode == 'separate':
+            records = [record._replace(myip=address)
+                        for record in records for _, address in sorted(split_addresses(record.myip).items())]
+        batches = plan_batches(records)
+        if batches:
+            self.__logger.info('Replaying %d journaled updates', len(records))
+        code = 0
+        for i, batch in enumerate(batches[:self.__journal_limit]):
+            # spread the replay to not flood the server after an outage
+            if i and self.__stop_event.wait(self.__journal_delay):
+                break
+            code = max(code, self.__update(batch))
+            if code in [10, 11, 12, 13]:
+                break
+        return code
+
+    def __update(self, batch):
+        """Send an update batch and retry its temporary failures
+
+        @param[UpdateBatch] batch : the hostnames to update
+        @return[integer] : the exit code of the batch
+        """
+        hostnames = list(batch.hostnames)
+        delays = self.__retry.delays()
+        since = time.time()
+        code = 0
+        while True:
+            fields = query_fields(self.__fields, hostnames, batch.myip, self.__ipv6_mode)
+            status, results = self.__query(fields)
+            if status == 13:
+                self.__postpone(hostnames, batch.myip)
+                return max(code, status)
+            if status not in [0, 10]:
+                return status
+            retry = hostnames if status == 10 else []
+            succeeded = dict()
+            for result in results or []:
+                if result.outcome == 'success':
+                    self.__logger.info('Successfully updated %s (%s)', result.hostname, result.answer or 'OK')
+                    succeeded[result.hostname] = result.answer
+                elif result.outcome == 'retry':
+                    self.__logger.warning('Temporary server error "%s" for %s', result.code, result.hostname)
+                    retry.append(result.hostname)
+                elif result.outcome == 'fatal':
+                    self.__logger.error('The server refused the update with "%s", stopping', result.code)
+                    self.__remember(succeeded, batch.myip, since)
+                    return 11 if result.code == 'badauth' else 12
+                else:
+                    self.__logger.error('The server refused the update of %s with "%s"', result.hostname,
+                                        result.answer or 'no answer')
+                    code = max(code, 1)
+            self.__remember(succeeded, batch.myip, since)
+            if not retry:
+                return code
+
+            delay = next(delays, None)
+            if delay is None:
+                self.__logger.error('Giving up the update of %s after %d attempts',
+                                    ','.join(retry), self.__retry.attempts)
+                self.__postpone(retry, batch.myip)
+                return max(code, 10)
+            self.__logger.info('Retrying the update of %s in %.1f seconds', ','.join(retry), delay)
+            if self.__stop_event.wait(delay):
+                self.__postpone(retry, batch.myip)
+                return max(code, 10)
+            hostnames = retry
+
+    def __find_myip(self):
+        """Find the ip addresses to set when none was configured
+
+        The addresses of the local interface are preferred as they do not
+        require any network query. The addresses of the other families are
+        discovered concurrently.
+
+        @return[str] : the comma separated addresses or None
+        """
+        addresses = dict()
+        if self.__interface is not None:
+            for family in self.__ip_families:
+                try:
+                    address = InterfaceWatcher.current_address(self.__interface,
+                                                                socket.AF_INET if family == 4 else socket.AF_INET6)
+                except OSError as e:
+                    self.__logger.error('Unable to read the address of interface %s : %s', self.__interface, str(e))
+                    break
+                if address is not None:
+                    self.__logger.debug('-> using address %s of interface %s', address, self.__interface)
+                    addresses[family] = address
+                else:
+                    self.__logger.warning('Interface %s has no global IPv%d address', self.__interface, family)
+
+        discoveries = [(family, discovery) for family, discovery in sorted(self.__discoveries.items())
+                        if family not in addresses]
+        found = []
+        if len(discoveries) == 1:
+            found = [discoveries[0][1].discover()]
+        elif discoveries:
+            loop = asyncio.new_event_loop()
+            try:
+                found = loop.run_until_complete(asyncio.gather(*[discovery.discover_async()
+                                                                    for _, discovery in discoveries]))
+            finally:
+                loop.close()
+        for (family, _), address in zip(discoveries, found):
+            if address is not None:
+                self.__logger.info('Discovered public ip address %s', address)
+                addresses[family] = address
+        return ','.join(addresses[family] for family in sorted(addresses)) or None
+
+    def __load_state(self):
+        """Read the state cache once for all the hostnames of a run
+
+        @return[dict] : the state entries, None if there is no state cache
+        """
+        if self.__state is None:
+            return None
+        try:
+            return self.__state.load()
+        except OSError as e:
+            self.__logger.warning('Unable to read state file : %s', str(e))
+            return None
+
+    def __is_up_to_date(self, state, hostname, myip):
+        """Check in the state cache if the update of a hostname can be skipped
+
+        @param[dict] state : the state entries read by __load_state()
+        @param[str] hostname : the hostname to check
+        @param[str] myip : the ip address to set
+        @return[bool] : True if the hostname already have the right ip
+        """
+        if state is None:
+            return False
+        return self.__state.is_fresh(self.__server_url['url'], hostname, myip, state=state)
+
+    def __check_dns(self, hostnames, myip, state=None):
+        """Remove the hostnames whose DNS record already have the ip address
+
+        @param[list] hostnames : the hostnames to update
+        @param[str] myip : the ip address to set
+        @param[dict] state : the state entries read by __load_state()
+        @return[list] : the hostnames which still need an update
+        """
+        if self.__resolver is None or not hostnames:
+            return hostnames
+        # the cached records are older than an address pushed since
+        fresh = []
+        if state is not None:
+            for hostname in hostnames:
+                entry = self.__state.get(self.__server_url['url'], hostname, state=state)
+                if entry is not None and entry['ip'] != myip:
+                    fresh.append(hostname)
+        records = self.__resolver.resolve([hostname for hostname in hostnames
+                                            if DynDNSUpdate.RE_HOST.match(hostname)], fresh)
+        pending = []
+        for hostname in hostnames:
+            if records.get(hostname) and set(records[hostname]) == set([myip]):
+                self.__logger.info('DNS record of %s already points to %s, skipping update', hostname, myip)
+            else:
+                self.__logger.debug('-> DNS record of %s is %s', hostname, records.get(hostname))
+                pending.append(hostname)
+        return pending
+
+    def __remember(self, answers, myip, since):
+        """Store successful updates in the state cache and the journal
+
+        @param[dict] answers : hostname => the server's answer
+        @param[str] myip : the ip address which was set
+        @param[float] since : the time at which the update started
+        """
+        if not answers:
+            return
+        if self.__resolver is not None:
+            self.__resolver.forget(answers)
+        if self.__state is not None:
+            try:
+                self.__state.set(self.__server_url['url'], list(answers), myip, answers)
+            except OSError as e:
+                self.__logger.warning('Unable to write state file : %s', str(e))
+        if self.__journal is not None:
+            try:
+                self.__journal.done(self.__server_url['url'], list(answers), since,
+                                    username=self.__server_username, ip=myip)
+            except OSError as e:
+                self.__logger.warning('Unable to write journal file : %s', str(e))
+
+    def __postpone(self, hostnames, myip):
+        """Keep failed updates in the journal to send them later
+
+        @param[list] hostnames : the hostnames which could not be updated
+        @param[str] myip : the ip address to set
+        """
+        if self.__journal is None:
+            return
+        try:
+            self.__journal.append(self.__server_url['url'], hostnames, myip, username=self.__server_username)
+            self.__logger.info('Kept the update of %s in the journal', ','.join(hostnames))
+        except OSError as e:
+            self.__logger.warning('Unable to write journal file : %s', str(e))
+
+    def daemon(self, interval):
+        """Run the update periodically until stop() is called
+
+        @param[int] interval : the number of seconds between two updates
+        @return[integer] : the exit code of the program
+        """
+        self.__logger.info('Starting daemon mode with an interval of %d seconds', interval)
+        self.__stop_event.clear()
+        try:
+            while True:
+                code = self.main()
+                # bad configuration or refused account will never succeed, stop here
+                if code in [2, 3, 11, 12]:
+                    return code
+                if self.__stop_event.wait(interval):
+                    break
+        finally:
+            self.close()
+        self.__logger.info('Daemon mode stopped')
+        return 0
+
+    def watch(self, interface, debounce=2):
+        """Run the update each time the address of an interface change
+
+        @param[str] interface : the name of the interface to watch
+        @param[int] debounce : the number of quiet seconds to wait after an
+                                address event before updating
+        @return[integer] : the exit code of the program
+        """
+        try:
+            families = [socket.AF_INET if family == 4 else socket.AF_INET6 for family in self.__ip_families]
+            watcher = InterfaceWatcher(interface, debounce=debounce, family=families)
+        except OSError as e:
+            self.__logger.error('Unable to watch interface %s : %s', interface, str(e))
+            return 1
+        if self.__interface is None and not self.__discoveries and not self.__fields['myip']:
+            # without other source, push the address of the watched interface
+            self.__interface = interface
+        self.__logger.info('Watching address changes of interface %s', interface)
+        self.__stop_event.clear()
+        try:
+            code = self.main()
+            if code in [2, 3, 11, 12]:
+                return code
+            while not self.__stop_event.is_set():
+                # wake up regularly to honor stop()
+                if watcher.wait_change(timeout=1):
+                    for discovery in self.__discoveries.values():
+                        discovery.invalidate()
+                    self.main()
+        finally:
+            watcher.close()
+            self.close()
+        self.__logger.info('Watch mode stopped')
+        return 0
+
+    def bulk(self, lines, output, fmt=None, skip=0, concurrency=8):
+        """Update the records read from a stream with bounded concurrency
+
+        The records are read, validated and sent as a pipeline which never
+        holds more than concurrency batches, whatever the size of the input.
+        One JSON object is written to output for each record, in the input
+        order, so an interrupted run can be resumed after its last line.
+
+        @param[iterable] lines : the lines of a CSV or JSON lines input
+        @param[file] output : the stream in which to write the results
+        @param[str] fmt : 'csv', 'jsonl' or None to guess it
+        @param[int] skip : the number of input lines already processed
+        @param[int] concurrency : the maximum number of simultaneous queries
+        @return[integer] : the exit code of the program
+        """
+        server_url = self.__server_url['url'] if self.__server_url else None
+        rows = ((number, row) for number, row in read_records(lines, fmt) if number > skip)
+        records = validate_records(rows, server_url, self.__server_username, self.__server_password)
+        updater = AsyncUpdater(api_url=self.__server_api_url, timeout=self.__timeout, tls=self.__tls,
+                                concurrency=concurrency, server_concurrency=concurrency,
+                                fields=self.__fields, tls_contexts=self.__pool.tls_contexts,
+                                metrics=self.__metrics, ipv6_mode=self.__ipv6_mode,
+                                rate_limiter=self.__rate_limiter, resolutions=self.__pool.resolutions)
+        if skip:
+            self.__logger.info('Resuming bulk update after line %d', skip)
+        self.__stop_event.clear()
+        loop = asyncio.new_event_loop()
+        try:
+            code, counts = loop.run_until_complete(
+                self.__bulk(updater, chunk_records(records), output, max(1, concurrency)))
+        finally:
+            updater.close()
+            loop.close()
+        self.__flush_metrics()
+        self.__logger.info('Bulk update done : %s', ', '.join(
+            '{} {}'.format(count, status) for status, count in sorted(counts.items())) or 'no record')
+        return code
+
+    async def __bulk(self, updater, batches, output, concurrency):
+        """Send the batches of a bulk update within a sliding window
+
+        @param[AsyncUpdater] updater : the engine which send the batches
+        @param[iterable] batches : (line numbers, UpdateBatch or error message)
+        @param[file] output : the stream in which to write the results
+        @param[int] concurrency : the size of the window
+        @return[tuple] : the exit code and a Counter of the records status
+        """
+        window = collections.deque()
+        # (server, username) which must not be used anymore
+        refused = set()
+        counts = collections.Counter()
+        code = 0
+
+        async def write_oldest():
+            numbers, batch, pending = window.popleft()
+            result = None if pending is None else await pending
+            return self.__write_bulk(output, refused, counts, numbers, batch, result)
+
+        for numbers, batch in batches:
+            if self.__stop_event.is_set():
+                self.__logger.warning('Bulk update interrupted before line %d', numbers[0])
+                break
+            pending = None
+            if isinstance(batch, UpdateBatch) and (batch.server_url, batch.username) not in refused:
+                pending = asyncio.ensure_future(updater.update(batch))
+            window.append((numbers, batch, pending))
+            while len(window) >= concurrency:
+                code = max(code, await write_oldest())
+        while window:
+            code = max(code, await write_oldest())
+        return code, counts
+
+    def __write_bulk(self, output, refused, counts, numbers, batch, result):
+        """Write the results of one bulk update batch
+
+        @param[file] output : the stream in which to write the results
+        @param[set] refused : the accounts refused by the servers
+        @param[Counter] counts : the number of records by status
+        @param[list] numbers : the input line number of each record
+        @param[UpdateBatch|str] batch : the sent batch or an error message
+        @param[UpdateResult] result : the result, None if nothing was sent
+        @return[integer] : the exit code of the batch
+        """
+        if not isinstance(batch, UpdateBatch):
+            self.__logger.error('Invalid record at line %d : %s', numbers[0], batch)
+            rows = [dict(status='invalid', error=batch)]
+            code = 1
+        else:
+            account = (batch.server_url, batch.username)
+            base = dict(ip=batch.myip, server=batch.server_url)
+            if result is None:
+                rows = dict((hostname, dict(base, status='skipped', error='account refused by the server'))
+                            for hostname in batch.hostnames)
+                code = 0
+            else:
+                rows = dict()
+                code = 0
+                for host in result.hosts:
+                    if result.error is None:
+                        row = dict(base, code=host.code, answer=host.answer)
+                    elif host.code is None:
+                        row = dict(base, error=result.error)
+                    else:
+                        row = dict(base, code=host.code, error=result.error)
+                    rows[host.hostname] = dict(row, status=host.outcome)
+                    if host.outcome == 'fatal':
+                        refused.add(account)
+                        code = max(code, 11 if host.code == 'badauth' else 12)
+                    elif host.outcome == 'retry':
+                        code = max(code, 13 if result.error == RateLimiter.ERROR else 10)
+                    else:
+                        code = max(code, dict(success=0).get(host.outcome, 1))
+            if account in refused and code in [11, 12]:
+                self.__logger.error('The server refused the account %s, skipping its next records',
+                                    batch.username or '(anonymous)')
+            rows = [dict(rows[hostname], hostname=hostname) for hostname in batch.hostnames]
+        for number, row in zip(numbers, rows):
+            counts[row['status']] += 1
+            output.write(json.dumps(dict(row, line=number), sort_keys=True) + '\n')
+        output.flush()
+        return code
+
+    def relay(self, listen, clients=None, interval=10, anonymous=False):
+        """Serve the update protocol to local clients and forward upstream
+
+        @param[str] listen : the [address:]port on which to listen
+        @param[dict] clients : username => password of the allowed clients
+        @param[float] interval : the number of seconds between two forwards
+        @param[bool] anonymous : accept any local client when no clients
+                                    are given
+        @return[integer] : the exit code of the program
+        """
+        if self.__server_url is None:
+            self.__logger.error('Missing the upstream server url')
+            return 3
+        if not clients and not anonymous:
+            self.__logger.error('The relay requires at least one --relay-client, or --relay-anonymous')
+            return 2
+        host, _, port = str(listen).rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            self.__logger.error('given relay address "%s" is incorrect', listen)
+            return 2
+        updater = AsyncUpdater(api_url=self.__server_api_url, timeout=self.__timeout, tls=self.__tls,
+                                fields=self.__fields, tls_contexts=self.__pool.tls_contexts,
+                                metrics=self.__metrics, ipv6_mode=self.__ipv6_mode,
+                                rate_limiter=self.__rate_limiter, resolutions=self.__pool.resolutions)
+        relay = RelayServer(self.__server_url['url'], self.__server_username, self.__server_password,
+                            path=self.__server_api_url, clients=clients, interval=interval, updater=updater,
+                            anonymous=anonymous)
+        self.__stop_event.clear()
+        loop = asyncio.new_event_loop()
+        try:
+            try:
+                loop.run_until_complete(relay.start(host or '127.0.0.1', port))
+            except OSError as e:
+                self.__logger.error('Unable to listen on %s : %s', listen, str(e))
+                return 1
+            self.__logger.info('Relaying updates received on %s:%d', host or '127.0.0.1', relay.port)
+            code = loop.run_until_complete(relay.run(self.__stop_event))
+        finally:
+            loop.run_until_complete(relay.close())
+            updater.close()
+            loop.close()
+            self.__flush_metrics()
+        self.__logger.info('Relay mode stopped')
+        return code
+
+    def stop(self):
+        """Ask the daemon loop to exit
+        """
+        self.__stop_event.set()
+
+    def resume(self):
+        """Forget a previous stop() request so main() can run again
+        """
+        self.__stop_event.clear()
+
+    def close(self):
+        """Release all network resources held by this instance
+        """
+        self.__pool.close()
+
+    def __flush_metrics(self):
+        """Write the metrics files, unless the collector is shared
+        """
+        if self.__metrics is not None and not self.__shared_metrics:
+            self.__metrics.flush()
+
+    def __query(self, fields):
+        """Forge and send the HTTP GET query
+
+        @param[dict] fields : the dyndns fields to send
+        @return[tuple] : the status, 0 if the server answered, 10 on network
+                            error, 11 on authentication error, 13 if the rate
+                            limit was reached, and the list of HostResult
+                            decoded from the answer
+        """
+        url_parts = self.__server_url
+        host = url_parts['host']
+        port = None
+        if url_parts['port']:
+            port = int(url_parts['port'].lstrip(':'))
+
+        # PROTOCOL
+        if not url_parts['proto'] or url_parts['proto'] == 'http':
+            self.__logger.debug('-> protocol HTTP')
+            proto = 'http'
+            if port is None:
+                port = http.client.HTTP_PORT
+        elif url_parts['proto'] == 'https':
+            self.__logger.debug('-> protocol HTTPs')
+            proto = 'https'
+            if port is None:
+                port = http.client.HTTPS_PORT
+            if self.__tls.insecure:
+                self.__logger.debug('-> SSL certificate verification is DISABLED')
+        else:
+            self.__logger.error('Found unmanaged url protocol : "%s" ignoring url', url_parts['proto'])
+            return 1, None
+        # /PROTOCOL
+
+        # QUERY
+        url, headers = build_query(url_parts, self.__server_api_url, fields,
+                                    self.__server_username, self.__server_password)
+        if 'Authorization' in headers:
+            self.__logger.debug('-> authentication enabled')
+        else:
+            self.__logger.debug('-> authentication disabled')
+        self.__logger.debug('set final url to "%s"', url)
+        # /QUERY
+
+        timings = None if self.__metrics is None else dict()
+        # RATE LIMIT
+        if self.__rate_limiter is not None:
+            delay = self.__rate_limiter.reserve(host, self.__server_username)
+            if delay is None:
+                return 13, None
+            if delay > 0:
+                if self.__stop_event.wait(delay):
+                    return 13, None
+                self.__rate_waited = True
+                if timings is not None:
+                    timings['rate_limit'] = delay
+        # /RATE LIMIT
+
+        start = time.perf_counter()
+        try:
+            res, data = self.__pool.request(proto, host, port, 'GET', url, headers,
+                                            timeout=self.__timeout, tls=self.__tls, timings=timings)
+            data = data.decode(errors='replace')
+        except socket.gaierror as e:
+            self.__logger.debug('=> unable to resolve hostname %s', str(e))
+            return self.__observe(timings, start, 10, None)
+        except ssl.SSLError as e:
+            self.__logger.debug('=> unable to validate the host\'s certifcate.' +
+                            ' You can override this by using --insecure')
+            # not a temporary failure, do not retry
+            return self.__observe(timings, start, 1, None)
+        except socket.error as e:
+            self.__logger.debug('=> unable to connect to host %s', str(e))
+            return self.__observe(timings, start, 10, None)
+        except http.client.HTTPException:
+            self.__logger.debug('=> error with HTTP query')
+            return self.__observe(timings, start, 10, None)
+        except Exception as e:
+            self.__logger.error('Unhandled python exception please inform the developper %s', str(e))
+            return 1, None
+
+        self.__logger.debug('get HTTP status code : %d %s', res.status, res.reason)
+        self.__logger.debug('get HTTP data : "%s"', data)
+
+        # authentication missing error
+        if res.status == 401:
+            self.__logger.debug('=> the server may require an authentification')
+            self.__logger.error('The server at url "%s" may require an authentification', url_parts['url'])
+            return self.__observe(timings, start, 11, None, res.status)
+        elif res.status in [200]:
+            return self.__observe(timings, start, 0, parse_answer(fields['hostname'].split(','), data))
+        elif http_outcome(res.status) == 'retry':
+            self.__logger.debug('=> temporary HTTP error %d', res.status)
+            return self.__observe(timings, start, 10, None, res.status)
+        self.__logger.error('The server at url "%s" refused the query with HTTP status %d %s',
+                            url_parts['url'], res.status, res.reason)
+        return self.__observe(timings, start, 1, None, res.status)
+
+    def __observe(self, timings, start, status, results, http_status=None):
+        """Record the metrics of a query
+
+        @param[dict] timings : the phase durations or None if disabled
+        @param[float] start : the perf_counter value at the query start
+        @param[int] status : the query status
+        @param[list] results : the decoded HostResult
+        @param[int] http_status : the unexpected HTTP status
+        @return[tuple] : the status and the results, unchanged
+        """
+        if timings is not None:
+            timings['total'] = time.perf_counter() - start
+            if results:
+                codes = [result.code or 'ok' for result in results]
+            elif http_status is not None:
+                codes = ['http_{}'.format(http_status)]
+            else:
+                codes = ['network_error']
+            self.__metrics.observe(self.__server_url['url'], timings, codes)
+        return status, results
+
+
+# the result of the update of one hostname by DynDNSClient
+# status is 'success', 'retry', 'error', 'fatal' or 'skipped'
+ClientResult = collections.namedtuple('ClientResult',
+                                        ['hostname', 'ip', 'status', 'code', 'answer', 'http_status',
+                                            'error', 'timings'])
+
+
+class DynDNSClient(object):
+    """A reusable update client for the applications embedding this module
+
+    Unlike DynDNSUpdate, this class is configured once by its constructor,
+    which raise ValueError on incorrect settings, does not touch the logging
+    configuration and return a ClientResult for each hostname instead of an
+    exit code.
+
+    An instance is thread-safe and can be shared by all the threads of an
+    application : its settings are never modified after the construction and
+    all the calls reuse the persistent connections of the same pool.
+    """
+
+    def __init__(self, server_url, username=None, password=None, api_url='/nic/update', timeout=5,
+                    tls=None, fields=None, ipv6_mode='myip', retry=None, connection_pool=None,
+                    rate_limiter=None):
+        """Constructor : Build a client
+
+        @param[str] server_url : the url of the dyndns server
+        @param[str] username : the account name
+        @param[str] password : the account password
+        @param[str] api_url : the path of the update endpoint
+        @param[int] timeout : the timeout in seconds of each query
+        @param[TLSOptions] tls : the TLS settings for https
+        @param[dict] fields : dyndns fields overriding the default ones
+        @param[str] ipv6_mode : how to send the addresses of both families,
+                                one of IPV6_MODES
+        @param[RetryPolicy] retry : the retries of the temporary failures,
+                                    none by default
+        @param[ConnectionPool] connection_pool : an optional pool of
+                                    connections to share
+        @param[RateLimiter] rate_limiter : an optional limit of the queries
+                                            of the account
+        """
+        parts = split_url(server_url)
+        if parts is None:
+            raise ValueError('incorrect server url "{}"'.format(server_url))
+        if ipv6_mode not in IPV6_MODES:
+            raise ValueError('incorrect ipv6 mode "{}"'.format(ipv6_mode))
+        self.__url_parts, self.__proto, self.__host, self.__port = parts
+        self.__server_url = server_url
+        self.__username = username
+        self.__password = password
+        self.__api_url = api_url
+        self.__timeout = timeout
+        self.__tls = tls or TLSOptions()
+        self.__fields = default_fields()
+        self.__fields.update(fields or dict())
+        self.__ipv6_mode = ipv6_mode
+        self.__retry = retry or RetryPolicy(attempts=1)
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        self.__pool = connection_pool
+        self.__rate_limiter = rate_limiter
+        self.__logger = logging.getLogger('dynupdate')
+
+    def update(self, hostnames, ip=None):
+        """Update hostnames to the same address
+
+        @param[str|list] hostnames : a hostname, a comma separated list or
+                                        a list of hostnames
+        @param[str] ip : the address to set, or both an IPv4 and an IPv6
+                            address separated by a comma, None to let the
+                            server use the client address
+        @return[list] : the ClientResult of each hostname
+        """
+        return self.update_many([(hostnames, ip)])
+
+    def update_many(self, updates):
+        """Update many hostnames with the fewest queries
+
+        The hostnames sharing the same address are sent together. If the
+        server refuses the account, the hostnames not yet sent are skipped.
+
+        @param[iterable] updates : the (hostnames, ip) pairs, as the
+                                    arguments of update()
+        @return[list] : the ClientResult of each hostname, grouped by
+                        address in order of first appearance
+        """
+        records = []
+        for hostnames, ip in updates:
+            if not isinstance(hostnames, (list, tuple)):
+                hostnames = hostnames.split(',')
+            hostnames = [hostname.strip() for hostname in hostnames if hostname.strip()]
+            for hostname in hostnames:
+                if not DynDNSUpdate.RE_HOST.match(hostname):
+                    raise ValueError('incorrect hostname "{}"'.format(hostname))
+            addresses = split_addresses(ip)
+            for address in addresses.values():
+                if not DynDNSUpdate.RE_IP.match(address):
+                    raise ValueError('incorrect ip address "{}"'.format(address))
+            if self.__ipv6_mode == 'separate' and addresses:
+                values = [addresses[family] for family in sorted(addresses)]
+            else:
+                values = [','.join(addresses[family] for family in sorted(addresses))]
+            records.extend(UpdateRecord(self.__server_url, self.__username, self.__password, value, hostname)
+                            for value in values for hostname in hostnames)
+        results = []
+        refused = False
+        for batch in plan_batches(records):
+            if refused:
+                results.extend(ClientResult(hostname, batch.myip or None, 'skipped', None, None, None,
+                                            'account refused by the server', dict())
+                                for hostname in batch.hostnames)
+                continue
+            batch_results = self.__update(batch)
+            refused = any(result.status == 'fatal' for result in batch_results)
+            results.extend(batch_results)
+        return results
+
+    def close(self):
+        """Close the pooled connections
+        """
+        self.__pool.close()
+
+    def __update(self, batch):
+        """Send an update batch and retry its temporary failures
+
+        @param[UpdateBatch] batch : the hostnames to update
+        @return[list] : the ClientResult in the order of the batch
+        """
+        delays = self.__retry.delays()
+        hostnames = list(batch.hostnames)
+        results = dict()
+        while True:
+            for result in self.__query(batch.myip, hostnames):
+                results[result.hostname] = result
+            if any(result.status == 'fatal' for result in results.values()):
+                break
+            hostnames = [hostname for hostname in hostnames if results[hostname].status == 'retry']
+            delay = next(delays, None) if hostnames else None
+            if delay is None:
+                break
+            self.__logger.debug('-> retrying %s in %.1f seconds', ','.join(hostnames), delay)
+            time.sleep(delay)
+        return [results[hostname] for hostname in batch.hostnames]
+
+    def __query(self, myip, hostnames):
+        """Send one update query
+
+        @param[str] myip : the address to set
+        @param[list] hostnames : the hostnames to update
+        @return[list] : the ClientResult of each hostname
+        """
+        timings = dict()
+        if self.__rate_limiter is not None:
+            delay = self.__rate_limiter.reserve(self.__host, self.__username)
+            if delay is None:
+                return self.__results(myip, classify_response(hostnames, None, error=RateLimiter.ERROR),
+                                        None, RateLimiter.ERROR, timings)
+            if delay > 0:
+                time.sleep(delay)
+                timings['rate_limit'] = delay
+
+        fields = query_fields(self.__fields, hostnames, myip, self.__ipv6_mode)
+        url, headers = build_query(self.__url_parts, self.__api_url, fields, self.__username, self.__password)
+        start = time.perf_counter()
+        try:
+            res, data = self.__pool.request(self.__proto, self.__host, self.__port, 'GET', url, headers,
+                                            timeout=self.__timeout, tls=self.__tls, timings=timings)
+        except (OSError, http.client.HTTPException) as e:
+            return self.__results(myip, classify_response(hostnames, None, error=e),
+                                    None, str(e) or e.__class__.__name__, timings)
+        finally:
+            timings['total'] = time.perf_counter() - start
+
+        error = None if res.status == 200 else 'HTTP status {}'.format(res.status)
+        return self.__results(myip, classify_response(hostnames, res.status, data.decode(errors='replace')),
+                                res.status, error, timings)
+
+    @staticmethod
+    def __results(myip, hosts, http_status, error, timings):
+        """Build the results of one query
+
+        @param[str] myip : the address sent
+        @param[list] hosts : the HostResult of each hostname
+        @param[int] http_status : the HTTP status, None if the query failed
+        @param[str] error : the reason of the failure
+        @param[dict] timings : the duration in seconds of each phase
+        @return[list] : the ClientResult of each hostname
+        """
+        return [ClientResult(host.hostname, myip or None, host.outcome, host.code or None, host.answer,
+                                http_status, error, timings)
+                for host in hosts]
+
+
+# the result of one update query, hosts holds the HostResult of each hostname
+UpdateResult = collections.namedtuple('UpdateResult', ['batch', 'status', 'answer', 'error', 'hosts'])
+
+
+class AsyncConnectionPool(object):
+    """A pool of persistent HTTP connections for the asyncio engine
+
+    This class keep the idle stream pairs per remote server. It implements a
+    minimal HTTP/1.1 client on top of asyncio streams.
+    """
+
+    def __init__(self):
+        """Constructor : Build an empty pool
+        """
+        self.__idle = dict()
+
+    async def request(self, key, connect, payload, timings=None):
+        """Send a raw HTTP query by using a pooled connection
+
+        @param[tuple] key : the identifier of the remote server
+        @param[coroutine function] connect : a coroutine function which open
+                                                a new (reader, writer) pair
+        @param[bytes] payload : the whole HTTP request
+        @param[dict] timings : an optional dict filled with the duration in
+                                seconds of each phase of the query
+        @return[tuple] : the HTTP status, reason and body
+        """
+        idle = self.__idle.setdefault(key, [])
+        reused = bool(idle)
+        streams = idle.pop() if reused else await self.__connect(key, connect, timings)
+        try:
+            status, reason, body, keep_alive = await self.__send(key, streams, payload, timings)
+        except AsyncConnectionPool.reconnect_exceptions():
+            streams[1].close()
+            if not reused:
+                raise
+            streams = await self.__connect(key, connect, timings)
+            try:
+                status, reason, body, keep_alive = await self.__send(key, streams, payload, timings)
+            except BaseException:
+                streams[1].close()
+                raise
+        except BaseException:
+            streams[1].close()
+            raise
+
+        if keep_alive:
+            idle.append(streams)
+        else:
+            streams[1].close()
+        return status, reason, body
+
+    @staticmethod
+    def reconnect_exceptions():
+        """Return the exceptions raised when the server closed an idle connection
+
+        @return[tuple] : the exception classes
+        """
+        return (ConnectionResetError,
+                BrokenPipeError,
+                asyncio.IncompleteReadError,
+                http.client.RemoteDisconnected)
+
+    @staticmethod
+    async def __connect(key, connect, timings):
+        """Open a new connection
+
+        The asyncio streams do not expose the name resolution and the TLS
+        handshake, so the whole duration is recorded as the connect phase.
+
+        @param[tuple] key : the identifier of the remote server
+        @param[coroutine function] connect : the connection opener
+        @param[dict] timings : an optional dict to fill with phase durations
+        @return[tuple] : the (reader, writer) pair
+        """
+        start = time.perf_counter()
+        with span('connect', proto=key[0], host=key[1], port=key[2]):
+            streams = await connect()
+        if timings is not None:
+            timings['connect'] = time.perf_counter() - start
+        return streams
+
+    async def __send(self, key, streams, payload, timings=None):
+        """Write the query and read the response, at most MAX_ANSWER_SIZE bytes
+
+        @param[tuple] key : the identifier of the remote server
+        @param[tuple] streams : the (reader, writer) pair to use
+        @param[bytes] payload : the whole HTTP request
+        @param[dict] timings : an optional dict to fill with phase durations
+        @return[tuple] : the HTTP status, reason, body and keep-alive flag
+        """
+        reader, writer = streams
+        start = time.perf_counter()
+        writer.write(payload)
+        await writer.drain()
+        sent = time.perf_counter()
+
+        with span('getresponse', proto=key[0], host=key[1], port=key[2]):
+            status_line = await reader.readline()
+        first_byte = time.perf_counter()
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        version, status, reason = (status_line.decode('iso-8859-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        try:
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('iso-8859-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # discard the trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+                if sum(len(chunk) for chunk in chunks) > MAX_ANSWER_SIZE:
+                    keep_alive = False
+                    break
+            body = b''.join(chunks)[:MAX_ANSWER_SIZE]
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if length > MAX_ANSWER_SIZE:
+                keep_alive = False
+            body = await reader.readexactly(min(length, MAX_ANSWER_SIZE))
+        else:
+            body = await reader.read(MAX_ANSWER_SIZE)
+            keep_alive = False
+        if timings is not None:
+            timings['send'] = sent - start
+            timings['first_byte'] = first_byte - sent
+            timings['read'] = time.perf_counter() - first_byte
+        return status, reason, body, keep_alive
+
+    def close(self):
+        """Close all pooled connections
+        """
+        for idle in self.__idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.__idle.clear()
+
+
+class AsyncUpdater(object):
+    """An asyncio engine to run many updates concurrently
+
+    This class send update batches in parallel within a global limit and a
+    limit per server. The queries are exactly the same as the ones sent by
+    DynDNSUpdate.
+    """
+
+    def __init__(self, api_url='/nic/update', timeout=5, tls=None,
+                    concurrency=100, server_concurrency=4, fields=None, tls_contexts=None,
+                    metrics=None, ipv6_mode='myip', rate_limiter=None, resolutions=None):
+        """Constructor : Build an update engine
+
+        @param[str] api_url : the path of the update endpoint
+        @param[int] timeout : the timeout in seconds of each query
+        @param[TLSOptions] tls : the TLS settings for https
+        @param[int] concurrency : the maximum number of simultaneous queries
+        @param[int] server_concurrency : the maximum number of simultaneous
+                                            queries to the same server
+        @param[dict] fields : dyndns fields overriding the default ones
+        @param[TLSContextCache] tls_contexts : an optional cache of SSL
+                                                contexts to share
+        @param[Metrics] metrics : an optional metrics collector
+        @param[str] ipv6_mode : how to send the addresses of both families,
+                                one of IPV6_MODES
+        @param[RateLimiter] rate_limiter : an optional limit of the queries
+                                            of each account
+        @param[ResolutionCache] resolutions : an optional cache of host
+                                                name resolutions to share
+        """
+        self.__metrics = metrics
+        self.__rate_limiter = rate_limiter
+        self.__ipv6_mode = ipv6_mode
+        self.__api_url = api_url
+        self.__timeout = timeout
+        self.__tls = tls or TLSOptions()
+        self.__tls_contexts = tls_contexts or TLSContextCache()
+        self.__resolutions = resolutions or ResolutionCache()
+        self.__concurrency = concurrency
+        self.__server_concurrency = server_concurrency
+        self.__fields = default_fields()
+        self.__fields.update(fields or dict())
+        self.__pool = AsyncConnectionPool()
+        self.__semaphore = None
+        self.__server_semaphores = dict()
+        self.__logger = logging.getLogger('dynupdate')
+
+    async def update(self, batch):
+        """Send one update batch
+
+        @param[UpdateBatch] batch : the hostnames to update
+        @return[UpdateResult] : the result of the query
+        """
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__concurrency)
+        parts = split_url(batch.server_url)
+        if parts is None:
+            return UpdateResult(batch, None, None, 'incorrect server url',
+                                [HostResult(hostname, None, None, 'error', None) for hostname in batch.hostnames])
+        url_parts, proto, host, port = parts
+
+        timings = None if self.__metrics is None else dict()
+        if self.__rate_limiter is not None:
+            # the state file is locked and rewritten, keep it off the event loop
+            delay = await asyncio.get_event_loop().run_in_executor(None, self.__rate_limiter.reserve,
+                                                                    host, batch.username)
+            if delay is None:
+                return self.__result(batch, None, None, RateLimiter.ERROR)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if timings is not None:
+                    timings['rate_limit'] = delay
+
+        fields = query_fields(self.__fields, batch.hostnames, batch.myip, self.__ipv6_mode)
+        url, headers = build_query(url_parts, self.__api_url, fields, batch.username, batch.password)
+        payload = build_payload(proto, host, port, url, headers)
+
+        context = self.__tls_contexts.get(self.__tls) if proto == 'https' else None
+
+        async def connect():
+            return await open_connection(host, port, ssl=context, resolutions=self.__resolutions)
+
+        key = (proto, host, port)
+        server_semaphore = self.__server_semaphores.get(key)
+        if server_semaphore is None:
+            server_semaphore = asyncio.Semaphore(self.__server_concurrency)
+            self.__server_semaphores[key] = server_semaphore
+        start = time.perf_counter()
+        try:
+            async with self.__semaphore, server_semaphore:
+                start = time.perf_counter()
+                status, _, body = await asyncio.wait_for(self.__pool.request(key, connect, payload, timings),
+                                                            self.__timeout)
+        except asyncio.TimeoutError:
+            self.__logger.debug('=> timeout while updating %s', fields['hostname'])
+            return self.__observe(batch, timings, start, self.__result(batch, None, None, 'timeout'))
+        except (OSError, http.client.HTTPException, asyncio.IncompleteReadError, ValueError) as e:
+            self.__logger.debug('=> error while updating %s : %s', fields['hostname'], str(e))
+            return self.__observe(batch, timings, start, self.__result(batch, None, None, e))
+        return self.__observe(batch, timings, start, self.__result(batch, status, body.decode(errors='replace')))
+
+    @staticmethod
+    def __result(batch, status, answer, error=None):
+        """Build the result of one query
+
+        @param[UpdateBatch] batch : the sent batch
+        @param[int] status : the HTTP status, None if the query failed
+        @param[str] answer : the answer body
+        @param[Exception|str] error : the reason of the failure
+        @return[UpdateResult] : the classified result
+        """
+        hosts = classify_response(batch.hostnames, status, answer, error)
+        if isinstance(error, Exception):
+            error = str(error) or error.__class__.__name__
+        elif error is None and status != 200:
+            error = 'HTTP status {}'.format(status)
+        return UpdateResult(batch, status, answer, error, hosts)
+
+    def __observe(self, batch, timings, start, result):
+        """Record the metrics of a query
+
+        @param[UpdateBatch] batch : the sent batch
+        @param[dict] timings : the phase durations or None if disabled
+        @param[float] start : the perf_counter value at the query start
+        @param[UpdateResult] result : the result of the query
+        @return[UpdateResult] : the result, unchanged
+        """
+        if timings is not None:
+            timings['total'] = time.perf_counter() - start
+            if result.status == 200:
+                codes = [host.code or 'ok' for host in result.hosts]
+            elif result.status is not None:
+                codes = ['http_{}'.format(result.status)]
+            else:
+                codes = ['network_error']
+            self.__metrics.observe(batch.server_url, timings, codes)
+        return result
+
+    async def update_all(self, batches):
+        """Send all update batches concurrently
+
+        @param[iterable] batches : the UpdateBatch to send
+        @return[list] : the UpdateResult in the same order as batches
+        """
+        return await asyncio.gather(*[self.update(batch) for batch in batches])
+
+    def run(self, batches):
+        """Send all update batches from a synchronous context
+
+        @param[iterable] batches : the UpdateBatch to send
+        @return[list] : the UpdateResult in the same order as batches
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.update_all(batches))
+        finally:
+            self.close()
+            loop.close()
+
+    def close(self):
+        """Close all pooled connections
+        """
+        self.__pool.close()
+        self.__semaphore = None
+        self.__server_semaphores.clear()
+
+
+class RelayServer(object):
+    """Serve the DynDNS update protocol to local clients and forward upstream
+
+    The updates received from the local clients are answered at once and
+    deduplicated by hostname, the latest address wins. They are forwarded
+    periodically to the upstream server in batches through the pooled
+    connections of an AsyncUpdater, so the provider only sees one client.
+
+    The "good" answer only means that the relay accepted the update : the
+    temporary upstream failures are retried by the relay, and a hostname
+    refused by the upstream server gets the refusal code on its next query.
+    """
+
+    # the longest accepted request head, and request body
+    MAX_REQUEST_SIZE = 8192
+
+    REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large'}
+
+    def __init__(self, server_url, username=None, password=None, path='/nic/update',
+                    clients=None, interval=10, updater=None, anonymous=False):
+        """Constructor : Build a relay
+
+        @param[str] server_url : the upstream server url
+        @param[str] username : the upstream account username
+        @param[str] password : the upstream account password
+        @param[str] path : the path of the update endpoint served to clients
+        @param[dict] clients : username => password of the allowed local
+                                clients
+        @param[float] interval : the number of seconds between two forwards
+        @param[AsyncUpdater] updater : the engine which send upstream queries
+        @param[bool] anonymous : accept any local client when no clients
+                                    are given
+        """
+        if not clients and not anonymous:
+            raise ValueError('the relay requires at least one client or the anonymous access')
+        self.__server_url = server_url
+        self.__username = username
+        self.__password = password
+        self.__path = path
+        self.__clients = dict(clients or dict())
+        self.__interval = interval
+        self.__updater = updater or AsyncUpdater(api_url=path)
+        # hostname => ip address waiting to be forwarded
+        self.__pending = collections.OrderedDict()
+        # hostname => ip address accepted by the upstream server
+        self.__forwarded = dict()
+        # hostname => return code of the upstream server refusal
+        self.__refused = dict()
+        self.__server = None
+        self.__handlers = set()
+        self.port = None
+        self.__logger = logging.getLogger('dynupdate')
+
+    @property
+    def pending(self):
+        """The hostname => ip address updates waiting to be forwarded
+        """
+        return dict(self.__pending)
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Listen for local clients
+
+        @param[str] host : the address to listen on
+        @param[int] port : the port to listen on, 0 for a random one
+        @return[RelayServer] : this relay
+        """
+        self.__server = await asyncio.start_server(self.__handle, host, port, limit=self.MAX_REQUEST_SIZE)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        return self
+
+    async def run(self, stop_event):
+        """Forward the pending updates periodically until stop_event is set
+
+        @param[threading.Event] stop_event : the event which stop the relay
+        @return[integer] : the exit code of the relay
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.__interval
+        while not stop_event.is_set():
+            # wake up regularly to honor the stop event
+            await asyncio.sleep(min(1, max(0, deadline - loop.time())))
+            if loop.time() < deadline:
+                continue
+            deadline = loop.time() + self.__interval
+            code = await self.flush()
+            # a refused account will never succeed, stop here
+            if code in [11, 12]:
+                return code
+        return await self.flush()
+
+    async def close(self):
+        """Stop listening and close the client connections
+        """
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+        for handler in list(self.__handlers):
+            handler.cancel()
+        await asyncio.gather(*self.__handlers, return_exceptions=True)
+
+    async def flush(self):
+        """Forward the pending updates to the upstream server
+
+        @return[integer] : the exit code of the forward
+        """
+        if not self.__pending:
+            return 0
+        pending, self.__pending = self.__pending, collections.OrderedDict()
+        records = [UpdateRecord(self.__server_url, self.__username, self.__password, ip, hostname)
+                    for hostname, ip in pending.items()]
+        self.__logger.debug('-> forwarding %d hostnames', len(records))
+        code = 0
+        retry = []
+        for result in await self.__updater.update_all(plan_batches(records)):
+            batch = result.batch
+            if result.error is not None:
+                self.__logger.warning('Unable to forward %s : %s', ','.join(batch.hostnames), result.error)
+            for host in result.hosts:
+                if host.outcome == 'success':
+                    self.__logger.info('Successfully forwarded %s (%s)', host.hostname, host.answer or 'OK')
+                    self.__forwarded[host.hostname] = batch.myip
+                elif host.outcome == 'retry':
+                    retry.append(host.hostname)
+                    code = max(code, 13 if result.error == RateLimiter.ERROR else 10)
+                elif host.outcome == 'fatal':
+                    self.__logger.error('The upstream server refused the update with "%s"', host.code)
+                    return 11 if host.code == 'badauth' else 12
+                else:
+                    self.__logger.error('The upstream server refused the update of %s with "%s"',
+                                        host.hostname, host.code or result.error)
+                    # only the protocol codes can be reported to the clients
+                    if host.code is not None:
+                        self.__refused[host.hostname] = host.code
+                    code = max(code, 1)
+        # newer updates received during the forward take precedence
+        for hostname in retry:
+            if hostname not in self.__pending:
+                self.__pending[hostname] = pending[hostname]
+        return code
+
+    def answer(self, method, target, headers, peer=None):
+        """Handle one update query of a local client
+
+        @param[str] method : the HTTP method
+        @param[str] target : the request target, path and query string
+        @param[dict] headers : the request headers with lower case names
+        @param[str] peer : the client ip address, used when myip is missing
+        @return[tuple] : the HTTP status and the answer body
+        """
+        if method != 'GET':
+            return 405, ''
+        url = urllib.parse.urlsplit(target)
+        if url.path != self.__path:
+            return 404, ''
+        if self.__clients and not self.__authenticate(headers.get('authorization', '')):
+            return 401, 'badauth'
+        query = urllib.parse.parse_qs(url.query)
+        hostnames = [hostname.strip() for hostname in ','.join(query.get('hostname', [])).split(',')
+                        if hostname.strip()]
+        if not hostnames:
+            return 200, 'notfqdn'
+        if len(hostnames) > MAX_HOSTNAMES:
+            return 200, 'numhost'
+        # like the DynDNS servers, a malformed address is replaced by the client one
+        myip = query.get('myip', [''])[0]
+        if not DynDNSUpdate.RE_IP.match(myip):
+            myip = peer or ''
+            if not DynDNSUpdate.RE_IP.match(myip):
+                return 200, 'dnserr'
+
+        lines = []
+        for hostname in hostnames:
+            if not DynDNSUpdate.RE_HOST.match(hostname):
+                lines.append('notfqdn')
+            elif hostname in self.__refused:
+                # report the previous upstream refusal once, the next query is forwarded again
+                lines.append(self.__refused.pop(hostname))
+            elif self.__pending.get(hostname, self.__forwarded.get(hostname)) == myip:
+                lines.append('nochg ' + myip)
+            else:
+                self.__pending.pop(hostname, None)
+                self.__pending[hostname] = myip
+                lines.append('good ' + myip)
+        return 200, '\n'.join(lines)
+
+    def __authenticate(self, authorization):
+        """Check the Basic credentials of a local client
+
+        @param[str] authorization : the Authorization header value
+        @return[bool] : True if the client is allowed
+        """
+        scheme, _, credentials = authorization.partition(' ')
+        if scheme.lower() != 'basic':
+            return False
+        try:
+            username, _, password = b64decode(credentials.strip()).decode().partition(':')
+        except ValueError:
+            return False
+        expected = self.__clients.get(username)
+        return expected is not None and hmac.compare_digest(expected.encode(), password.encode())
+
+    async def __handle(self, reader, writer):
+        """Serve the queries of one client connection
+
+        @param[asyncio.StreamReader] reader : the input stream
+        @param[asyncio.StreamWriter] writer : the output stream
+        """
+        # python < 3.7 compatibility
+        handler = asyncio.current_task() if hasattr(asyncio, 'current_task') else asyncio.Task.current_task()
+        self.__handlers.add(handler)
+        peer = (writer.get_extra_info('peername') or [None])[0]
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(self.__response(431, '', False))
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split(' ')
+                headers = dict()
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if len(request) != 3:
+                    writer.write(self.__response(400, '', False))
+                    break
+                method, target, version = request
+                if headers.get('content-length', '0') != '0':
+                    # the body is useless, do not read it for an unknown client
+                    if self.__clients and not self.__authenticate(headers.get('authorization', '')):
+                        writer.write(self.__response(401, 'badauth', False))
+                        break
+                    try:
+                        length = int(headers['content-length'])
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        writer.write(self.__response(400, '', False))
+                        break
+                    if length > self.MAX_REQUEST_SIZE:
+                        writer.write(self.__response(413, '', False))
+                        break
+                    await reader.readexactly(length)
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                status, body = self.answer(method, target, headers, peer)
+                self.__logger.debug('-> %s %s from %s : %d %s', method, target, peer, status, body)
+                writer.write(self.__response(status, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self.__handlers.discard(handler)
+            writer.close()
+
+    def __response(self, status, body, keep_alive):
+        """Build a raw HTTP response
+
+        @param[int] status : the HTTP status
+        @param[str] body : the answer body
+        @param[bool] keep_alive : False to close the connection after it
+        @return[bytes] : the whole response
+        """
+        body = body.encode()
+        headers = ['HTTP/1.1 {} {}'.format(status, self.REASONS[status]),
+                    'Content-Type: text/plain',
+                    'Content-Length: {}'.format(len(body))]
+        if status == 401:
+            headers.append('WWW-Authenticate: Basic realm="dyndnsupdate"')
+        if not keep_alive:
+            headers.append('Connection: close')
+        return ('\r\n'.join(headers) + '\r\n\r\n').encode() + body
+
+
+class InterfaceWatcher(object):
+    """Watch the addresses of a network interface with Linux rtnetlink
+
+    This class read the current addresses of an interface without any HTTP
+    query, and wait for address change events sent by the kernel so updates
+    are only triggered when the address really changed.
+    """
+
+    # rtnetlink constants from linux/rtnetlink.h and linux/if_addr.h
+    NETLINK_ROUTE = 0
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV6_IFADDR = 0x100
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    RTM_GETADDR = 22
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    RT_SCOPE_UNIVERSE = 0
+
+    def __init__(self, interface, debounce=2, family=None, sock=None):
+        """Constructor : Subscribe to the address events
+
+        @param[str] interface : the name of the interface to watch
+        @param[int] debounce : the number of quiet seconds to wait after an
+                                event before reading the new address
+        @param[int|list] family : the address family or a list of families,
+                                    default to AF_INET
+        @param[socket] sock : an already subscribed socket
+        """
+        self.__interface = interface
+        self.__index = socket.if_nametoindex(interface)
+        self.__debounce = debounce
+        if family is None:
+            family = socket.AF_INET
+        self.__families = family if isinstance(family, list) else [family]
+        self.__logger = logging.getLogger('dynupdate')
+        if sock is None:
+            groups = InterfaceWatcher.RTMGRP_IPV4_IFADDR | InterfaceWatcher.RTMGRP_IPV6_IFADDR
+            sock = InterfaceWatcher.__netlink_socket()
+            sock.bind((0, groups))
+        self.__sock = sock
+        self.__address = self.address()
+
+    @staticmethod
+    def __netlink_socket():
+        """Open a rtnetlink socket
+
+        @return[socket] : the unbound socket
+        """
+        if not hasattr(socket, 'AF_NETLINK'):
+            raise OSError('rtnetlink is only available on Linux')
+        return socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, InterfaceWatcher.NETLINK_ROUTE)
+
+    @staticmethod
+    def parse_messages(data):
+        """Decode the address messages of a netlink datagram
+
+        @param[bytes] data : the netlink datagram
+        @return[list] : tuples (type, family, scope, index, address)
+        """
+        messages = []
+        offset = 0
+        while offset + 16 <= len(data):
+            length, msg_type = struct.unpack_from('=LH', data, offset)
+            if length < 16 or offset + length > len(data):
+                break
+            if msg_type in (InterfaceWatcher.RTM_NEWADDR, InterfaceWatcher.RTM_DELADDR):
+                family, _, _, scope, index = struct.unpack_from('=BBBBI', data, offset + 16)
+                attributes = dict()
+                attr_offset = offset + 24
+                while attr_offset + 4 <= offset + length:
+                    attr_length, attr_type = struct.unpack_from('=HH', data, attr_offset)
+                    if attr_length < 4:
+                        break
+                    attributes[attr_type] = data[attr_offset + 4:attr_offset + attr_length]
+                    attr_offset += (attr_length + 3) & ~3
+                # IFA_LOCAL is the local address on point to point interfaces
+                raw = attributes.get(InterfaceWatcher.IFA_LOCAL, attributes.get(InterfaceWatcher.IFA_ADDRESS))
+                address = socket.inet_ntop(family, raw) if raw else None
+                messages.append((msg_type, family, scope, index, address))
+            offset += (length + 3) & ~3
+        return messages
+
+    def address(self):
+        """Read the current global address of the watched interface
+
+        @return[str] : the first global address of each family, comma
+                        separated, or None
+        """
+        addresses = [InterfaceWatcher.current_address(self.__interface, family) for family in self.__families]
+        return ','.join(address for address in addresses if address is not None) or None
+
+    @staticmethod
+    def current_address(interface, family=None, timeout=5):
+        """Read the current global address of an interface
+
+        @param[str] interface : the name of the interface
+        @param[int] family : the address family, default to AF_INET
+        @param[float] timeout : the maximum number of seconds to wait for
+                                    each part of the kernel answer
+        @return[str] : the first global address or None
+        """
+        index = socket.if_nametoindex(interface)
+        if family is None:
+            family = socket.AF_INET
+        sock = InterfaceWatcher.__netlink_socket()
+        try:
+            sock.settimeout(timeout)
+            sock.bind((0, 0))
+            request = struct.pack('=LHHLL', 24, InterfaceWatcher.RTM_GETADDR,
+                                    InterfaceWatcher.NLM_F_REQUEST | InterfaceWatcher.NLM_F_DUMP, 1, 0)
+            request += struct.pack('=BBBBI', family, 0, 0, 0, 0)
+            sock.sendto(request, (0, 0))
+            addresses = []
+            done = False
+            while not done:
+                data = sock.recv(65536)
+                offset = 0
+                while offset + 16 <= len(data):
+                    length, msg_type = struct.unpack_from('=LH', data, offset)
+                    if msg_type in (InterfaceWatcher.NLMSG_DONE, InterfaceWatcher.NLMSG_ERROR) or length < 16:
+                        done = True
+                        break
+                    offset += (length + 3) & ~3
+                addresses.extend(InterfaceWatcher.parse_messages(data))
+        finally:
+            sock.close()
+        for _, msg_family, scope, msg_index, address in addresses:
+            if msg_index == index and msg_family == family and scope == InterfaceWatcher.RT_SCOPE_UNIVERSE:
+                return address
+        return None
+
+    def wait_change(self, timeout=None):
+        """Wait for an address change of the interface
+
+        Events are accumulated until no new one arrive during the debounce
+        window, then the address is read again and compared to the previous
+        one, so a quick loss and recovery of the same address is ignored.
+
+        @param[float] timeout : the maximum number of seconds to wait for a
+                                first event
+        @return[bool] : True if the address changed
+        """
+        if not self.__receive(timeout):
+            return False
+        while self.__receive(self.__debounce):
+            pass
+        address = self.address()
+        if address == self.__address:
+            self.__logger.debug('-> address of %s is unchanged after events', self.__interface)
+            return False
+        self.__logger.info('Address of interface %s changed from %s to %s',
+                            self.__interface, self.__address, address)
+        self.__address = address
+        return True
+
+    def __receive(self, timeout):
+        """Read events until one concern the watched interface
 
-class DynDNSUpdate(object):
-    """An instance of a dyn client
+        @param[float] timeout : the maximum number of seconds to wait
+        @return[bool] : True if an event concern the watched interface
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.__sock], [], [], remaining)
+            if not readable:
+                return False
+            for _, family, _, index, _ in self.parse_messages(self.__sock.recv(65536)):
+                if index == self.__index and family in self.__families:
+                    return True
 
-    This class represent a instance of a dyn dns client until it make
-    his http query to update a remote dns server entry
+    def close(self):
+        """Unsubscribe from the address events
+        """
+        self.__sock.close()
+
+
+class IPDiscovery(object):
+    """Find the public ip address of this host
+
+    This class query several echo services at the same time and keep the
+    first valid answer, or the first address returned by enough services in
+    quorum mode. Slower queries are cancelled. The result is cached for a
+    while so periodic runs do not query the services every time.
     """
 
-    # define the http protocol string
-    REG_E_PROTO = 'https?'
+    # services answering with the ip address of the client in plain text
+    DEFAULT_URLS = ['https://api.ipify.org/',
+                    'https://ipv4.icanhazip.com/',
+                    'https://ifconfig.me/ip',
+                    'https://checkip.amazonaws.com/']
 
-    # match a exact ipv4 address
-    REG_E_IPV4 = '(?:(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9][0-9]|[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9][0-9]|[0-9])'
+    # services reachable only over IPv6
+    DEFAULT_URLS6 = ['https://api6.ipify.org/',
+                        'https://ipv6.icanhazip.com/',
+                        'https://v6.ident.me/']
 
-    # according to RFC 1123 define an hostname
-    REG_E_HOST = '(?:(?:[a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*(?:[A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])'
+    def __init__(self, urls=None, quorum=1, ttl=300, timeout=5, tls_contexts=None, family=4):
+        """Constructor : Build a discovery
 
-    # match the exact value of a port number
-    REG_E_PORT = '(?:[0-9]{1,4}|[1-5][0-9]{4}|6[0-4][0-9]{3}|65[0-4][0-9]{2}|655[0-2][0-9]|6553[0-5])'
+        @param[list] urls : the urls of the echo services
+        @param[int] quorum : the number of services which must agree
+        @param[int] ttl : the number of seconds to cache the result
+        @param[int] timeout : the overall timeout in seconds
+        @param[TLSContextCache] tls_contexts : an optional cache of SSL
+                                                contexts to share
+        @param[int] family : the version of the address to find, 4 or 6
+        """
+        self.__family = family
+        self.__urls = list(urls or (IPDiscovery.DEFAULT_URLS if family == 4 else IPDiscovery.DEFAULT_URLS6))
+        self.__quorum = quorum
+        self.__ttl = ttl
+        self.__timeout = timeout
+        self.__tls_contexts = tls_contexts or TLSContextCache()
+        self.__cached = None
+        self.__expires = 0
+        self.__logger = logging.getLogger('dynupdate')
 
-    # match a resource's path
-    REG_E_PATH = '/(?:(?:[a-zA-Z0-9-_~.%]+/?)*)?'
+    def discover(self):
+        """Return the public ip address from a synchronous context
 
-    # match some http parameters
-    REG_E_QUERY = '\?(?:&?[a-zA-Z0-9-_~.%]+=?[a-zA-Z0-9-_~.%]*)+'
+        @return[str] : the ip address or None if not found
+        """
+        if self.__cached is not None and time.monotonic() < self.__expires:
+            self.__logger.debug('-> using cached public ip address %s', self.__cached)
+            return self.__cached
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.discover_async())
+        finally:
+            loop.close()
 
-    # an URL is defined by :
-    # PROTO+AUTH+IP|HOST+PORT+PATH+QUERY
-    REG_E_URL = ('^(?P<url>(?:(?P<proto>' + REG_E_PROTO + ')://)?' +  # HTTP
-               '(?P<host>' + REG_E_IPV4 + '|' + REG_E_HOST + ')' +  # HOST or IP
-               '(?P<port>:' + REG_E_PORT + ')?' +  # PORT
-               '(?P<path>' + REG_E_PATH + ')?' +  # PATH
-               ')$')
+    def invalidate(self):
+        """Forget the cached ip address
+        """
+        self.__cached = None
 
-    # an ip address is version 4
-    REG_E_IP = '^(?P<ipv4>' + REG_E_IPV4 + ')$'  # IP matching
+    async def discover_async(self):
+        """Return the public ip address
+
+        @return[str] : the ip address or None if not found
+        """
+        if self.__cached is not None and time.monotonic() < self.__expires:
+            return self.__cached
+        tasks = [asyncio.ensure_future(self.__fetch(url)) for url in self.__urls]
+        votes = collections.Counter()
+        address = None
+        # the timeout is for the whole discovery, not for each answer
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.__timeout
+        try:
+            pending = tasks
+            while pending and address is None:
+                done, pending = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()),
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.__logger.debug('=> timeout while discovering the public ip address')
+                    break
+                for task in done:
+                    ip = task.result()
+                    if ip is None:
+                        continue
+                    votes[ip] += 1
+                    if votes[ip] >= self.__quorum:
+                        address = ip
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    # re match object
-    RE_URL = re.compile(REG_E_URL)
-    RE_IP = re.compile(REG_E_IP)
+        if address is None:
+            self.__logger.error('Unable to discover the public ip address, got %s', dict(votes))
+            return None
+        self.__logger.debug('-> discovered public ip address %s', address)
+        self.__cached = address
+        self.__expires = time.monotonic() + self.__ttl
+        return address
 
-    def __init__(self):
-        """Constructor : Build an launcher for dynupdate
+    async def __fetch(self, url):
+        """Query one echo service
+
+        @param[str] url : the url of the service
+        @return[str] : the valid ip address answered or None
         """
-        # Network required
-        self.__server_url = None
-        self.__server_api_url = '/nic/update'
-        self.__server_username = None
-        self.__server_password = None
-        self.__tls_insecure = False
-        # The HTTP timeout
-        self.__timeout = 5
+        parts = split_url(url)
+        if parts is None:
+            self.__logger.warning('Ignoring incorrect discovery url "%s"', url)
+            return None
+        url_parts, proto, host, port = parts
+        context = self.__tls_contexts.get(TLSOptions()) if proto == 'https' else None
+        payload = build_payload(proto, host, port, url_parts['path'] or '/',
+                                {'User-Agent': 'dyndns-update/' + __version__,
+                                 'Connection': 'close'})
+        pool = AsyncConnectionPool()
+        async def connect():
+            return await open_connection(host, port, ssl=context)
+        try:
+            status, _, body = await pool.request((proto, host, port), connect, payload)
+        except (OSError, http.client.HTTPException, asyncio.IncompleteReadError, ValueError) as e:
+            self.__logger.debug('=> discovery from %s failed : %s', url, str(e))
+            return None
+        finally:
+            pool.close()
+        answer = body.decode(errors='replace').strip()
+        match = DynDNSUpdate.RE_IP.match(answer)
+        if status != 200 or not match or not match.group('ipv{}'.format(self.__family)):
+            self.__logger.debug('=> discovery from %s gave an invalid answer %d "%s"', url, status, answer[:64])
+            return None
+        return match.group(0)
 
-        # init logger
+
+class DNSResolver(object):
+    """A minimal DNS client to read the A records of hostnames
+
+    This class send one UDP query per hostname to the configured resolvers,
+    all hostnames at the same time, and cache the answers for their TTL. It
+    is used to skip the updates of hostnames which already point to the
+    right address.
+
+    The queries are sent to recursive resolvers, not to the authoritative
+    servers of the zone, so an answer may be as old as the TTL of the record.
+    The callers must not trust it for a hostname they changed recently : the
+    addresses of the hostnames updated by this program can be forgotten, and
+    fresh answers requested when the state cache knows another address.
+    A truncated answer is considered as unknown.
+    """
+
+    TYPE_A = 1
+    CLASS_IN = 1
+    RCODE_NXDOMAIN = 3
+    FLAG_RESPONSE = 0x8000
+    FLAG_TRUNCATED = 0x0200
+
+    # the number of seconds to cache a missing record
+    NEGATIVE_TTL = 60
+
+    def __init__(self, servers=None, timeout=2):
+        """Constructor : Build a resolver
+
+        @param[list] servers : the resolvers as "address" or "address:port",
+                                default to the ones of /etc/resolv.conf
+        @param[float] timeout : the number of seconds to wait for each resolver
+        """
+        self.__servers = []
+        for server in servers or DNSResolver.system_servers():
+            host, _, port = server.rpartition(':') if server.count(':') == 1 else (server, None, None)
+            self.__servers.append((host, int(port or 53)))
+        self.__timeout = timeout
+        # hostname => (expiration time, addresses)
+        self.__cache = dict()
         self.__logger = logging.getLogger('dynupdate')
-        self.__logger.setLevel(logging.DEBUG)
-
-        # remove all previously defined handlers
-        for handler in self.__logger.handlers:
-            self.__logger.removeHandler(handler)
-        # default format for all handlers
-        out_formatter = logging.Formatter("%(levelname)s [%(name)s] : %(message)s")
-        # register stdout handler
-        self.__logger_stdout = logging.StreamHandler(sys.stdout)
-        self.__logger_stdout.setFormatter(out_formatter)
-        self.__logger_stdout.setLevel(logging.INFO)
-        self.__logger.addHandler(self.__logger_stdout)
-        # register stderr handler
-        self.__logger_stderr = logging.StreamHandler(sys.stderr)
-        self.__logger_stderr.setFormatter(out_formatter)
-        self.__logger_stderr.setLevel(logging.CRITICAL+1)
-        self.__logger.addHandler(self.__logger_stderr)
 
-        # DYNDNS protocol
-        # for detail see https://help.dyn.com/remote-access-api/perform-update/
-        self.__fields = dict()
+    @staticmethod
+    def system_servers(path='/etc/resolv.conf'):
+        """Read the resolvers configured on this host
+
+        @param[str] path : the path of the resolver configuration file
+        @return[list] : the addresses of the resolvers
+        """
+        servers = []
+        try:
+            with open(path, 'r') as conf:
+                for line in conf:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[0] == 'nameserver':
+                        servers.append(fields[1])
+        except OSError:
+            pass
+        return servers or ['127.0.0.1']
 
-        # Identify update type
-        # "dyndns", "statdns"
-        self.__fields['system'] = 'dyndns'
+    @staticmethod
+    def build_query(query_id, hostname):
+        """Build a recursive query for the A records of a hostname
 
-        # A comma separated list of host to update (max 20)
-        self.__fields['hostname'] = ''
+        @param[int] query_id : the 16 bits identifier of the query
+        @param[str] hostname : the hostname to resolve
+        @return[bytes] : the query message
+        """
+        qname = b''.join(struct.pack('!B', len(label)) + label
+                            for label in hostname.rstrip('.').encode('idna').split(b'.'))
+        return (struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + b'\0' +
+                struct.pack('!HH', DNSResolver.TYPE_A, DNSResolver.CLASS_IN))
 
-        # The IP address to set.
-        # If not set or incorrect the server will choose himself an IP
-        self.__fields['myip'] = ''
+    @staticmethod
+    def parse_response(query_id, data):
+        """Extract the A records of a response
 
-        # Parameter enables or disables wildcards for this host.
-        # Values : "ON","NOCHG","OFF"
-        self.__fields['wildcard'] = 'NOCHG'
+        @param[int] query_id : the identifier of the sent query
+        @param[bytes] data : the response message
+        @return[tuple] : the list of addresses and the smallest TTL, None
+                            if the resolver failed
+        """
+        def skip_name(offset):
+            while True:
+                length = data[offset]
+                if length == 0:
+                    return offset + 1
+                if length & 0xC0 == 0xC0:
+                    # compression pointer
+                    return offset + 2
+                offset += length + 1
 
-        # Specify an eMail eXchanger
-        self.__fields['mx'] = ''
+        try:
+            response_id, flags, qdcount, ancount = struct.unpack_from('!HHHH', data)
+            if response_id != query_id or not flags & DNSResolver.FLAG_RESPONSE:
+                raise ValueError('unexpected message')
+            if flags & DNSResolver.FLAG_TRUNCATED:
+                # the records which did not fit are missing
+                return None, 0
+            rcode = flags & 0xF
+            if rcode == DNSResolver.RCODE_NXDOMAIN:
+                return [], DNSResolver.NEGATIVE_TTL
+            if rcode != 0:
+                return None, 0
+            offset = 12
+            for _ in range(qdcount):
+                offset = skip_name(offset) + 4
+            addresses = []
+            ttls = []
+            for _ in range(ancount):
+                offset = skip_name(offset)
+                rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+                offset += 10
+                if rtype == DNSResolver.TYPE_A and rclass == DNSResolver.CLASS_IN and length == 4:
+                    addresses.append(socket.inet_ntoa(data[offset:offset + 4]))
+                    ttls.append(ttl)
+                offset += length
+        except (struct.error, IndexError) as e:
+            raise ValueError('malformed DNS response') from e
+        return addresses, min(ttls) if ttls else DNSResolver.NEGATIVE_TTL
 
-        # Requests the MX in the previous parameter to be set up as a backup MX
-        # by listing the host itself as an MX with a lower preference value.
-        # Values : "ON","NOCHG","OFF"
-        self.__fields['backmx'] = 'NOCHG'
+    def resolve(self, hostnames, fresh=None):
+        """Return the A records of several hostnames from a synchronous context
 
-        # Set the hostname to offline mode
-        # "YES" turn on offline redirect for host
-        # "NOCHG" no make change
-        self.__fields['offline'] = 'NOCHG'
+        @param[list] hostnames : the hostnames to resolve
+        @param[list] fresh : the hostnames to query again even if cached
+        @return[dict] : hostname => list of addresses, None if unknown
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.resolve_async(hostnames, fresh))
+        finally:
+            loop.close()
 
-        # No already use
-        self.__fields['url'] = ''
+    async def resolve_async(self, hostnames, fresh=None):
+        """Return the A records of several hostnames
 
+        @param[list] hostnames : the hostnames to resolve
+        @param[list] fresh : the hostnames to query again even if cached
+        @return[dict] : hostname => list of addresses, None if unknown
+        """
+        fresh = set(fresh or [])
+        addresses = await asyncio.gather(*[self.__resolve(hostname, hostname in fresh) for hostname in hostnames])
+        return dict(zip(hostnames, addresses))
 
-    def configure(self, **options):
-        """Parse input main program options (restrict to program strict execution)
+    def forget(self, hostnames):
+        """Remove hostnames from the cache, after an update of their records
 
-        @param[dict] options : array of option key => value
+        @param[list] hostnames : the hostnames to forget
         """
-        if 'verbose' in options:
-            if options['verbose'] < 0:
-                self.__logger_stdout.setLevel(logging.CRITICAL + 1)
-            else:
-                self.__logger_stdout.setLevel(logging.INFO - options['verbose']*10)
-        self.__logger.debug('configured with args %s', options)
-        if 'errors_to_stderr' in options and options['errors_to_stderr']:
-            self.__logger_stderr.setLevel(logging.ERROR)
-        # disable SSL certificate verification
-        if 'tls_insecure' in options and options['tls_insecure']:
-            self.__tls_insecure = True
-        # http timeout
-        if 'timeout' in options and options['timeout']:
-            self.__timeout = options['timeout']
-        # http settings
-        if 'server_url' in options and options['server_url']:
-            match = DynDNSUpdate.RE_URL.match(options['server_url'])
-            if match:
-                self.__server_url = match.groupdict()
-            else:
-                self.__logger.error('given server url "%s" is incorrect', options['server_url'])
-                return False
-        if 'server_api_url' in options and options['server_api_url']:
-            self.__server_api_url = options['server_api_url']
-        if 'server_username' in options and options['server_username']:
-            self.__server_username = options['server_username']
-        if 'server_password' in options and options['server_password']:
-            self.__server_password = options['server_password']
+        for hostname in hostnames:
+            self.__cache.pop(hostname, None)
 
-        # dyn dns parsing
-        if 'dyndns_myip' in options and options['dyndns_myip']:
-            match = DynDNSUpdate.RE_IP.match(options['dyndns_myip'])
-            if match:
-                self.__fields['myip'] = match.group('ipv4')
-            else:
-                self.__logger.error('given ip address "%s" is incorrect', options['dyndns_myip'])
-                return False
-        if 'dyndns_hostname' in options and options['dyndns_hostname']:
-            hostnames = options['dyndns_hostname']
-            if isinstance(hostnames, list):
-                hostnames = ','.join(hostnames)
-            self.__fields['hostname'] = hostnames
+    async def __resolve(self, hostname, fresh=False):
+        """Return the A records of a hostname, from the cache if possible
 
-        if 'dyndns_wildcard' in options and options['dyndns_wildcard']:
-            if options['dyndns_wildcard'] in ['ON', 'OFF', 'NOCHG']:
-                self.__logger.warning('Deprecated: Flag wildcard can be currently ignored')
-                self.__fields['wildcard'] = options['dyndns_wildcard']
-            else:
-                self.__logger.error('Incorrect value for dyndns_wildcard option')
-                return False
-        return True
+        @param[str] hostname : the hostname to resolve
+        @param[bool] fresh : True to ignore the cached addresses
+        @return[list] : the addresses, None if no resolver answered
+        """
+        cached = self.__cache.get(hostname)
+        if not fresh and cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+        for server in self.__servers:
+            try:
+                result = await asyncio.wait_for(self.__query(server, hostname), self.__timeout)
+            except asyncio.TimeoutError:
+                self.__logger.debug('=> timeout while resolving %s with %s', hostname, server[0])
+                continue
+            except (OSError, ValueError) as e:
+                self.__logger.debug('=> error while resolving %s with %s : %s', hostname, server[0], str(e))
+                continue
+            addresses, ttl = result
+            if addresses is None:
+                self.__logger.debug('=> resolver %s failed to resolve %s', server[0], hostname)
+                continue
+            self.__cache[hostname] = (time.monotonic() + ttl, addresses)
+            return addresses
+        return None
 
-              #
-              # if opt[0] == '--backmx':
-              #   self.__fields['backmx'] = 'YES'
-              # if opt[0] == '--no-backmx':
-              #   self.__fields['backmx'] = 'NO'
-              # if opt[0] == '--offline':
-              #   self.__fields['offline'] = 'YES'
-              # if opt[0] == '--static':
-              #   self.__fields['system'] = 'statdns'
-              # if opt[0] == '--url':
-              #   self.__fields['url'] = opt[1]
+    async def __query(self, server, hostname):
+        """Send one query and wait for its response
 
-    def main(self):
-        """Entry point of the program
+        @param[tuple] server : the (address, port) of the resolver
+        @param[str] hostname : the hostname to resolve
+        @return[tuple] : the result of parse_response
         """
-        if not self.__server_url:
-            self.__logger.error('Missing required setting "server_url" in configure()')
-            return 3
-        for required_field in ['myip', 'hostname']:
-            if not self.__fields[required_field]:
-                self.__logger.error('Missing required setting "%s" in configure()', required_field)
-                return 3
+        loop = asyncio.get_event_loop()
+        # unpredictable to make the spoofing of answers harder
+        query_id = struct.unpack('!H', os.urandom(2))[0]
+        response = loop.create_future()
 
-        self.__logger.debug('debug: config fields ' + str(self.__fields))
-        return int(not self.__query())
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if not response.done():
+                    try:
+                        response.set_result(DNSResolver.parse_response(query_id, data))
+                    except ValueError:
+                        # not our response, keep waiting
+                        pass
 
-    def __query(self):
-        """Forge and send the HTTP GET query
+            def error_received(self, exc):
+                if not response.done():
+                    response.set_exception(exc)
+
+        transport, _ = await loop.create_datagram_endpoint(Protocol, remote_addr=server)
+        try:
+            transport.sendto(DNSResolver.build_query(query_id, hostname))
+            return await response
+        finally:
+            transport.close()
+
+
+class ProfileGroup(object):
+    """Run the updates of several profiles declared in a configuration file
+
+    Each section of the INI file is a profile. Its keys are the long command
+    line options without the leading dashes, for example :
+
+        [home]
+        dyn-server = https://www.api.com
+        dyn-hostname = home.example.com, www.example.com
+        username = login
+        password = secret
+
+    All profiles share the same connection pool and metrics collector, whose
+    files are written once per run of the group. A profile which fails its
+    validation or its update does not prevent the others to run.
+
+    To publish the same records through redundant providers, the profiles
+    can be run concurrently with a fan-out policy : 'all' waits for all of
+    them, 'first' stops the others as soon as one succeeds. The deadline
+    bounds the whole fan-out, independently of the timeout of each query.
+    A stopped profile does not start new queries, but a query already sent
+    can still complete and be recorded in the state and journal files.
+    """
+
+    FANOUT_POLICIES = ['all', 'first']
+
+    # these options apply to the whole program and can not be set by profile
+    GLOBAL_OPTIONS = ['config_file', 'daemon', 'daemon_interval', 'watch_interface', 'watch_debounce',
+                        'verbose', 'errors_to_stderr', 'show_version', 'bulk_file', 'bulk_format',
+                        'bulk_results_file', 'bulk_resume', 'bulk_concurrency', 'relay_listen', 'relay_clients',
+                        'relay_interval', 'relay_anonymous', 'profile_file', 'fanout_policy', 'fanout_deadline',
+                        'metrics_prometheus_file', 'metrics_json_file']
+
+    # the list options, given comma separated, which replace the default list
+    LIST_OPTIONS = {'dyn-hostname': 'dyndns_hostname', 'discovery-url': 'discovery_urls',
+                    'discovery-url6': 'discovery_urls6', 'dns-resolver': 'dns_resolvers',
+                    'relay-client': 'relay_clients'}
 
-        @return[integer] : True if query success
-                          False otherwise
+    # the options without value, enabled by a boolean
+    FLAG_OPTIONS = ['discover-ip', 'backmx', 'no-backmx', 'wildcard', 'no-wildcard', 'dns-check',
+                    'daemon', 'no-output', 'verbose', 'errors-to-stderr', 'version', 'resume',
+                    'relay-anonymous']
+
+    # the options taking a value on the command line which are booleans in a profile
+    BOOLEAN_OPTIONS = {'insecure': 'tls_insecure'}
+
+    def __init__(self, connection_pool=None, fanout=None, deadline=None):
+        """Constructor : Build an empty group
+
+        @param[ConnectionPool] connection_pool : an optional pool of
+                                    connections to share between profiles
+        @param[str] fanout : run the profiles concurrently with this policy,
+                                one of FANOUT_POLICIES, None to run them
+                                one after the other
+        @param[float] deadline : the maximum number of seconds of a fan-out
         """
-        url_parts = self.__server_url
-        host = url_parts['host']
-        port = None
-        if url_parts['port']:
-            port = url_parts['port']
+        if fanout is not None and fanout not in ProfileGroup.FANOUT_POLICIES:
+            raise ValueError('unknown fan-out policy "{}"'.format(fanout))
+        if deadline is not None and fanout is None:
+            raise ValueError('the deadline requires a fan-out policy')
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        self.__pool = connection_pool
+        self.__metrics = None
+        self.__fanout = fanout
+        self.__deadline = deadline
+        self.__threads = dict()
+        self.__programs = collections.OrderedDict()
+        self.__invalid = []
+        self.__stop_event = threading.Event()
+        self.__logger = logging.getLogger('dynupdate')
+        self.__log_handlers = setup_logging()
 
-        # PROTOCOL
-        if not url_parts['proto'] or url_parts['proto'] == 'http':
-            self.__logger.debug('-> protocol HTTP')
-            if port is None:
-                port = http.client.HTTP_PORT
-            conn = http.client.HTTPConnection(host, port, timeout=self.__timeout)
-        elif url_parts['proto'] == 'https':
-            self.__logger.debug('-> protocol HTTPs')
-            if port is None:
-                port = http.client.HTTPS_PORT
-            if self.__tls_insecure:
-                context = ssl._create_unverified_context()
-                self.__logger.debug('-> SSL certificate verification is DISABLED')
-            else:
-                context = None
-            conn = http.client.HTTPSConnection(host, port,
-                                                timeout=self.__timeout,
-                                                context=context)
-        else:
-            self.__logger.error('Found unmanaged url protocol : "%s" ignoring url', url_parts['proto'])
+    @property
+    def profiles(self):
+        """The names of the valid profiles
+        """
+        return list(self.__programs)
+
+    def load(self, path, **defaults):
+        """Read and validate the profiles of a configuration file
+
+        @param[str] path : the path of the INI file
+        @param[dict] defaults : options applied to all profiles
+        @return[bool] : True if at least one profile is valid
+        """
+        config = configparser.ConfigParser(interpolation=None)
+        try:
+            with open(path, 'r') as config_file:
+                config.read_file(config_file)
+        except (OSError, configparser.Error) as e:
+            self.__logger.error('Unable to read configuration file "%s" : %s', path, str(e))
             return False
-        # /PROTOCOL
+        apply_log_options(self.__log_handlers, defaults)
+        if defaults.get('metrics_prometheus_file') or defaults.get('metrics_json_file'):
+            self.__metrics = Metrics(prometheus_file=defaults.get('metrics_prometheus_file'),
+                                        json_file=defaults.get('metrics_json_file'))
 
-        # HEADER
-        # build the header dict
-        headers = {'User-Agent': 'dyndns-update/' + __version__}
-        # authentification
-        if self.__server_username and self.__server_password:
-            # build the auth string
-            auth_str = self.__server_username + ':' + self.__server_password
-            # encode it as a base64 string to put in http header
-            auth = b64encode(auth_str.encode()).decode("ascii")
-            # fill the header
-            headers['Authorization'] = 'Basic ' + auth
-            self.__logger.debug('-> authentication enabled')
+        # the values of the options which are not given
+        unset = vars(parse_args([], exit_on_error=False))
+        for name in config.sections():
+            try:
+                options = self.__parse_section(config[name], defaults, unset)
+            except ValueError as e:
+                self.__logger.error('Invalid profile "%s" : %s', name, str(e))
+                self.__invalid.append(name)
+                continue
+            program = DynDNSUpdate(connection_pool=self.__pool, metrics=self.__metrics,
+                                    log_handlers=self.__log_handlers)
+            if not program.configure(**options):
+                self.__logger.error('Invalid profile "%s"', name)
+                self.__invalid.append(name)
+                continue
+            self.__programs[name] = program
+        if not self.__programs:
+            self.__logger.error('No valid profile found in "%s"', path)
+        return bool(self.__programs)
+
+    @staticmethod
+    def __parse_section(section, defaults, unset):
+        """Convert a profile section into configure() options
+
+        The values are parsed as command line arguments so they get the same
+        types and checks.
+
+        @param[configparser.SectionProxy] section : the profile section
+        @param[dict] defaults : options applied to all profiles
+        @param[dict] unset : the options parsed from an empty command line
+        @return[dict] : the options, without the global ones
+        """
+        argv = []
+        booleans = dict()
+        for key, value in section.items():
+            if key in ProfileGroup.FLAG_OPTIONS:
+                if section.getboolean(key):
+                    argv.append('--' + key)
+            elif key in ProfileGroup.BOOLEAN_OPTIONS:
+                booleans[ProfileGroup.BOOLEAN_OPTIONS[key]] = section.getboolean(key)
+            elif key in ProfileGroup.LIST_OPTIONS:
+                for item in re.split(r'[\s,]+', value.strip()):
+                    if item:
+                        argv.append('--{}={}'.format(key, item))
+            else:
+                # a value starting with a dash is not taken for an option
+                argv.append('--{}={}'.format(key, value))
+        # the profile lists replace the default ones
+        replaced = [ProfileGroup.LIST_OPTIONS[key] for key in section if key in ProfileGroup.LIST_OPTIONS]
+        namespace = argparse.Namespace(**dict((key, value) for key, value in defaults.items()
+                                                if key not in replaced))
+        options = vars(parse_args(argv, namespace=namespace, exit_on_error=False))
+        options.update(booleans)
+        for key in ProfileGroup.GLOBAL_OPTIONS:
+            if key in options and options[key] != defaults.get(key, unset.get(key)):
+                raise ValueError('option "{}" applies to the whole run'.format(key))
+        return dict((key, value) for key, value in options.items() if key not in ProfileGroup.GLOBAL_OPTIONS)
+
+    def main(self):
+        """Run the update of all profiles
+
+        @return[integer] : the highest exit code of all profiles
+        """
+        if self.__fanout is not None:
+            code = self.__fan_out()
         else:
-            self.__logger.debug('-> authentication disabled')
-        # /HEADER
+            code = self.__run_all()
+        if self.__metrics is not None:
+            self.__metrics.flush()
+        return code
 
-        # URL
-        dyndns_params = urllib.parse.urlencode(sorted(self.__fields.items()))
-        url = '{base_url}{api_path}?{params}'.format(base_url=url_parts['url'].rstrip('/'),
-                                                    api_path=self.__server_api_url,
-                                                    params=dyndns_params)
-        self.__logger.debug('set final url to "%s"', url)
-        # /URL
+    def __run_all(self):
+        """Run the update of all profiles one after the other
+
+        @return[integer] : the highest exit code of all profiles
+        """
+        codes = [2 if self.__invalid else 0]
+        for name, program in self.__programs.items():
+            self.__logger.debug('running profile "%s"', name)
+            try:
+                profile_code = program.main()
+            except Exception as e:
+                self.__logger.error('Profile "%s" failed : %s', name, str(e))
+                profile_code = 1
+            if profile_code not in [0, 14]:
+                self.__logger.error('Profile "%s" failed with code %d', name, profile_code)
+            codes.append(profile_code)
+        return ProfileGroup.__combine(codes)
+
+    @staticmethod
+    def __combine(codes):
+        """Merge the exit codes of several profiles
+
+        A wait for the rate limit is only reported when nothing failed.
+
+        @param[list] codes : the exit codes
+        @return[integer] : the highest failure code, else 14 if a profile
+                            waited for the rate limit, else 0
+        """
+        failures = [code for code in codes if code != 14]
+        return max(failures) if any(failures) else max(codes)
+
+    def __fan_out(self):
+        """Run the update of all profiles concurrently
+
+        The profiles which did not finish are stopped, and their thread is
+        abandoned : a query in progress is not interrupted, it ends within
+        its timeout and may still update the hostnames. The connections are
+        not closed under it since all the profiles share the same pool.
+
+        @return[integer] : 0 if the policy is satisfied, or 14 if it had to
+                            wait for the rate limit, else the highest exit
+                            code, 10 for the profiles over the deadline
+        """
+        results = queue.Queue()
+
+        def run(name, program):
+            try:
+                code = program.main()
+            except Exception as e:
+                self.__logger.error('Profile "%s" failed : %s', name, str(e))
+                code = 1
+            results.put((name, code))
+
+        deadline = None if self.__deadline is None else time.monotonic() + self.__deadline
+        started = []
+        for name, program in self.__programs.items():
+            if name in self.__threads and self.__threads[name].is_alive():
+                self.__logger.warning('Profile "%s" is still running since the previous fan-out, skipping it', name)
+                continue
+            program.resume()
+            self.__threads[name] = threading.Thread(target=run, args=(name, program),
+                                                    name='profile-' + name, daemon=True)
+            self.__threads[name].start()
+            started.append(name)
+
+        codes = collections.OrderedDict()
+        winner = None
+        while len(codes) < len(started):
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            try:
+                name, code = results.get(timeout=timeout)
+            except queue.Empty:
+                break
+            codes[name] = code
+            if code not in [0, 14]:
+                self.__logger.error('Profile "%s" failed with code %d', name, code)
+            elif self.__fanout == 'first':
+                winner = name
+                break
 
+        for name in started:
+            if name in codes:
+                continue
+            self.__programs[name].stop()
+            if winner is not None:
+                self.__logger.debug('Profile "%s" succeeded first, abandoning profile "%s" whose query may '
+                                    'still complete', winner, name)
+            else:
+                self.__logger.error('Profile "%s" did not finish before the deadline', name)
+                codes[name] = 10
+        code = 2 if self.__invalid else 0
+        if winner is None:
+            return ProfileGroup.__combine([code] + list(codes.values()))
+        return ProfileGroup.__combine([code, codes[winner]])
+
+    def daemon(self, interval):
+        """Run the update of all profiles periodically until stop() is called
+
+        @param[int] interval : the number of seconds between two updates
+        @return[integer] : the exit code of the program
+        """
+        self.__logger.info('Starting daemon mode for %d profiles with an interval of %d seconds',
+                            len(self.__programs), interval)
+        self.__stop_event.clear()
         try:
-            conn.request('GET', url, headers=headers)
-            res = conn.getresponse()
-            data = res.read().decode()
-        except socket.gaierror as e:
-            self.__logger.debug('=> unable to resolve hostname %s', str(e))
-            return False
-        except ssl.SSLError as e:
-            self.__logger.debug('=> unable to validate the host\'s certifcate.' +
-                            ' You can override this by using --insecure')
-            return False
-        except socket.error as e:
-            self.__logger.debug('=> unable to connect to host %s', str(e))
-            return False
-        except http.client.HTTPException:
-            self.__logger.debug('=> error with HTTP query')
-            return False
-        except Exception as e:
-            self.__logger.error('Unhandled python exception please inform the developper %s', str(e))
-            return False
+            while True:
+                self.main()
+                if self.__stop_event.wait(interval):
+                    break
         finally:
-            conn.close()
+            self.close()
+        self.__logger.info('Daemon mode stopped')
+        return 0
 
-        self.__logger.debug('get HTTP status code : %d %s', res.status, res.reason)
-        self.__logger.debug('get HTTP data : "%s"', data)
+    def stop(self):
+        """Ask the daemon loop to exit
+        """
+        self.__stop_event.set()
+        for program in self.__programs.values():
+            program.stop()
 
-        # authentication missing error
-        if res.status == 401:
-            self.__logger.debug('=> the server may require an authentification')
-            self.__logger.error('The server at url "%s" may require an authentification', url_parts['url'])
-            return False
-        elif res.status in [200]:
-            self.__logger.info('Successfully updated')
-            return True
-        return False
+    def close(self):
+        """Release all network resources
+        """
+        self.__pool.close()
 
-##
-# Run launcher as the main program
-if __name__ == '__main__':
+
+class RunProfiler(object):
+    """Record the CPU and memory profile of a whole run
+
+    The cProfile statistics are written to path, readable with
+    "python -m pstats path". The tracemalloc snapshot of the memory still
+    allocated at the end is written to path + '.tracemalloc', and the peak
+    and biggest allocations to path + '.memory.json'.
+    """
+
+    # the environment variable which enable the profiling from cron
+    ENVIRONMENT = 'DYNDNSUPDATE_PROFILE'
+
+    def __init__(self, path, frames=10):
+        """Constructor : Build a profiler
+
+        @param[str] path : the path of the cProfile dump
+        @param[int] frames : the number of frames kept by tracemalloc
+        """
+        self.path = path
+        self.__frames = frames
+        self.__profile = None
+
+    def start(self):
+        """Start the profiling
+        """
+        tracemalloc.start(self.__frames)
+        self.__profile = cProfile.Profile()
+        self.__profile.enable()
+
+    def stop(self):
+        """Stop the profiling and write its files, can be called many times
+        """
+        if self.__profile is None:
+            return
+        self.__profile.disable()
+        self.__profile.dump_stats(self.path)
+        self.__profile = None
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(self.path + '.tracemalloc')
+        with open(self.path + '.memory.json', 'w') as memory_file:
+            json.dump(dict(current_bytes=current, peak_bytes=peak,
+                            top=[str(stat) for stat in snapshot.statistics('lineno')[:10]]),
+                        memory_file, indent=2)
+
+
+def parse_args(argv=None, namespace=None, exit_on_error=True):
+    """Parse the command line arguments
+
+    @param[list] argv : the arguments, default to sys.argv
+    @param[argparse.Namespace] namespace : the options already known
+    @param[bool] exit_on_error : exit the program on incorrect arguments,
+                                    else raise ValueError
+    @return[argparse.Namespace] : the parsed options
+    """
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                         argument_default=argparse.SUPPRESS,
                                         description='DynDNS version v' + __version__ + """ --
 Use DYNDNS protocol to update a dynhost with a new ip address""")
     # required arguments
     parser.add_argument('--dyn-address', action='store', dest='dyndns_myip',
-                            help='set the IP address to use for update')
+                            help='set the IP address to use for update, or both an IPv4 and an IPv6 address separated by a comma')
+    parser.add_argument('--dyn-address6', action='store', dest='dyndns_myipv6',
+                            help='set the IPv6 address to use for update')
+    parser.add_argument('--ip-family', action='store', dest='ip_family', choices=['4', '6', 'dual'], default='4',
+                            help='the address families to find with --dyn-interface or --discover-ip')
+    parser.add_argument('--ipv6-mode', action='store', dest='ipv6_mode', choices=IPV6_MODES, default='myip',
+                            help='how the server accept both families : comma separated in myip, ' +
+                                    'the IPv6 address in myipv6 or one query per family')
+    parser.add_argument('--dyn-interface', action='store', dest='dyndns_interface',
+                            help='use the global IP address of this local interface when --dyn-address is not given')
+    parser.add_argument('--discover-ip', action='store_true', dest='discover_ip',
+                            help='find the public IP address with echo services when --dyn-address is not given')
+    parser.add_argument('--discovery-url', action='append', dest='discovery_urls',
+                            help='url of an echo service answering the client IP address, implies --discover-ip')
+    parser.add_argument('--discovery-url6', action='append', dest='discovery_urls6',
+                            help='url of an echo service answering the client IPv6 address, implies --discover-ip')
+    parser.add_argument('--discovery-quorum', action='store', dest='discovery_quorum', type=int, default=1,
+                            help='the number of echo services which must give the same IP address')
+    parser.add_argument('--discovery-ttl', action='store', dest='discovery_ttl', type=int, default=300,
+                            help='the number of seconds during which a discovered IP address is reused')
     parser.add_argument('--dyn-hostname', action='append', dest='dyndns_hostname',
                             help='set the hostname of the dyn host to update. This is the DNS domain name that point to the ip address')
     parser.add_argument('--dyn-server', action='store', dest='server_url',
@@ -374,11 +4508,69 @@ Use DYNDNS protocol to update a dynhost with a new ip address""")
     #     --static       set static dns system (Default system : """ + self.__fields['system'] + """)
 
 
-    parser.add_argument('-t', '--timeout', action='store', dest='timeout', default=5,
+    parser.add_argument('-t', '--timeout', action='store', dest='timeout', type=float, default=5,
                             help='The HTTP timeout in seconds for all requests')
+    parser.add_argument('--resolve-ttl', action='store', dest='resolve_ttl', type=int, default=60,
+                            help='The number of seconds during which the addresses of the servers are reused')
     parser.add_argument('--insecure', action='store', dest='tls_insecure', default=False,
                             help='Disable TLS certificate verification for secure connexions')
 
+    parser.add_argument('--ca-file', action='store', dest='tls_cafile',
+                            help='A file of concatenated CA certificates to use instead of the system ones')
+    parser.add_argument('--ca-path', action='store', dest='tls_capath',
+                            help='A directory of CA certificates to use instead of the system ones')
+    parser.add_argument('--client-cert', action='store', dest='tls_certfile',
+                            help='A client certificate file for TLS authentication')
+    parser.add_argument('--client-key', action='store', dest='tls_keyfile',
+                            help='The private key of the client certificate if not included in it')
+    parser.add_argument('--retry', action='store', dest='retry_attempts', type=int, default=3,
+                            help='The maximum number of attempts of an update on network or temporary server errors')
+    parser.add_argument('--retry-delay', action='store', dest='retry_base_delay', type=float, default=2,
+                            help='The maximum delay in seconds before the first retry, doubled at each attempt')
+    parser.add_argument('--retry-max-delay', action='store', dest='retry_max_delay', type=float, default=60,
+                            help='The upper bound in seconds of the delay between two attempts')
+    parser.add_argument('--state-file', action='store', dest='state_file',
+                            help='Path of a file in which to remember the last successful updates to skip unnecessary ones')
+    parser.add_argument('--state-max-age', action='store', dest='state_max_age', type=int, default=86400,
+                            help='The number of seconds after which an unchanged address is updated again')
+    parser.add_argument('--dns-check', action='store_true', dest='dns_check',
+                            help='Skip the hostnames whose A record already points to the address. The record is read ' +
+                                    'from recursive resolvers, so it may be as old as its TTL')
+    parser.add_argument('--dns-resolver', action='append', dest='dns_resolvers',
+                            help='address[:port] of a DNS server to query, implies --dns-check. The default are the system ones')
+    parser.add_argument('--dns-timeout', action='store', dest='dns_timeout', type=float, default=2,
+                            help='The number of seconds to wait for each DNS server')
+    parser.add_argument('--journal-file', action='store', dest='journal_file',
+                            help='Path of a file in which to keep the updates which failed because of network or server outages')
+    parser.add_argument('--journal-fsync', action='store', dest='journal_fsync', choices=UpdateJournal.FSYNC_POLICIES,
+                            default='always', help='When to flush the journal to the disk : at each write, once per run or never')
+    parser.add_argument('--journal-replay-limit', action='store', dest='journal_replay_limit', type=int, default=5,
+                            help='The maximum number of journaled batches sent by each run')
+    parser.add_argument('--journal-replay-delay', action='store', dest='journal_replay_delay', type=float, default=1,
+                            help='The number of seconds between two journaled batches')
+    parser.add_argument('--rate-limit', action='store', dest='rate_limit', type=float,
+                            help='The maximum number of queries per minute of each account, shared with the other ' +
+                                    'runs using the same --rate-file')
+    parser.add_argument('--rate-burst', action='store', dest='rate_burst', type=int, default=5,
+                            help='The number of queries of an account which can be sent at once within the rate limit')
+    parser.add_argument('--rate-file', action='store', dest='rate_file',
+                            help='Path of a file in which to share the rate limit between processes')
+    parser.add_argument('--rate-max-wait', action='store', dest='rate_max_wait', type=float, default=30,
+                            help='The maximum number of seconds to wait for the rate limit, 0 to postpone the update at once')
+    parser.add_argument('--metrics-file', action='store', dest='metrics_prometheus_file',
+                            help='Write latency histograms and outcome counters to this Prometheus textfile collector file')
+    parser.add_argument('--metrics-json', action='store', dest='metrics_json_file',
+                            help='Append the phase durations and return codes of each query to this JSON lines file')
+    parser.add_argument('-d', '--daemon', action='store_true', dest='daemon', default=False,
+                            help='Stay in foreground and periodically run the update')
+    parser.add_argument('--interval', action='store', dest='daemon_interval', type=int, default=300,
+                            help='The number of seconds between two updates in daemon mode')
+
+    parser.add_argument('--watch', action='store', dest='watch_interface',
+                            help='Stay in foreground and run the update each time the address of this interface change (Linux only)')
+    parser.add_argument('--watch-debounce', action='store', dest='watch_debounce', type=float, default=2,
+                            help='The number of quiet seconds to wait after an address change before the update')
+
     logging_group = parser.add_mutually_exclusive_group()
     logging_group.add_argument('--no-output', action='store_const', dest='verbose', const=-1,
                             help='Disable all output message to stdout. (cron mode)')
@@ -386,17 +4578,127 @@ Use DYNDNS protocol to update a dynhost with a new ip address""")
                             help='Show more running messages')
     parser.add_argument('--errors-to-stderr', action='store_true', dest='errors_to_stderr',
                             help='Copy errors to stderr')
+    parser.add_argument('--profile', action='store', dest='profile_file',
+                            help='Write the cProfile statistics of the run to this file, and its memory peak and ' +
+                                    'tracemalloc snapshot next to it. Also enabled by the ' +
+                                    RunProfiler.ENVIRONMENT + ' environment variable')
     parser.add_argument('-V', '--version', action='store_true', dest='show_version', default=False,
                             help='Print the version and exit')
-    args = parser.parse_args()
+    parser.add_argument('-c', '--config', action='store', dest='config_file',
+                            help='Update all profiles declared in this INI file, the other options are their defaults')
+    parser.add_argument('--fanout', action='store', dest='fanout_policy', choices=ProfileGroup.FANOUT_POLICIES,
+                            help='Update the profiles of the configuration file concurrently, and succeed when all ' +
+                                    'of them or the first of them succeeded')
+    parser.add_argument('--deadline', action='store', dest='fanout_deadline', type=float,
+                            help='The maximum number of seconds of a concurrent update of the profiles, ' +
+                                    'independently of --timeout')
+    parser.add_argument('--from-file', action='store', dest='bulk_file',
+                            help='Update the records of this CSV or JSON lines file, or of stdin with "-". Their columns are ' +
+                                    ', '.join(BULK_FIELDS) + ', the other options are their defaults')
+    parser.add_argument('--from-format', action='store', dest='bulk_format', choices=['csv', 'jsonl'],
+                            help='The format of the records file, guessed from its first line by default')
+    parser.add_argument('--results-file', action='store', dest='bulk_results_file',
+                            help='Append the JSON result of each record to this file instead of stdout')
+    parser.add_argument('--resume', action='store_true', dest='bulk_resume', default=False,
+                            help='Skip the records before the last line written in the results file')
+    parser.add_argument('--concurrency', action='store', dest='bulk_concurrency', type=int, default=8,
+                            help='The maximum number of simultaneous queries of a records file update')
+    parser.add_argument('--relay', action='store', dest='relay_listen',
+                            help='Stay in foreground, accept updates from local clients on this [address:]port and ' +
+                                    'forward them in batches to --dyn-server. The default address is 127.0.0.1')
+    parser.add_argument('--relay-client', action='append', dest='relay_clients',
+                            help='USERNAME:PASSWORD of a client allowed to use the relay')
+    parser.add_argument('--relay-anonymous', action='store_true', dest='relay_anonymous',
+                            help='Allow any client to use the relay without --relay-client')
+    parser.add_argument('--relay-interval', action='store', dest='relay_interval', type=float, default=10,
+                            help='The number of seconds between two forwards of the relayed updates')
+
+    if not exit_on_error:
+        def error(message):
+            raise ValueError(message)
+        parser.error = error
+    return parser.parse_args(argv, namespace=namespace)
+
+
+##
+# Run launcher as the main program
+if __name__ == '__main__':
+    # start as soon as possible to profile the arguments parsing
+    profiler = RunProfiler(os.environ[RunProfiler.ENVIRONMENT]) if os.environ.get(RunProfiler.ENVIRONMENT) else None
+    if profiler is not None:
+        profiler.start()
+    args = parse_args()
+    if getattr(args, 'profile_file', None):
+        if profiler is None:
+            profiler = RunProfiler(args.profile_file)
+            profiler.start()
+        profiler.path = args.profile_file
+    if profiler is not None:
+        # all the modes end with sys.exit()
+        atexit.register(profiler.stop)
 
     if args.show_version:
         print("DynDNS client version v" + __version__)
         sys.exit(0)
 
-    program = DynDNSUpdate()
-    if not program.configure(**vars(args)):
+    if getattr(args, 'fanout_deadline', None) is not None and not getattr(args, 'fanout_policy', None):
+        print('The deadline only applies to the concurrent update of --fanout', file=sys.stderr)
         sys.exit(2)
+    if getattr(args, 'config_file', None):
+        program = ProfileGroup(fanout=getattr(args, 'fanout_policy', None),
+                                deadline=getattr(args, 'fanout_deadline', None))
+        if not program.load(args.config_file, **vars(args)):
+            sys.exit(2)
+        if getattr(args, 'watch_interface', None):
+            print('The watch mode is not available with a configuration file', file=sys.stderr)
+            sys.exit(2)
+    else:
+        if getattr(args, 'fanout_policy', None):
+            print('The concurrent update requires a configuration file with one profile per provider', file=sys.stderr)
+            sys.exit(2)
+        options = vars(args)
+        if getattr(args, 'bulk_file', None) and not getattr(args, 'bulk_results_file', None):
+            # stdout is reserved to the results
+            options = dict(options, verbose=-1, errors_to_stderr=True)
+        program = DynDNSUpdate()
+        if not program.configure(**options):
+            sys.exit(2)
+    if getattr(args, 'bulk_file', None):
+        if getattr(args, 'config_file', None) or args.daemon or getattr(args, 'watch_interface', None) \
+                or getattr(args, 'relay_listen', None):
+            print('The records file update can not be combined with other modes', file=sys.stderr)
+            sys.exit(2)
+        if args.bulk_resume and not getattr(args, 'bulk_results_file', None):
+            print('The resume of a records file update requires a results file', file=sys.stderr)
+            sys.exit(2)
+        signal.signal(signal.SIGTERM, lambda signum, frame: program.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: program.stop())
+        skip = last_result_line(args.bulk_results_file) if args.bulk_resume else 0
+        try:
+            source = sys.stdin if args.bulk_file == '-' else open(args.bulk_file, 'r', newline='')
+            output = open_results(args.bulk_results_file) if getattr(args, 'bulk_results_file', None) else sys.stdout
+        except OSError as e:
+            print('Unable to open file : {}'.format(str(e)), file=sys.stderr)
+            sys.exit(2)
+        with source, output:
+            sys.exit(program.bulk(source, output, fmt=getattr(args, 'bulk_format', None), skip=skip,
+                                    concurrency=args.bulk_concurrency))
+    if getattr(args, 'relay_listen', None):
+        if getattr(args, 'config_file', None) or args.daemon or getattr(args, 'watch_interface', None):
+            print('The relay mode can not be combined with other modes', file=sys.stderr)
+            sys.exit(2)
+        clients = dict(client.partition(':')[::2] for client in getattr(args, 'relay_clients', None) or [])
+        signal.signal(signal.SIGTERM, lambda signum, frame: program.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: program.stop())
+        sys.exit(program.relay(args.relay_listen, clients, args.relay_interval,
+                                getattr(args, 'relay_anonymous', False)))
+    if args.daemon or getattr(args, 'watch_interface', None):
+        signal.signal(signal.SIGTERM, lambda signum, frame: program.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: program.stop())
+    if getattr(args, 'watch_interface', None):
+        sys.exit(program.watch(args.watch_interface, args.watch_debounce))
+    if args.daemon:
+        sys.exit(program.daemon(args.daemon_interval))
     sys.exit(program.main())
 
 # Return code :
@@ -406,3 +4708,6 @@ Use DYNDNS protocol to update a dynhost with a new ip address""")
 #     3 Missing required argument
 #     10 Error during HTTP query
 #     11 Authentification needed
+#     12 Update refused by the server (abuse, badagent, !donator)
+#     13 Update postponed by the rate limit
+#     14 Update sent after waiting for the rate limit
@@ -10,15 +10,26 @@ def __createRaiser(exception):
     return will_raise
 
 
-def __mockConnection(connection_mock, response_data='', response_status=200, response_reason='OK', raise_=None):
+def __mockResponse(response_data, response_status, response_reason, keep_alive):
     # http response mock
     response_mock = Mock(spec=http.client.HTTPResponse)
     response_mock.read = io.BytesIO(response_data.encode()).read
     response_mock.status = response_status
     response_mock.reason = response_reason
+    response_mock.will_close = not keep_alive
+    response_mock.isclosed.return_value = True
+    return response_mock
 
+
+def __mockConnection(connection_mock, response_data='', response_status=200, response_reason='OK', raise_=None, keep_alive=False):
     # connectionmock
-    connection_mock.getresponse.return_value = response_mock
+    if isinstance(response_data, list):
+        # successive answers
+        connection_mock.getresponse.side_effect = [__mockResponse(data, response_status, response_reason, keep_alive)
+                                                    for data in response_data]
+    else:
+        connection_mock.getresponse.return_value = __mockResponse(response_data, response_status,
+                                                                    response_reason, keep_alive)
     if raise_:
         connection_mock.request = __createRaiser(raise_)
 
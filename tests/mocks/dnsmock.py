@@ -0,0 +1,45 @@
+# -*- coding: utf8 -*-
+
+import asyncio
+import socket
+import struct
+
+
+class DNSServerMock(asyncio.DatagramProtocol):
+    """A local asyncio UDP server answering A queries from a static zone
+    """
+
+    def __init__(self, records=None, ttl=300, silent=False):
+        self.records = records or dict()
+        self.ttl = ttl
+        self.silent = silent
+        self.queries = []
+        self.transport = None
+        self.port = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', 0))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        return self
+
+    async def stop(self):
+        self.transport.close()
+
+    def datagram_received(self, data, addr):
+        query_id, = struct.unpack_from('!H', data)
+        offset, labels = 12, []
+        while data[offset]:
+            labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+            offset += data[offset] + 1
+        question = data[12:offset + 5]
+        hostname = '.'.join(labels)
+        self.queries.append(hostname)
+        if self.silent:
+            return
+        addresses = self.records.get(hostname)
+        rcode = 3 if addresses is None else 0
+        answers = b''.join(struct.pack('!HHHIH', 0xC00C, 1, 1, self.ttl, 4) + socket.inet_aton(address)
+                            for address in addresses or [])
+        header = struct.pack('!HHHHHH', query_id, 0x8180 | rcode, 1, len(addresses or []), 0, 0)
+        self.transport.sendto(header + question + answers, addr)
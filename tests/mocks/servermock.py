@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+
+import asyncio
+
+# python < 3.7 compatibility
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class DynDNSServerMock(object):
+    """A local asyncio server speaking the DynDNS update protocol
+    """
+
+    def __init__(self, answer='good', status=200, delay=0, keep_alive=True):
+        self.answer = answer
+        self.status = status
+        self.delay = delay
+        self.keep_alive = keep_alive
+        self.requests = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.server = None
+        self.port = None
+        self.handlers = set()
+
+    async def start(self, ssl=None):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0, ssl=ssl)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for handler in list(self.handlers):
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        handler = current_task()
+        self.handlers.add(handler)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip()] = value.strip()
+                self.requests.append((request_line.decode().rstrip('\r\n'), headers))
+
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                self.active -= 1
+
+                answer = self.answer(request_line, headers) if callable(self.answer) else self.answer
+                body = answer.encode()
+                writer.write('HTTP/1.1 {} OK\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    self.status, len(body), '' if self.keep_alive else 'Connection: close\r\n').encode() + body)
+                await writer.drain()
+                if not self.keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
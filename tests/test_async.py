@@ -0,0 +1,572 @@
+# -*- coding: utf8 -*-
+
+import asyncio
+import base64
+import io
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import pytest
+from unittest.mock import patch, Mock
+
+from .mocks.dnsmock import DNSServerMock
+from .mocks.servermock import DynDNSServerMock
+
+import dyndnsupdate
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_query_same_as_sync():
+    """The asyncio engine must send the same query as DynDNSUpdate"""
+    async def scenario():
+        server = await DynDNSServerMock(answer='good 1.1.1.1').start()
+        updater = dyndnsupdate.AsyncUpdater()
+        server_url = 'http://127.0.0.1:{}/'.format(server.port)
+        batch = dyndnsupdate.UpdateBatch(server_url, 'user', 'pass', '1.1.1.1', ['a.example.com', 'b.example.com'])
+        result = await updater.update(batch)
+        updater.close()
+        await server.stop()
+        return server, server_url, result
+
+    server, server_url, result = run(scenario())
+    assert result.status == 200
+    assert result.answer == 'good 1.1.1.1'
+    assert result.error is None
+
+    url_parts = dyndnsupdate.DynDNSUpdate.RE_URL.match(server_url).groupdict()
+    fields = dict(dyndnsupdate.default_fields(), hostname='a.example.com,b.example.com', myip='1.1.1.1')
+    url, headers = dyndnsupdate.build_query(url_parts, '/nic/update', fields, 'user', 'pass')
+    request_line, received_headers = server.requests[0]
+    assert request_line == 'GET {} HTTP/1.1'.format(url)
+    assert received_headers['Authorization'] == 'Basic dXNlcjpwYXNz'
+    assert received_headers['User-Agent'] == headers['User-Agent']
+    assert received_headers['Host'] == '127.0.0.1:{}'.format(server.port)
+
+
+def test_async_concurrency_limits():
+    """Concurrent queries must respect the global and per server limits"""
+    async def scenario(concurrency, server_concurrency):
+        servers = [await DynDNSServerMock(delay=0.05).start() for _ in range(2)]
+        updater = dyndnsupdate.AsyncUpdater(concurrency=concurrency, server_concurrency=server_concurrency)
+        batches = [dyndnsupdate.UpdateBatch('http://127.0.0.1:{}/'.format(server.port), None, None,
+                                            '1.1.1.1', ['h{}'.format(i)])
+                    for i in range(10) for server in servers]
+        results = await updater.update_all(batches)
+        updater.close()
+        for server in servers:
+            await server.stop()
+        return servers, results
+
+    servers, results = run(scenario(100, 3))
+    assert all(result.status == 200 for result in results)
+    assert [len(server.requests) for server in servers] == [10, 10]
+    assert [server.max_active for server in servers] == [3, 3]
+    # keep-alive connections are reused
+    assert [server.connections for server in servers] == [3, 3]
+
+    servers, results = run(scenario(1, 3))
+    assert [server.max_active for server in servers] == [1, 1]
+
+
+def test_async_errors():
+    """Network errors must be reported in the results"""
+    async def scenario():
+        server = await DynDNSServerMock(delay=1).start()
+        port = server.port
+        updater = dyndnsupdate.AsyncUpdater(timeout=0.1)
+        results = await updater.update_all([
+            dyndnsupdate.UpdateBatch('http://127.0.0.1:{}/'.format(port), None, None, '1.1.1.1', ['a']),
+            dyndnsupdate.UpdateBatch('ftp://127.0.0.1/', None, None, '1.1.1.1', ['a']),
+        ])
+        updater.close()
+        await server.stop()
+        return results
+
+    timeout, bad_url = run(scenario())
+    assert timeout.status is None and timeout.error == 'timeout'
+    assert bad_url.error == 'incorrect server url'
+
+
+def test_async_reconnect():
+    """Connections closed by the server must be replaced"""
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(DynDNSServerMock(keep_alive=False).start())
+    batches = [dyndnsupdate.UpdateBatch('http://127.0.0.1:{}/'.format(server.port), None, None,
+                                        '1.1.1.1', ['h'])] * 3
+    updater = dyndnsupdate.AsyncUpdater(server_concurrency=1)
+    try:
+        results = loop.run_until_complete(updater.update_all(batches))
+    finally:
+        updater.close()
+        loop.run_until_complete(server.stop())
+        loop.close()
+    assert [result.status for result in results] == [200, 200, 200]
+    assert server.connections == 3
+
+
+def test_async_resolution_cache():
+    """The connections must reuse the cached resolution of the server"""
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(DynDNSServerMock(keep_alive=False).start())
+    batches = [dyndnsupdate.UpdateBatch('http://localhost:{}/'.format(server.port), None, None,
+                                        '1.1.1.1', ['h'])] * 3
+    getaddrinfo = socket.getaddrinfo
+    # the mock only listens on IPv4
+    resolve = Mock(side_effect=lambda *args: [info for info in getaddrinfo(*args) if info[0] == socket.AF_INET])
+    updater = dyndnsupdate.AsyncUpdater(server_concurrency=1, resolutions=dyndnsupdate.ResolutionCache())
+    try:
+        with patch('socket.getaddrinfo', resolve):
+            results = loop.run_until_complete(updater.update_all(batches))
+    finally:
+        updater.close()
+        loop.run_until_complete(server.stop())
+        loop.close()
+    assert [result.status for result in results] == [200, 200, 200]
+    assert server.connections == 3
+    assert resolve.call_count == 1
+
+
+def test_ip_discovery_race():
+    """The first valid answer must win and slower queries be cancelled"""
+    async def scenario():
+        slow = await DynDNSServerMock(answer='2.2.2.2', delay=2).start()
+        fast = await DynDNSServerMock(answer='1.1.1.1\n').start()
+        invalid = await DynDNSServerMock(answer='<html>').start()
+        discovery = dyndnsupdate.IPDiscovery(urls=['http://127.0.0.1:{}/'.format(server.port)
+                                                    for server in [slow, invalid, fast]])
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        ip = await discovery.discover_async()
+        duration = loop.time() - start
+        # cached result
+        again = await discovery.discover_async()
+        for server in [slow, fast, invalid]:
+            await server.stop()
+        return ip, again, duration, fast
+
+    ip, again, duration, fast = run(scenario())
+    assert ip == '1.1.1.1'
+    assert again == '1.1.1.1'
+    assert duration < 1
+    assert len(fast.requests) == 1
+
+
+def test_ip_discovery_quorum():
+    """In quorum mode enough services must agree"""
+    async def scenario(quorum, answers):
+        servers = [await DynDNSServerMock(answer=answer).start() for answer in answers]
+        discovery = dyndnsupdate.IPDiscovery(urls=['http://127.0.0.1:{}/'.format(server.port)
+                                                    for server in servers], quorum=quorum, ttl=0)
+        ip = await discovery.discover_async()
+        for server in servers:
+            await server.stop()
+        return ip
+
+    assert run(scenario(2, ['1.1.1.1', '2.2.2.2', '1.1.1.1'])) == '1.1.1.1'
+    assert run(scenario(2, ['1.1.1.1', '2.2.2.2', '3.3.3.3'])) is None
+    assert run(scenario(1, ['not an ip'])) is None
+
+
+def test_ip_discovery_timeout():
+    """The timeout must bound the whole discovery, not each answer"""
+    async def scenario():
+        servers = [await DynDNSServerMock(answer=answer, delay=delay).start()
+                   for answer, delay in [('1.1.1.1', 0.2), ('2.2.2.2', 0.4), ('1.1.1.1', 0.8)]]
+        discovery = dyndnsupdate.IPDiscovery(urls=['http://127.0.0.1:{}/'.format(server.port)
+                                                    for server in servers], quorum=2, timeout=0.5)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        ip = await discovery.discover_async()
+        duration = loop.time() - start
+        for server in servers:
+            await server.stop()
+        return ip, duration
+
+    ip, duration = run(scenario())
+    assert ip is None
+    assert duration < 0.7
+
+
+class ServerThread(object):
+    """Run mock servers in a background event loop for synchronous callers"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def start(self, server):
+        return asyncio.run_coroutine_threadsafe(server.start(), self.loop).result()
+
+    def stop(self, *servers):
+        for server in servers:
+            asyncio.run_coroutine_threadsafe(server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def answer_each(request_line, headers):
+    """Answer good for each hostname of the query"""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(request_line.split()[1].decode()).query)
+    return '\n'.join('good ' + query['myip'][0] for _ in query['hostname'][0].split(','))
+
+
+def test_bulk_records():
+    """Records must be decoded, validated and grouped with their neighbours"""
+    lines = ['hostname,ip,server,username,password\n', 'a.example.com,1.1.1.1\n', '\n', 'b.example.com, 1.1.1.1\n',
+                'bad host,1.1.1.1\n', 'c.example.com,1.1.1.1,http://other.com/,u,p\n']
+    rows = list(dyndnsupdate.read_records(lines))
+    assert [number for number, _ in rows] == [2, 4, 5, 6]
+    records = dyndnsupdate.validate_records(rows, 'http://www.api.com/', 'user', 'pass')
+    batches = list(dyndnsupdate.chunk_records(records, max_hostnames=20))
+    assert batches == [
+        ([2, 4], dyndnsupdate.UpdateBatch('http://www.api.com/', 'user', 'pass', '1.1.1.1',
+                                            ['a.example.com', 'b.example.com'])),
+        ([5], 'incorrect hostname "bad host"'),
+        ([6], dyndnsupdate.UpdateBatch('http://other.com/', 'u', 'p', '1.1.1.1', ['c.example.com'])),
+    ]
+
+    lines = ['{"hostname": "a.example.com", "ip": "1.1.1.300"}\n', '{"hostname": \n', '[]\n']
+    errors = list(dyndnsupdate.validate_records(dyndnsupdate.read_records(lines)))
+    assert errors[0] == (1, 'incorrect ip address "1.1.1.300"')
+    assert errors[1][0] == 2 and errors[1][1].startswith('invalid JSON : ')
+    assert errors[2] == (3, 'a JSON object is expected')
+
+
+def test_bulk_update():
+    """A records stream must be sent in batches and its results kept in order"""
+    servers = ServerThread()
+    server = servers.start(DynDNSServerMock(answer=answer_each, delay=0.01))
+    lines = ('h{}.example.com,1.1.1.{}\n'.format(i, i // 25) for i in range(50))
+    output = io.StringIO()
+    program = dyndnsupdate.DynDNSUpdate()
+    try:
+        assert program.configure(verbose=-1, server_url='http://127.0.0.1:{}/'.format(server.port)) == True
+        assert program.bulk(itertools.chain(lines, ['broken\n']), output, concurrency=2) == 1
+    finally:
+        program.close()
+        servers.stop(server)
+    # 2 addresses of 25 hostnames in batches of 20
+    assert len(server.requests) == 4
+    assert server.max_active == 2
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result['line'] for result in results] == list(range(1, 52))
+    assert results[0] == dict(line=1, hostname='h0.example.com', ip='1.1.1.0', status='success',
+                                code='good', answer='good 1.1.1.0',
+                                server='http://127.0.0.1:{}/'.format(server.port))
+    assert results[49]['answer'] == 'good 1.1.1.1'
+    assert results[50] == dict(line=51, status='invalid', error='incorrect ip address ""')
+
+
+def test_bulk_resume(tmp_path):
+    """A bulk update must resume after the last result and skip refused accounts"""
+    results_file = tmp_path / 'results.jsonl'
+    results_file.write_text('{"line": 1, "status": "success"}\n{"line": 2, "st')
+    assert dyndnsupdate.last_result_line(str(results_file)) == 1
+    assert dyndnsupdate.last_result_line(str(tmp_path / 'missing')) == 0
+
+    servers = ServerThread()
+    server = servers.start(DynDNSServerMock(answer='badauth'))
+    server_url = 'http://127.0.0.1:{}/'.format(server.port)
+    lines = ['{{"hostname": "h{}.example.com", "ip": "1.1.1.{}", "server": "{}"}}\n'.format(i, i, server_url)
+                for i in range(1, 5)]
+    program = dyndnsupdate.DynDNSUpdate()
+    try:
+        assert program.configure(verbose=-1) == True
+        with dyndnsupdate.open_results(str(results_file)) as output:
+            assert program.bulk(lines, output, skip=1, concurrency=1) == 11
+    finally:
+        program.close()
+        servers.stop(server)
+    assert len(server.requests) == 1
+    results = [json.loads(line) for line in results_file.read_text().splitlines()[2:]]
+    assert [(result['line'], result['status']) for result in results] == [
+        (2, 'fatal'), (3, 'skipped'), (4, 'skipped')]
+
+
+async def relay_query(reader, writer, target, credentials=None, extra=''):
+    """Send one query to the relay and read its answer"""
+    headers = 'Host: relay\r\n' + extra
+    if credentials:
+        headers += 'Authorization: Basic {}\r\n'.format(base64.b64encode(credentials.encode()).decode())
+    writer.write('GET {} HTTP/1.1\r\n{}\r\n'.format(target, headers).encode())
+    head = (await reader.readuntil(b'\r\n\r\n')).decode()
+    length = int(head.partition('Content-Length: ')[2].partition('\r\n')[0])
+    return int(head.split(' ')[1]), (await reader.readexactly(length)).decode()
+
+
+def test_relay():
+    """The relay must deduplicate local updates and forward them in batches"""
+    async def scenario():
+        upstream = await DynDNSServerMock(answer=answer_each).start()
+        relay = dyndnsupdate.RelayServer('http://127.0.0.1:{}/'.format(upstream.port), 'user', 'pass',
+                                            clients={'lan': 'secret'})
+        await relay.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', relay.port)
+        answers = [
+            await relay_query(reader, writer, '/nic/update?hostname=a.example.com&myip=1.1.1.1'),
+            await relay_query(reader, writer, '/nic/update?hostname=a.example.com&myip=1.1.1.1', 'lan:wrong'),
+            await relay_query(reader, writer, '/other', 'lan:secret'),
+            await relay_query(reader, writer, '/nic/update?hostname=a.example.com,b..com&myip=1.1.1.1',
+                                'lan:secret'),
+            await relay_query(reader, writer, '/nic/update?hostname=a.example.com&myip=2.2.2.2', 'lan:secret'),
+            await relay_query(reader, writer, '/nic/update?hostname=c.example.com', 'lan:secret'),
+        ]
+        pending = relay.pending
+        code = await relay.flush()
+        again = await relay_query(reader, writer, '/nic/update?hostname=a.example.com&myip=2.2.2.2',
+                                    'lan:secret')
+        writer.close()
+        await relay.close()
+        await upstream.stop()
+        return answers, pending, code, again, upstream
+
+    answers, pending, code, again, upstream = run(scenario())
+    assert answers == [(401, 'badauth'), (401, 'badauth'), (404, ''), (200, 'good 1.1.1.1\nnotfqdn'),
+                        (200, 'good 2.2.2.2'), (200, 'good 127.0.0.1')]
+    # the latest address wins
+    assert pending == {'a.example.com': '2.2.2.2', 'c.example.com': '127.0.0.1'}
+    assert code == 0
+    assert len(upstream.requests) == 2
+    assert upstream.requests[0][1]['Authorization'] == 'Basic dXNlcjpwYXNz'
+    assert again == (200, 'nochg 2.2.2.2')
+
+
+def test_relay_retry():
+    """Updates which could not be forwarded must be kept unless replaced"""
+    async def scenario():
+        upstream = await DynDNSServerMock(answer='911').start()
+        relay = dyndnsupdate.RelayServer('http://127.0.0.1:{}/'.format(upstream.port), anonymous=True)
+        await relay.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', relay.port)
+        await relay_query(reader, writer, '/nic/update?hostname=a.example.com,b.example.com&myip=1.1.1.1')
+        code = await relay.flush()
+        await relay_query(reader, writer, '/nic/update?hostname=b.example.com&myip=2.2.2.2')
+        pending = relay.pending
+        writer.close()
+        await relay.close()
+        await upstream.stop()
+        return code, pending
+
+    code, pending = run(scenario())
+    assert code == 10
+    assert pending == {'a.example.com': '1.1.1.1', 'b.example.com': '2.2.2.2'}
+
+
+def test_relay_request_body():
+    """The relay must not read the body of unknown clients nor of oversized requests"""
+    async def scenario(credentials, length):
+        relay = dyndnsupdate.RelayServer('http://127.0.0.1:1/', clients={'lan': 'secret'})
+        await relay.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', relay.port)
+        answer = await relay_query(reader, writer, '/nic/update?hostname=a.example.com&myip=1.1.1.1',
+                                    credentials, 'Content-Length: {}\r\n'.format(length))
+        closed = await reader.read() == b''
+        writer.close()
+        await relay.close()
+        return answer, closed
+
+    assert run(scenario(None, 1 << 30)) == ((401, 'badauth'), True)
+    assert run(scenario('lan:secret', 'x')) == ((400, ''), True)
+    assert run(scenario('lan:secret', -1)) == ((400, ''), True)
+    assert run(scenario('lan:secret', dyndnsupdate.RelayServer.MAX_REQUEST_SIZE + 1)) == ((413, ''), True)
+
+
+def test_relay_refused():
+    """A hostname refused upstream must get the refusal on its next query"""
+    async def scenario():
+        upstream = await DynDNSServerMock(answer='nohost').start()
+        relay = dyndnsupdate.RelayServer('http://127.0.0.1:{}/'.format(upstream.port), anonymous=True)
+        await relay.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', relay.port)
+        query = '/nic/update?hostname=a.example.com&myip=1.1.1.1'
+        answers = [await relay_query(reader, writer, query)]
+        code = await relay.flush()
+        answers.append(await relay_query(reader, writer, query))
+        answers.append(await relay_query(reader, writer, query))
+        writer.close()
+        await relay.close()
+        await upstream.stop()
+        return code, answers
+
+    code, answers = run(scenario())
+    assert code == 1
+    assert answers == [(200, 'good 1.1.1.1'), (200, 'nohost'), (200, 'good 1.1.1.1')]
+    with pytest.raises(ValueError):
+        dyndnsupdate.RelayServer('http://127.0.0.1/')
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(verbose=-1, server_url='http://127.0.0.1/') == True
+    assert program.relay('127.0.0.1:0') == 2
+
+
+def test_dns_resolver():
+    """A records must be read concurrently from the first answering resolver and cached"""
+    async def scenario():
+        silent = await DNSServerMock(silent=True).start()
+        server = await DNSServerMock({'a.example.com': ['1.1.1.1'], 'b.example.com': ['2.2.2.2', '3.3.3.3']}).start()
+        resolver = dyndnsupdate.DNSResolver(servers=['127.0.0.1:{}'.format(silent.port),
+                                                        '127.0.0.1:{}'.format(server.port)], timeout=0.2)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        records = await resolver.resolve_async(['a.example.com', 'b.example.com', 'c.example.com'])
+        duration = loop.time() - start
+        cached = await resolver.resolve_async(['a.example.com'])
+        fresh = await resolver.resolve_async(['a.example.com', 'b.example.com'], fresh=['b.example.com'])
+        await silent.stop()
+        await server.stop()
+        return records, duration, cached, fresh, silent, server
+
+    records, duration, cached, fresh, silent, server = run(scenario())
+    assert records == {'a.example.com': ['1.1.1.1'], 'b.example.com': ['2.2.2.2', '3.3.3.3'], 'c.example.com': []}
+    # the queries are sent at the same time
+    assert duration < 0.4
+    assert cached == {'a.example.com': ['1.1.1.1']}
+    assert fresh == {'a.example.com': ['1.1.1.1'], 'b.example.com': ['2.2.2.2', '3.3.3.3']}
+    assert sorted(silent.queries) == ['a.example.com', 'b.example.com', 'b.example.com', 'c.example.com']
+    assert sorted(server.queries) == ['a.example.com', 'b.example.com', 'b.example.com', 'c.example.com']
+    # a truncated answer is unknown
+    truncated = struct.pack('!HHHHHH', 7, 0x8200, 0, 0, 0, 0)
+    assert dyndnsupdate.DNSResolver.parse_response(7, truncated) == (None, 0)
+
+
+def test_dns_check_skip_update():
+    """Hostnames whose A record already have the address must not be updated"""
+    servers = ServerThread()
+    dns = servers.start(DNSServerMock({'a.example.com': ['1.1.1.1'], 'b.example.com': ['2.2.2.2']}))
+    server = servers.start(DynDNSServerMock(answer='good 1.1.1.1'))
+    program = dyndnsupdate.DynDNSUpdate()
+    try:
+        assert program.configure(verbose=-1, server_url='http://127.0.0.1:{}/'.format(server.port),
+                                    dyndns_myip='1.1.1.1', dyndns_hostname=['a.example.com', 'b.example.com'],
+                                    dns_resolvers=['127.0.0.1:{}'.format(dns.port)]) == True
+        assert program.main() == 0
+    finally:
+        program.close()
+        servers.stop(dns, server)
+    assert len(server.requests) == 1
+    assert 'hostname=b.example.com&' in server.requests[0][0]
+
+
+def test_ip_discovery_ipv6():
+    """An IPv6 discovery must only accept IPv6 addresses"""
+    async def scenario():
+        servers = [await DynDNSServerMock(answer=answer).start() for answer in ['1.1.1.1', '2001:db8::1']]
+        discoveries = [dyndnsupdate.IPDiscovery(urls=['http://127.0.0.1:{}/'.format(server.port)], family=family)
+                        for server in servers for family in [4, 6]]
+        addresses = await asyncio.gather(*[discovery.discover_async() for discovery in discoveries])
+        for server in servers:
+            await server.stop()
+        return addresses
+
+    assert run(scenario()) == ['1.1.1.1', None, None, '2001:db8::1']
+
+
+def test_client_threads():
+    """A client must be shared by threads and reuse its connections"""
+    servers = ServerThread()
+    server = servers.start(DynDNSServerMock(answer=answer_each, delay=0.01))
+    client = dyndnsupdate.DynDNSClient('http://127.0.0.1:{}/'.format(server.port), 'user', 'pass')
+    results = []
+
+    def run(i):
+        for j in range(5):
+            results.extend(client.update(['t{}.example.com'.format(i), 'u{}.example.com'.format(i)],
+                                            '1.1.{}.{}'.format(i, j)))
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        client.close()
+        servers.stop(server)
+    assert len(results) == 80
+    assert all(result.status == 'success' and result.code == 'good' for result in results)
+    assert all(result.timings['total'] > 0 for result in results)
+    assert len(server.requests) == 40
+    assert server.connections <= 8
+
+
+def test_span_hooks():
+    """The hooks must be called around each traced phase, even failing ones"""
+    spans = []
+
+    def hook(name, attributes):
+        spans.append(('start', name))
+        return lambda error: spans.append(('end', name, error is None))
+
+    def broken_hook(name, attributes):
+        raise RuntimeError('broken')
+
+    servers = ServerThread()
+    server = servers.start(DynDNSServerMock(answer='good'))
+    dyndnsupdate.add_span_hook(hook)
+    dyndnsupdate.add_span_hook(broken_hook)
+    try:
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(verbose=-1) == True
+        client = dyndnsupdate.DynDNSClient('http://127.0.0.1:{}/'.format(server.port))
+        assert client.update('a.example.com', '1.1.1.1')[0].status == 'success'
+        client.close()
+    finally:
+        dyndnsupdate.remove_span_hook(hook)
+        dyndnsupdate.remove_span_hook(broken_hook)
+        servers.stop(server)
+    assert spans == [('start', 'configure'), ('end', 'configure', True),
+                        ('start', 'build_query'), ('end', 'build_query', True),
+                        ('start', 'connect'), ('end', 'connect', True),
+                        ('start', 'getresponse'), ('end', 'getresponse', True)]
+    assert dyndnsupdate.span('configure') is dyndnsupdate.NULL_SPAN
+
+
+def test_fanout(tmp_path):
+    """A hung provider must not delay the others beyond the fan-out policy"""
+    servers = ServerThread()
+    slow = servers.start(DynDNSServerMock(answer='good', delay=3))
+    fast = servers.start(DynDNSServerMock(answer='good'))
+    config_file = tmp_path / 'providers.ini'
+    config_file.write_text("""
+[primary]
+dyn-server = http://127.0.0.1:{}/
+username = user
+password = secret
+api-url = /primary/update
+
+[secondary]
+dyn-server = http://127.0.0.1:{}/
+""".format(slow.port, fast.port))
+    defaults = dict(verbose=-1, dyndns_hostname=['home.example.com'], dyndns_myip='1.1.1.1', retry_attempts=1)
+    try:
+        group = dyndnsupdate.ProfileGroup(fanout='first')
+        assert group.load(str(config_file), **defaults) == True
+        start = time.monotonic()
+        assert group.main() == 0
+        assert time.monotonic() - start < 2
+        assert '/nic/update?' in fast.requests[0][0]
+
+        group = dyndnsupdate.ProfileGroup(fanout='all', deadline=0.5)
+        assert group.load(str(config_file), **defaults) == True
+        start = time.monotonic()
+        assert group.main() == 10
+        assert time.monotonic() - start < 2
+        assert len(fast.requests) == 2
+        assert '/primary/update?' in slow.requests[0][0]
+    finally:
+        servers.stop(slow, fast)
+    with pytest.raises(ValueError):
+        dyndnsupdate.ProfileGroup(fanout='any')
+    with pytest.raises(ValueError):
+        dyndnsupdate.ProfileGroup(deadline=1)
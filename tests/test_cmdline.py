@@ -2,6 +2,7 @@
 
 import shlex
 import subprocess
+import sys
 
 
 # command line test
@@ -20,3 +21,41 @@ def test_cmdline_exit_with_2():
     result = subprocess.Popen(shlex.split('./dyndnsupdate.py --dyn-address 1.1.1.1 --dyn-server ftp://www.ovh.com --dyn-hostname d'), stdout=subprocess.PIPE)
     stdout, stderr = result.communicate()
     assert result.returncode == 2
+
+def test_cmdline_state_hit_does_not_load_network_modules(tmp_path):
+    """A run stopped by the state cache must not load the network stack"""
+    state_file = str(tmp_path / 'state.json')
+    script = """
+import sys
+sys.argv = ['dyndnsupdate.py', '--no-output', '--state-file', {state!r},
+            '--dyn-server', 'http://www.api.com/', '--dyn-address', '1.1.1.1', '--dyn-hostname', 'd']
+import json, time
+with open({state!r}, 'w') as state_file:
+    json.dump({{'http://www.api.com/ d': dict(ip='1.1.1.1', timestamp=time.time(), answer='good')}}, state_file)
+import dyndnsupdate
+program = dyndnsupdate.DynDNSUpdate()
+assert program.configure(**vars(dyndnsupdate.parse_args()))
+assert program.main() == 0
+print(sorted(m for m in ['_ssl', 'asyncio.base_events', 'email.parser'] if m in sys.modules))
+""".format(state=state_file)
+    result = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+    stdout, stderr = result.communicate()
+    assert result.returncode == 0
+    assert stdout.decode().strip() == "[]"
+
+def test_cmdline_config_without_valid_profile(tmp_path):
+    """A configuration file without valid profile must produce a 2 return code"""
+    config_file = tmp_path / 'dyndns.ini'
+    config_file.write_text('[broken]\ndyn-server = ftp://www.ovh.com\ndyn-hostname = d\n')
+    result = subprocess.Popen(['./dyndnsupdate.py', '--no-output', '--config', str(config_file)], stdout=subprocess.PIPE)
+    stdout, stderr = result.communicate()
+    assert result.returncode == 2
+
+def test_cmdline_deadline_without_fanout():
+    """A deadline without fan-out policy must produce a 2 return code"""
+    result = subprocess.Popen(shlex.split('./dyndnsupdate.py --no-output --deadline 5 --dyn-address 1.1.1.1 '
+                                            '--dyn-server http://127.0.0.1:1/ --dyn-hostname d'),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = result.communicate()
+    assert result.returncode == 2
+    assert b'--fanout' in stderr
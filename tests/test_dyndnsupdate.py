@@ -1,12 +1,18 @@
 # -*- coding: utf8 -*-
 
 import http.client
+import json
 import logging
+import pstats
 import shlex
 import shutil
 import socket
 import ssl
+import struct
 import subprocess
+import time
+import tracemalloc
+import pytest
 from unittest.mock import patch, Mock, call
 
 from .mocks.connexionmock import createHTTPConnectionMock, createHTTPSConnectionMock
@@ -65,7 +71,7 @@ def test_with_http_auth():
     'http://www.api.com/nic/update?backmx=NOCHG&hostname=mydyndnshostname.com&mx=&myip=1.1.1.1&offline=NOCHG&system=dyndns&url=&wildcard=NOCHG', headers={'User-Agent': 'dyndns-update/'+dyndnsupdate.__version__, 'Authorization': 'Basic dXNlcjpwYXNz'})
     http.client.HTTPConnection.assert_has_calls([c1])
 
-@patch('http.client.HTTPSConnection', createHTTPSConnectionMock('0.0.0.0'))
+@patch('http.client.HTTPSConnection', createHTTPSConnectionMock('good 0.0.0.0'))
 @patch('ssl._create_unverified_context', return_value=Mock(spec=ssl.SSLContext))
 def test_insecure_https_address_from_url(ssl_context_mock, capsys):
     """Use insecure SSL transaction"""
@@ -79,3 +85,795 @@ def test_insecure_https_address_from_url(ssl_context_mock, capsys):
     assert program.main() == 0
 
     ssl._create_unverified_context.assert_called_once_with()
+
+# Persistent connections
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(keep_alive=True))
+def test_connection_reused_between_updates():
+    """Keep-alive connection must be reused by successive updates"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/',
+                                verbose=-1,
+                                dyndns_hostname=['mydyndnshostname.com']) == True
+    assert program.main() == 0
+    assert program.main() == 0
+    assert http.client.HTTPConnection.call_count == 1
+    program.close()
+    http.client.HTTPConnection.return_value.close.assert_called_once_with()
+
+def test_connection_pool_reconnect():
+    """A connection closed by the server must be transparently replaced"""
+    first = createHTTPConnectionMock(keep_alive=True).return_value
+    second = createHTTPConnectionMock(keep_alive=True).return_value
+    pool = dyndnsupdate.ConnectionPool()
+    with patch('http.client.HTTPConnection', Mock(side_effect=[first, second])) as connection_class:
+        pool.request('http', 'www.api.com', 80, 'GET', '/', {})
+        first.getresponse.side_effect = http.client.RemoteDisconnected('closed')
+        res, data = pool.request('http', 'www.api.com', 80, 'GET', '/', {})
+    assert res.status == 200
+    first.close.assert_called_once_with()
+    assert connection_class.call_count == 2
+    assert len(pool) == 1
+
+    # a fresh connection error is not retried
+    pool = dyndnsupdate.ConnectionPool()
+    with patch('http.client.HTTPConnection', createHTTPConnectionMock(raise_=ConnectionResetError)):
+        try:
+            pool.request('http', 'www.api.com', 80, 'GET', '/', {})
+            assert False
+        except ConnectionResetError:
+            pass
+    assert len(pool) == 0
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(keep_alive=True))
+def test_daemon_mode():
+    """The daemon loop must run until stopped"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/',
+                                verbose=-1,
+                                dyndns_hostname=['mydyndnshostname.com']) == True
+    calls = []
+    def main():
+        calls.append(1)
+        if len(calls) == 3:
+            program.stop()
+        return 1
+    program.main = main
+    assert program.daemon(0) == 0
+    assert len(calls) == 3
+
+    # configuration errors abort the daemon
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.daemon(0) == 3
+
+# State cache
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good 1.1.1.1'))
+def test_state_cache_skip_unchanged(tmp_path):
+    """An unchanged address must not be sent twice"""
+    state_file = str(tmp_path / 'state.json')
+    options = dict(server_url='http://www.api.com/', verbose=-1,
+                    dyndns_hostname=['a.example.com', 'b.example.com'],
+                    state_file=state_file)
+
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', **options) == True
+    assert program.main() == 0
+    assert program.main() == 0
+    assert http.client.HTTPConnection.call_count == 1
+
+    # another process share the same file
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', **options) == True
+    assert program.main() == 0
+    assert http.client.HTTPConnection.call_count == 1
+
+    cache = dyndnsupdate.StateCache(state_file)
+    entry = cache.get('http://www.api.com/', 'b.example.com')
+    assert entry['ip'] == '1.1.1.1'
+    assert entry['answer'] == 'good 1.1.1.1'
+
+    # a new address must be sent
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='2.2.2.2', **options) == True
+    assert program.main() == 0
+    assert http.client.HTTPConnection.call_count == 2
+
+def test_ip_address_families():
+    """IPv4 and IPv6 addresses must be recognized"""
+    for address, family in [('1.1.1.1', 'ipv4'), ('2001:db8::1', 'ipv6'), ('::1', 'ipv6'),
+                            ('fe80:0:0:0:0:0:0:1', 'ipv6'), ('2001:db8::', 'ipv6')]:
+        assert dyndnsupdate.DynDNSUpdate.RE_IP.match(address).group(family) == address
+    for address in ['1.1.1', '2001:db8::g', '1:2:3:4:5:6:7:8:9', '2001::db8::1']:
+        assert dyndnsupdate.DynDNSUpdate.RE_IP.match(address) is None
+    assert dyndnsupdate.split_addresses('2001:db8::1, 1.1.1.1') == {4: '1.1.1.1', 6: '2001:db8::1'}
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myipv6='1.1.1.1', verbose=-1) == False
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good', 'good', 'good', 'good']))
+def test_dual_stack_modes():
+    """Both families must be sent in as few queries as the server accept"""
+    options = dict(server_url='http://www.api.com/', verbose=-1, dyndns_hostname=['a.example.com'])
+    for mode in ['myip', 'myipv6', 'separate']:
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(dyndns_myip='1.1.1.1', dyndns_myipv6='2001:db8::1', ipv6_mode=mode, **options) == True
+        assert program.main() == 0
+    requests = [request[0][1] for request in http.client.HTTPConnection.return_value.request.call_args_list]
+    assert len(requests) == 4
+    assert '&myip=1.1.1.1%2C2001%3Adb8%3A%3A1&' in requests[0]
+    assert '&myip=1.1.1.1&myipv6=2001%3Adb8%3A%3A1&' in requests[1]
+    assert '&myip=1.1.1.1&' in requests[2]
+    assert '&myip=2001%3Adb8%3A%3A1&' in requests[3]
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good', 'good']))
+def test_state_cache_per_family(tmp_path):
+    """A change of one address family must not send the other again"""
+    options = dict(server_url='http://www.api.com/', verbose=-1, dyndns_hostname=['a.example.com'],
+                    state_file=str(tmp_path / 'state.json'), ipv6_mode='myipv6')
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1,2001:db8::1', **options) == True
+    assert program.main() == 0
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1,2001:db8::2', **options) == True
+    assert program.main() == 0
+    requests = [request[0][1] for request in http.client.HTTPConnection.return_value.request.call_args_list]
+    assert len(requests) == 2
+    assert 'myip=' not in requests[1]
+    assert 'myipv6=2001%3Adb8%3A%3A2&' in requests[1]
+    cache = dyndnsupdate.StateCache(str(tmp_path / 'state.json'))
+    assert cache.get('http://www.api.com/', 'a.example.com')['ip'] == '1.1.1.1'
+    assert cache.get('http://www.api.com/', 'a.example.com', family=6)['ip'] == '2001:db8::2'
+
+def test_state_cache_max_age(tmp_path):
+    """Old entries must be refreshed"""
+    cache = dyndnsupdate.StateCache(str(tmp_path / 'state.json'), max_age=60)
+    assert cache.is_fresh('http://a/', 'h', '1.1.1.1') == False
+    cache.set('http://a/', ['h'], '1.1.1.1', 'good', now=1000)
+    assert cache.is_fresh('http://a/', 'h', '1.1.1.1', now=1059) == True
+    assert cache.is_fresh('http://a/', 'h', '1.1.1.1', now=1060) == False
+    assert cache.is_fresh('http://a/', 'h', '2.2.2.2', now=1000) == False
+    assert cache.is_fresh('http://b/', 'h', '1.1.1.1', now=1000) == False
+
+def test_state_cache_batch(tmp_path):
+    """Both families of a batch are written at once and checked from one read"""
+    cache = dyndnsupdate.StateCache(str(tmp_path / 'state.json'), max_age=60)
+    cache.set('http://a/', ['h1', 'h2'], '1.1.1.1,::1', 'good', now=1000)
+    state = cache.load()
+    assert len(state) == 4
+    (tmp_path / 'state.json').unlink()
+    assert cache.is_fresh('http://a/', 'h2', '1.1.1.1', now=1000, state=state) == True
+    assert cache.is_fresh('http://a/', 'h1', '::1', now=1000, state=state) == True
+    assert cache.is_fresh('http://a/', 'h1', '::1', now=1000) == False
+
+def test_state_cache_corrupted(tmp_path):
+    """A corrupted state file must be ignored"""
+    state_file = tmp_path / 'state.json'
+    state_file.write_text('{not json')
+    cache = dyndnsupdate.StateCache(str(state_file))
+    assert cache.get('http://a/', 'h') is None
+    cache.set('http://a/', ['h'], '1.1.1.1', 'good')
+    assert cache.get('http://a/', 'h')['ip'] == '1.1.1.1'
+
+# Batches
+def test_journal_compaction(tmp_path):
+    """The journal must keep the newest address of each hostname and stay small"""
+    path = str(tmp_path / 'journal')
+    journal = dyndnsupdate.UpdateJournal(path, fsync='batch')
+    journal.append('http://a/', ['h1', 'h2'], '1.1.1.1', now=10)
+    journal.append('http://a/', ['h1'], '2.2.2.2', now=20)
+    journal.append('http://b/', ['h1'], '3.3.3.3', now=30)
+    # an update started before the newest address does not complete it
+    journal.done('http://a/', ['h1', 'h2'], since=15)
+    journal.sync()
+    assert journal.pending() == [dyndnsupdate.UpdateRecord('http://a/', None, None, '2.2.2.2', 'h1'),
+                                    dyndnsupdate.UpdateRecord('http://b/', None, None, '3.3.3.3', 'h1')]
+    assert [entry.hostname for entry in journal.pending('http://b/')] == ['h1']
+
+    # a line truncated by a crash is ignored
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"server": "http://a/", "hostn')
+    for i in range(200):
+        journal.append('http://a/', ['h1'], '4.4.4.{}'.format(i % 2), now=40 + i)
+    assert journal.pending('http://a/')[0].myip == '4.4.4.1'
+    with open(path) as journal_file:
+        assert len(journal_file.readlines()) <= 2 * 2 + dyndnsupdate.UpdateJournal.COMPACT_MIN_LINES
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(raise_=ConnectionRefusedError))
+def test_journal_keeps_failed_updates(tmp_path):
+    """Updates failing on network errors must be kept in the journal"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, journal_file=str(tmp_path / 'journal')) == True
+    assert program.main() == 10
+    journal = dyndnsupdate.UpdateJournal(str(tmp_path / 'journal'))
+    assert [(entry.hostname, entry.myip) for entry in journal.pending()] == [
+        ('a.example.com', '1.1.1.1'), ('b.example.com', '1.1.1.1')]
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['911', 'good 2001:db8::1']))
+def test_journal_per_family(tmp_path):
+    """The success of one address family must not complete the journaled update of the other"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1,2001:db8::1', server_url='http://www.api.com/', verbose=-1,
+                                dyndns_hostname=['a.example.com'], ipv6_mode='separate', retry_attempts=1,
+                                journal_file=str(tmp_path / 'journal')) == True
+    assert program.main() == 10
+    journal = dyndnsupdate.UpdateJournal(str(tmp_path / 'journal'))
+    assert [(entry.hostname, entry.myip) for entry in journal.pending()] == [('a.example.com', '1.1.1.1')]
+    # the families are merged back for the servers taking both in myip
+    journal.append('http://www.api.com/', ['a.example.com'], '2001:db8::2', now=1)
+    assert journal.pending()[0].myip == '1.1.1.1,2001:db8::2'
+    journal.done('http://www.api.com/', ['a.example.com'], since=time.time() + 1, ip='1.1.1.1')
+    assert journal.pending()[0].myip == '2001:db8::2'
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good'))
+def test_journal_replay(tmp_path):
+    """Journaled updates must be replayed in limited batches once the server answers"""
+    journal = dyndnsupdate.UpdateJournal(str(tmp_path / 'journal'))
+    journal.append('http://www.api.com/', ['a.example.com', 'old.example.com'], '1.1.1.0', now=1)
+    journal.append('http://www.api.com/', ['h{}'.format(i) for i in range(30)], '2.2.2.2', now=1)
+    journal.append('http://other.com/', ['other.example.com'], '2.2.2.2', now=1)
+    # the updates of another account are not sent with the current credentials
+    journal.append('http://www.api.com/', ['foreign.example.com'], '2.2.2.2', now=1, username='other')
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, hostnames=['a.example.com'], journal_file=str(tmp_path / 'journal'),
+                            journal_replay_limit=2, journal_replay_delay=0) == True
+    assert program.main() == 0
+    requests = http.client.HTTPConnection.return_value.request.call_args_list
+    # the current update, then 2 batches of the journal
+    assert len(requests) == 3
+    assert 'hostname=a.example.com&' in requests[0][0][1]
+    assert 'hostname=old.example.com&mx=&myip=1.1.1.0&' in requests[1][0][1]
+    assert 'hostname=h0%2Ch1%2C' in requests[2][0][1]
+    assert [entry.hostname for entry in journal.pending()] == ['h20', 'h21', 'h22', 'h23', 'h24', 'h25',
+                                                                'h26', 'h27', 'h28', 'h29', 'other.example.com',
+                                                                'foreign.example.com']
+    assert journal.pending('http://www.api.com/', 'other') == [
+        dyndnsupdate.UpdateRecord('http://www.api.com/', 'other', None, '2.2.2.2', 'foreign.example.com')]
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good'))
+def test_journal_not_read_without_change(tmp_path):
+    """A run with nothing to update must not read the journal"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, hostnames=['a.example.com'], journal_file=str(tmp_path / 'journal'),
+                            state_file=str(tmp_path / 'state')) == True
+    assert program.main() == 0
+    with patch('dyndnsupdate.UpdateJournal.pending') as pending:
+        assert program.main() == 0
+    assert pending.call_count == 0
+    assert http.client.HTTPConnection.return_value.request.call_count == 1
+
+def test_interleave_families():
+    """Addresses must alternate their families, the preferred one first"""
+    v6 = [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::{}'.format(i), 80, 0, 0)) for i in range(3)]
+    v4 = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.{}'.format(i), 80)) for i in range(2)]
+    assert dyndnsupdate.interleave_families(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v6[2]]
+
+def test_happy_eyeballs_connect():
+    """An unreachable address must not delay the connection to the next one"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    # a listener with a full backlog drops the SYN like a black hole
+    black_hole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    black_hole.bind(('127.0.0.1', 0))
+    black_hole.listen(0)
+    fillers = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(3)]
+    for filler in fillers:
+        filler.setblocking(False)
+        filler.connect_ex(black_hole.getsockname())
+    infos = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', address)
+                for address in [black_hole.getsockname(), ('127.0.0.1', 1), server.getsockname()]]
+    try:
+        start = time.monotonic()
+        sock = dyndnsupdate.happy_eyeballs_connect(infos, timeout=5, delay=0.05)
+        assert time.monotonic() - start < 1
+        assert sock.getpeername() == server.getsockname()
+        sock.close()
+        with pytest.raises(OSError):
+            dyndnsupdate.happy_eyeballs_connect(infos[1:2], timeout=5)
+        with pytest.raises(socket.timeout):
+            dyndnsupdate.happy_eyeballs_connect(infos[:1], timeout=0.1)
+    finally:
+        for sock in fillers + [black_hole, server]:
+            sock.close()
+
+def test_resolution_cache():
+    """Resolutions must be reused during their TTL and kept when the resolver fails"""
+    infos = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('1.1.1.1', 443))]
+    cache = dyndnsupdate.ResolutionCache(ttl=60)
+    with patch('socket.getaddrinfo', Mock(return_value=infos)) as getaddrinfo:
+        assert cache.resolve('www.api.com', 443) == infos
+        assert cache.resolve('www.api.com', 443) == infos
+        assert getaddrinfo.call_count == 1
+    cache.ttl = 0
+    cache.invalidate('www.api.com', 443)
+    with patch('socket.getaddrinfo', Mock(return_value=infos)):
+        cache.resolve('www.api.com', 443)
+    with patch('socket.getaddrinfo', Mock(side_effect=socket.gaierror('failure'))):
+        assert cache.resolve('www.api.com', 443) == infos
+        with pytest.raises(socket.gaierror):
+            cache.resolve('other.api.com', 443)
+
+def test_plan_batches():
+    """Records must be grouped by server, credentials and ip"""
+    records = [dyndnsupdate.UpdateRecord('http://a/', 'u', 'p', '1.1.1.1', 'h{}'.format(i))
+                for i in range(45)]
+    records.append(dyndnsupdate.UpdateRecord('http://a/', 'u', 'p', '2.2.2.2', 'x'))
+    records.append(dyndnsupdate.UpdateRecord('http://b/', 'u', 'p', '1.1.1.1', 'y'))
+    records.append(dyndnsupdate.UpdateRecord('http://a/', 'u', 'p', '1.1.1.1', 'h0'))
+    batches = dyndnsupdate.plan_batches(records)
+    assert [len(b.hostnames) for b in batches] == [20, 20, 5, 1, 1]
+    assert batches[0].hostnames[0] == 'h0'
+    assert batches[3].myip == '2.2.2.2'
+    assert batches[4].server_url == 'http://b/'
+
+def test_split_answer():
+    """Batched answers must be mapped to each hostname"""
+    assert dyndnsupdate.split_answer(['b', 'a'], 'good 1.1.1.1\nnochg 1.1.1.1\n') == \
+        [('b', 'good 1.1.1.1'), ('a', 'nochg 1.1.1.1')]
+    assert dyndnsupdate.split_answer(['a', 'b'], 'badauth') == [('a', 'badauth'), ('b', 'badauth')]
+    assert dyndnsupdate.split_answer(['a', 'b'], '') == [('a', ''), ('b', '')]
+    assert dyndnsupdate.split_answer(['a', 'b'], 'good\nnochg\n911') == [('a', 'good'), ('b', 'nochg')]
+    assert dyndnsupdate.split_answer(['a', 'b'], 'good\n\n') == [('a', 'good'), ('b', 'good')]
+    assert dyndnsupdate.split_answer(['a', 'b', 'c'], 'good\nnochg') == [('a', 'good'), ('b', 'nochg'), ('c', None)]
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock())
+def test_hostnames_sent_in_batches():
+    """More than 20 hostnames must be split in several queries"""
+    program = dyndnsupdate.DynDNSUpdate()
+    hostnames = ['h{}.example.com'.format(i) for i in range(25)]
+    assert program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/',
+                                verbose=-1, dyndns_hostname=hostnames + ['h0.example.com']) == True
+    assert program.main() == 0
+    requests = http.client.HTTPConnection.return_value.request.call_args_list
+    assert len(requests) == 2
+    assert 'hostname=' + '%2C'.join(hostnames[:20]) + '&' in requests[0][0][1]
+    assert 'hostname=' + '%2C'.join(hostnames[20:]) + '&' in requests[1][0][1]
+
+# IP discovery
+@patch('http.client.HTTPConnection', createHTTPConnectionMock())
+def test_main_with_discovered_ip():
+    """A discovered ip address must be used when none was given"""
+    with patch('dyndnsupdate.IPDiscovery.discover', Mock(side_effect=['2.2.2.2', None])):
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(server_url='http://www.api.com/', verbose=-1,
+                                    dyndns_hostname=['mydyndnshostname.com'],
+                                    discover_ip=True) == True
+        assert program.main() == 0
+        assert program.main() == 1
+    url = http.client.HTTPConnection.return_value.request.call_args[0][1]
+    assert 'myip=2.2.2.2' in url
+
+# Interface watcher
+def build_netlink_address(msg_type, index, address, scope=0):
+    """Craft a rtnetlink address message"""
+    raw = socket.inet_aton(address)
+    attribute = struct.pack('=HH', 4 + len(raw), 2) + raw
+    body = struct.pack('=BBBBI', socket.AF_INET, 24, 0, scope, index) + attribute
+    return struct.pack('=LHHLL', 16 + len(body), msg_type, 0, 0, 0) + body
+
+def test_netlink_parse_messages():
+    """Address messages must be decoded"""
+    data = build_netlink_address(20, 4, '192.0.2.1') + build_netlink_address(21, 1, '127.0.0.1', scope=254)
+    assert dyndnsupdate.InterfaceWatcher.parse_messages(data) == [
+        (20, socket.AF_INET, 0, 4, '192.0.2.1'),
+        (21, socket.AF_INET, 254, 1, '127.0.0.1'),
+    ]
+    assert dyndnsupdate.InterfaceWatcher.parse_messages(b'\x00' * 8) == []
+
+@patch('socket.if_nametoindex', Mock(return_value=4))
+def test_netlink_wait_change():
+    """Only real address changes must be reported after the debounce window"""
+    kernel, sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    addresses = ['192.0.2.1', '192.0.2.1', '198.51.100.1']
+    with patch('dyndnsupdate.InterfaceWatcher.current_address', Mock(side_effect=addresses)):
+        watcher = dyndnsupdate.InterfaceWatcher('wan0', debounce=0.05, sock=sock)
+        # no event
+        assert watcher.wait_change(timeout=0.01) == False
+        # flapping of the same address
+        kernel.send(build_netlink_address(21, 4, '192.0.2.1'))
+        kernel.send(build_netlink_address(20, 4, '192.0.2.1'))
+        assert watcher.wait_change(timeout=0.01) == False
+        # event on another interface
+        kernel.send(build_netlink_address(20, 9, '10.0.0.1'))
+        assert watcher.wait_change(timeout=0.01) == False
+        # new address
+        kernel.send(build_netlink_address(20, 4, '198.51.100.1'))
+        assert watcher.wait_change(timeout=0.01) == True
+    watcher.close()
+    kernel.close()
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock())
+def test_main_with_interface_address():
+    """The address of the local interface must be used when none was given"""
+    with patch('dyndnsupdate.InterfaceWatcher.current_address', Mock(side_effect=['192.0.2.1', None])):
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(server_url='http://www.api.com/', verbose=-1,
+                                    dyndns_hostname=['mydyndnshostname.com'],
+                                    dyndns_interface='wan0') == True
+        assert program.main() == 0
+        assert program.main() == 1
+    url = http.client.HTTPConnection.return_value.request.call_args[0][1]
+    assert 'myip=192.0.2.1' in url
+
+def test_watch_mode():
+    """The update must run at start and after each address change"""
+    program = dyndnsupdate.DynDNSUpdate()
+    calls = []
+    def main():
+        calls.append(1)
+        return 0
+    program.main = main
+    def wait_change(timeout):
+        if len(calls) == 2:
+            program.stop()
+        return len(calls) == 1
+    watcher = Mock()
+    watcher.return_value.wait_change.side_effect = wait_change
+    with patch('dyndnsupdate.InterfaceWatcher', watcher):
+        assert program.watch('wan0', debounce=0) == 0
+    assert len(calls) == 2
+    watcher.return_value.close.assert_called_once_with()
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock())
+def test_watch_mode_interface_address():
+    """Without other source the address of the watched interface must be pushed"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(server_url='http://www.api.com/', verbose=-1,
+                                dyndns_hostname=['mydyndnshostname.com']) == True
+    watcher = Mock()
+    watcher.current_address.return_value = '192.0.2.1'
+    watcher.return_value.wait_change.side_effect = lambda timeout: program.stop()
+    with patch('dyndnsupdate.InterfaceWatcher', watcher):
+        assert program.watch('wan0', debounce=0) == 0
+    watcher.current_address.assert_called_once_with('wan0', socket.AF_INET)
+    url = http.client.HTTPConnection.return_value.request.call_args[0][1]
+    assert 'myip=192.0.2.1' in url
+
+# Return codes and retries
+def test_parse_answer():
+    """Return codes must be decoded for each hostname"""
+    results = dyndnsupdate.parse_answer(['a', 'b', 'c'], 'good 1.1.1.1\nnochg 1.1.1.1\nnohost')
+    assert [(r.hostname, r.code, r.ip, r.outcome) for r in results] == [
+        ('a', 'good', '1.1.1.1', 'success'),
+        ('b', 'nochg', '1.1.1.1', 'success'),
+        ('c', 'nohost', None, 'error'),
+    ]
+    assert [r.outcome for r in dyndnsupdate.parse_answer(['a', 'b'], '911')] == ['retry', 'retry']
+    assert dyndnsupdate.parse_answer(['a'], 'badauth')[0].outcome == 'fatal'
+    assert dyndnsupdate.parse_answer(['a'], '')[0].outcome == 'success'
+    # only an empty answer is a success without return code
+    results = dyndnsupdate.parse_answer(['a', 'b', 'c'], 'good 1.1.1.1\nnohost')
+    assert [(r.code, r.outcome) for r in results] == [('good', 'success'), ('nohost', 'error'), (None, 'error')]
+    page = '<html><body>Login required</body></html>'
+    assert [r.outcome for r in dyndnsupdate.parse_answer(['a', 'b'], page)] == ['error', 'error']
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good 1.1.1.1\nnochg 1.1.1.1'))
+def test_short_answer_not_cached(tmp_path):
+    """The hostnames without answer line must not be recorded as up to date"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/', verbose=-1,
+                                dyndns_hostname=['a.example.com', 'b.example.com', 'c.example.com'],
+                                state_file=str(tmp_path / 'state.json')) == True
+    assert program.main() == 1
+    cache = dyndnsupdate.StateCache(str(tmp_path / 'state.json'))
+    assert cache.get('http://www.api.com/', 'b.example.com')['ip'] == '1.1.1.1'
+    assert cache.get('http://www.api.com/', 'c.example.com') is None
+
+def test_retry_policy():
+    """Delays must grow exponentially with jitter and be bounded"""
+    policy = dyndnsupdate.RetryPolicy(attempts=6, base_delay=1, max_delay=5)
+    for _ in range(50):
+        delays = list(policy.delays())
+        assert len(delays) == 5
+        assert all(0 <= delay <= bound for delay, bound in zip(delays, [1, 2, 4, 5, 5]))
+    assert list(dyndnsupdate.RetryPolicy(attempts=1).delays()) == []
+
+def configure_retry(program, hostnames=['a.example.com', 'b.example.com'], **options):
+    return program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/', verbose=-1,
+                                dyndns_hostname=hostnames, retry_attempts=3, retry_base_delay=0, **options)
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good 1.1.1.1\ndnserr', 'good 1.1.1.1']))
+def test_retry_temporary_errors():
+    """Only the hostnames with temporary errors must be sent again"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 0
+    requests = http.client.HTTPConnection.return_value.request.call_args_list
+    assert len(requests) == 2
+    assert 'hostname=b.example.com&' in requests[1][0][1]
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(raise_=ConnectionRefusedError))
+def test_retry_network_errors():
+    """Network errors must be retried then reported with code 10"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 10
+    assert http.client.HTTPConnection.call_count == 3
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['badauth', 'good']))
+def test_fatal_answer_stop_all_batches():
+    """A refused account must stop all queries"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, hostnames=['h{}'.format(i) for i in range(30)]) == True
+    assert program.main() == 11
+    assert http.client.HTTPConnection.return_value.request.call_count == 1
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['abuse']))
+def test_abuse_answer():
+    """An account blocked for abuse must produce code 12"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 12
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good 1.1.1.1\nnotfqdn'))
+def test_hostname_error_answer():
+    """A refused hostname must produce code 1 without retry"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 1
+    assert http.client.HTTPConnection.return_value.request.call_count == 1
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('', response_status=503))
+def test_retry_server_errors():
+    """HTTP server errors must be retried then reported with code 10"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 10
+    assert http.client.HTTPConnection.return_value.request.call_count == 3
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('', response_status=404))
+def test_client_error_not_retried(tmp_path):
+    """HTTP client errors other than 401 and 429 must not be retried"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program) == True
+    assert program.main() == 1
+    assert http.client.HTTPConnection.return_value.request.call_count == 1
+    assert [dyndnsupdate.http_outcome(status) for status in [200, 401, 403, 429, 500]] == \
+        ['success', 'fatal', 'error', 'retry', 'retry']
+    # the library client classifies the answers the same way
+    client = dyndnsupdate.DynDNSClient('http://www.api.com/', retry=dyndnsupdate.RetryPolicy(attempts=3, base_delay=0),
+                                        rate_limiter=dyndnsupdate.RateLimiter(1, path=str(tmp_path / 'none' / 'rate')))
+    result, = client.update('a.example.com', '1.1.1.1')
+    assert (result.status, result.http_status, result.error) == ('error', 404, 'HTTP status 404')
+    assert http.client.HTTPConnection.return_value.request.call_count == 2
+    assert [host.outcome for host in dyndnsupdate.classify_response(['a'], None, error=ssl.SSLError())] == ['error']
+    assert [host.outcome for host in dyndnsupdate.classify_response(['a'], None, error='timeout')] == ['retry']
+
+def test_rate_limiter(tmp_path):
+    """The buckets must be refilled over time and shared through the file"""
+    path = str(tmp_path / 'rate')
+    limiter = dyndnsupdate.RateLimiter(1, burst=2, path=path, max_wait=0)
+    other = dyndnsupdate.RateLimiter(1, burst=2, path=path, max_wait=1.5)
+    assert limiter.acquire('www.api.com', 'user', now=100) == 0
+    assert other.acquire('www.api.com', 'user', now=100) == 0
+    # the bucket is empty, fail fast or reserve the next token
+    assert limiter.acquire('www.api.com', 'user', now=100) is None
+    assert other.acquire('www.api.com', 'user', now=100.5) == pytest.approx(0.5)
+    assert other.acquire('www.api.com', 'user', now=100.5) == pytest.approx(1.5)
+    assert other.acquire('www.api.com', 'user', now=100.5) is None
+    # the other accounts have their own budget
+    assert limiter.acquire('www.api.com', 'admin', now=100.5) == 0
+    assert limiter.acquire('other.com', 'user', now=100.5) == 0
+    assert limiter.acquire('www.api.com', 'user', now=103) == 0
+    memory = dyndnsupdate.RateLimiter(1, burst=1)
+    assert memory.acquire('www.api.com', None, now=100) == 0
+    assert memory.acquire('www.api.com', None, now=100.25) is None
+    with pytest.raises(ValueError):
+        dyndnsupdate.RateLimiter(0)
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good'))
+def test_rate_limit_postpones_update(tmp_path):
+    """Updates over the rate limit must be journaled and produce code 13"""
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, hostnames=['h{}'.format(i) for i in range(50)],
+                            journal_file=str(tmp_path / 'journal'), rate_limit=1, rate_burst=1,
+                            rate_max_wait=0, rate_file=str(tmp_path / 'rate')) == True
+    assert program.main() == 13
+    assert http.client.HTTPConnection.return_value.request.call_count == 1
+    journal = dyndnsupdate.UpdateJournal(str(tmp_path / 'journal'))
+    # the batches after the postponed one are kept too
+    assert len(journal.pending()) == 30
+    # another process sharing the file has no token left either
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, rate_limit=1, rate_max_wait=0, rate_file=str(tmp_path / 'rate')) == True
+    assert program.main() == 13
+    assert program.configure(rate_limit=-1) == False
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('good'))
+def test_rate_limit_wait_exit_code(tmp_path):
+    """A run which waited for the rate limit must report it with code 14"""
+    options = dict(rate_limit=600, rate_burst=1, rate_max_wait=5, rate_file=str(tmp_path / 'rate'))
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, **options) == True
+    assert program.main() == 0
+    program = dyndnsupdate.DynDNSUpdate()
+    assert configure_retry(program, **options) == True
+    assert program.main() == 14
+    assert http.client.HTTPConnection.return_value.request.call_count == 2
+    # the next run gets a token again
+    time.sleep(0.1)
+    assert program.main() == 0
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good 1.1.1.1\n911', 'good 1.1.1.1', 'badauth'],
+                                                                keep_alive=True))
+def test_client_results():
+    """The library client must return a structured result per hostname"""
+    logger = logging.getLogger('dynupdate')
+    handlers = list(logger.handlers)
+    client = dyndnsupdate.DynDNSClient('http://www.api.com/', 'user', 'pass',
+                                        retry=dyndnsupdate.RetryPolicy(attempts=2, base_delay=0))
+    assert logger.handlers == handlers
+    results = client.update_many([('a.example.com,b.example.com', '1.1.1.1'), (['c.example.com'], '2.2.2.2'),
+                                    ('d.example.com', '3.3.3.3')])
+    assert [(r.hostname, r.ip, r.status, r.code) for r in results] == [
+        ('a.example.com', '1.1.1.1', 'success', 'good'),
+        ('b.example.com', '1.1.1.1', 'success', 'good'),
+        ('c.example.com', '2.2.2.2', 'fatal', 'badauth'),
+        ('d.example.com', '3.3.3.3', 'skipped', None),
+    ]
+    assert results[0].http_status == 200 and 'total' in results[0].timings
+    # one connection for all the queries
+    assert http.client.HTTPConnection.call_count == 1
+    requests = http.client.HTTPConnection.return_value.request.call_args_list
+    assert 'hostname=b.example.com&' in requests[1][0][1]
+    with pytest.raises(ValueError):
+        client.update('bad host', '1.1.1.1')
+    with pytest.raises(ValueError):
+        client.update('a.example.com', '1.1.1.300')
+    with pytest.raises(ValueError):
+        dyndnsupdate.DynDNSClient('ftp://www.api.com/')
+
+def test_run_profiler(tmp_path):
+    """A profiled run must leave its CPU and memory statistics"""
+    path = str(tmp_path / 'run.prof')
+    profiler = dyndnsupdate.RunProfiler(path)
+    profiler.start()
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(verbose=-1, dyndns_myip='1.1.1.1') == True
+    profiler.stop()
+    profiler.stop()
+    assert 'configure' in ' '.join(str(key) for key in pstats.Stats(path).stats)
+    with open(path + '.memory.json') as memory_file:
+        memory = json.load(memory_file)
+    assert memory['peak_bytes'] >= memory['current_bytes'] > 0
+    assert tracemalloc.Snapshot.load(path + '.tracemalloc').traces
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock('x' * 10000, keep_alive=True))
+def test_answer_size_is_capped():
+    """Huge answers must be truncated and their connection dropped"""
+    pool = dyndnsupdate.ConnectionPool()
+    res, data = pool.request('http', 'www.api.com', 80, 'GET', '/', {})
+    assert len(data) == dyndnsupdate.MAX_ANSWER_SIZE
+    assert len(pool) == 0
+
+# Metrics
+def test_metrics_export(tmp_path):
+    """Metrics must be aggregated and exported"""
+    prometheus_file = tmp_path / 'dyndns.prom'
+    json_file = tmp_path / 'dyndns.jsonl'
+    metrics = dyndnsupdate.Metrics(prometheus_file=str(prometheus_file), json_file=str(json_file))
+    metrics.observe('http://a/', dict(connect=0.003, total=0.2), ['good', 'nochg'])
+    metrics.observe('http://a/', dict(connect=0.02, total=0.3), ['good'])
+    metrics.observe('http://"b"/', dict(total=20), ['network_error'])
+    metrics.flush()
+
+    text = prometheus_file.read_text()
+    assert 'dyndnsupdate_query_phase_seconds_bucket{le="0.005",phase="connect",server="http://a/"} 1' in text
+    assert 'dyndnsupdate_query_phase_seconds_bucket{le="0.025",phase="connect",server="http://a/"} 2' in text
+    assert 'dyndnsupdate_query_phase_seconds_bucket{le="+Inf",phase="total",server="http://\\"b\\"/"} 1' in text
+    assert 'dyndnsupdate_query_phase_seconds_count{phase="total",server="http://a/"} 2' in text
+    assert 'dyndnsupdate_updates_total{code="good",server="http://a/"} 2' in text
+    assert 'dyndnsupdate_updates_total{code="network_error",server="http://\\"b\\"/"} 1' in text
+
+    events = [json.loads(line) for line in json_file.read_text().splitlines()]
+    assert len(events) == 3
+    assert events[0]['codes'] == ['good', 'nochg']
+    assert events[0]['timings'] == {'connect': 0.003, 'total': 0.2}
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good 1.1.1.1', 'good 1.1.1.1']))
+def test_metrics_from_main(tmp_path):
+    """Each query must be recorded when metrics are enabled"""
+    prometheus_file = tmp_path / 'dyndns.prom'
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(dyndns_myip='1.1.1.1', server_url='http://www.api.com/', verbose=-1,
+                                dyndns_hostname=['a.example.com'],
+                                metrics_prometheus_file=str(prometheus_file)) == True
+    assert program.main() == 0
+    assert program.main() == 0
+    text = prometheus_file.read_text()
+    assert 'dyndnsupdate_updates_total{code="good",server="http://www.api.com/"} 2' in text
+    for phase in ['send', 'first_byte', 'read', 'total']:
+        assert 'dyndnsupdate_query_phase_seconds_count{{phase="{}",server="http://www.api.com/"}} 2'.format(phase) in text
+
+# Profiles
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good 1.1.1.1'] * 2, keep_alive=True))
+def test_profiles(tmp_path):
+    """All valid profiles must run and share their connections"""
+    config_file = tmp_path / 'dyndns.ini'
+    config_file.write_text("""
+[DEFAULT]
+dyn-server = http://www.api.com/
+dyn-address = 1.1.1.1
+
+[home]
+dyn-hostname = home.example.com, www.example.com
+username = user
+password = p%ss
+
+[broken]
+dyn-server = ftp://www.api.com/
+dyn-hostname = broken.example.com
+
+[unknown]
+dyn-hostname = unknown.example.com
+no-such-option = 1
+
+[office]
+dyn-hostname = office.example.com
+timeout = 2
+retry = 1
+
+[global]
+dyn-hostname = global.example.com
+daemon = yes
+""")
+    with patch('dyndnsupdate.setup_logging', wraps=dyndnsupdate.setup_logging) as setup_logging:
+        group = dyndnsupdate.ProfileGroup()
+        assert group.load(str(config_file), verbose=-1, dyndns_hostname=['cli.example.com']) == True
+    # the logging is set up once for all profiles
+    assert setup_logging.call_count == 1
+    assert group.profiles == ['home', 'office']
+    # invalid profiles are reported but do not prevent the others
+    assert group.main() == 2
+    assert http.client.HTTPConnection.call_count == 1
+    requests = http.client.HTTPConnection.return_value.request.call_args_list
+    assert 'hostname=home.example.com%2Cwww.example.com&' in requests[0][0][1]
+    assert requests[0][1]['headers']['Authorization'] == 'Basic dXNlcjpwJXNz'
+    assert 'hostname=office.example.com&' in requests[1][0][1]
+    assert 'Authorization' not in requests[1][1]['headers']
+    group.close()
+
+def test_profiles_values(tmp_path):
+    """The profile values must be parsed as booleans or as plain values"""
+    config_file = tmp_path / 'dyndns.ini'
+    config_file.write_text("""
+[DEFAULT]
+dyn-server = https://www.api.com/
+dyn-address = 1.1.1.1
+dyn-hostname = h.example.com
+username = user
+
+[safe]
+insecure = false
+password = -s3cret
+
+[unsafe]
+insecure = yes
+""")
+    with patch('dyndnsupdate.DynDNSUpdate.configure', autospec=True, return_value=True) as configure:
+        group = dyndnsupdate.ProfileGroup()
+        assert group.load(str(config_file), verbose=-1) == True
+    assert group.profiles == ['safe', 'unsafe']
+    safe, unsafe = [call[1] for call in configure.call_args_list]
+    assert safe['tls_insecure'] is False and safe['server_password'] == '-s3cret'
+    assert unsafe['tls_insecure'] is True
+    group.close()
+
+@patch('http.client.HTTPConnection', createHTTPConnectionMock(['good 1.1.1.1'] * 2))
+def test_profiles_share_metrics(tmp_path):
+    """All profiles must count in the same metrics, written once per run"""
+    config_file = tmp_path / 'dyndns.ini'
+    config_file.write_text('[a]\ndyn-server = http://a.example.com/\n\n[b]\ndyn-server = http://b.example.com/\n')
+    prometheus_file = tmp_path / 'dyndns.prom'
+    group = dyndnsupdate.ProfileGroup()
+    assert group.load(str(config_file), verbose=-1, dyndns_myip='1.1.1.1', dyndns_hostname=['h.example.com'],
+                        metrics_prometheus_file=str(prometheus_file)) == True
+    with patch('dyndnsupdate.Metrics.flush', autospec=True, side_effect=dyndnsupdate.Metrics.flush) as flush:
+        assert group.main() == 0
+    assert flush.call_count == 1
+    text = prometheus_file.read_text()
+    for server in ['http://a.example.com/', 'http://b.example.com/']:
+        assert 'dyndnsupdate_updates_total{{code="good",server="{}"}} 1'.format(server) in text
+
+def test_profiles_missing_file(tmp_path):
+    """A missing configuration file must be reported"""
+    group = dyndnsupdate.ProfileGroup()
+    assert group.load(str(tmp_path / 'missing.ini')) == False
@@ -0,0 +1,121 @@
+# -*- coding: utf8 -*-
+
+import http.server
+import os
+import ssl
+import threading
+import pytest
+from unittest.mock import patch
+
+import dyndnsupdate
+
+CERTFILE = os.path.join(os.path.dirname(__file__), 'mocks', 'localhost.crt')
+KEYFILE = os.path.join(os.path.dirname(__file__), 'mocks', 'localhost.key')
+
+
+class UpdateHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        body = b'good 1.1.1.1'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_tls_server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), UpdateHandler)
+    # python < 3.6 has no PROTOCOL_TLS_SERVER
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    context.load_cert_chain(CERTFILE, KEYFILE)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def test_tls_context_cache():
+    """SSL contexts must be built once per set of options"""
+    cache = dyndnsupdate.TLSContextCache()
+    secure = cache.get(dyndnsupdate.TLSOptions(cafile=CERTFILE))
+    assert cache.get(dyndnsupdate.TLSOptions(cafile=CERTFILE)) is secure
+    insecure = cache.get(dyndnsupdate.TLSOptions(insecure=True))
+    assert insecure is not secure
+    assert insecure.verify_mode == ssl.CERT_NONE
+    assert secure.verify_mode == ssl.CERT_REQUIRED
+
+
+@pytest.mark.skipif(not hasattr(ssl, 'SSLSession'), reason='TLS session resumption requires python 3.6')
+def test_tls_session_resumption():
+    """Successive connections must resume the TLS session"""
+    server = start_tls_server()
+    port = server.server_address[1]
+    pool = dyndnsupdate.ConnectionPool()
+    tls = dyndnsupdate.TLSOptions(cafile=CERTFILE)
+    sockets = []
+    original = ssl.SSLContext.wrap_socket
+    def wrap_socket(context, *args, **kwargs):
+        sock = original(context, *args, **kwargs)
+        if not kwargs.get('server_side'):
+            sockets.append(sock.session_reused)
+        return sock
+    try:
+        with patch('ssl.SSLContext.wrap_socket', wrap_socket):
+            for _ in range(3):
+                res, data = pool.request('https', 'localhost', port, 'GET', '/nic/update', {}, tls=tls)
+                assert res.status == 200
+                assert data == b'good 1.1.1.1'
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+    assert len(sockets) == 3
+    assert sockets == [False, True, True]
+
+
+def test_tls_custom_ca():
+    """A custom CA bundle must be used to validate the server"""
+    server = start_tls_server()
+    port = server.server_address[1]
+    try:
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(dyndns_myip='1.1.1.1', verbose=-1,
+                                    server_url='https://localhost:{}/'.format(port),
+                                    dyndns_hostname=['mydyndnshostname.com'],
+                                    tls_cafile=CERTFILE) == True
+        assert program.main() == 0
+
+        # the system CA does not know the self-signed certificate
+        program = dyndnsupdate.DynDNSUpdate()
+        assert program.configure(dyndns_myip='1.1.1.1', verbose=-1,
+                                    server_url='https://localhost:{}/'.format(port),
+                                    dyndns_hostname=['mydyndnshostname.com']) == True
+        assert program.main() == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    program = dyndnsupdate.DynDNSUpdate()
+    assert program.configure(server_url='https://localhost/', verbose=-1, tls_keyfile=KEYFILE) == False
+
+
+def test_tls_query_phases():
+    """All phases of a secure query must be timed"""
+    server = start_tls_server()
+    port = server.server_address[1]
+    pool = dyndnsupdate.ConnectionPool()
+    timings = dict()
+    try:
+        pool.request('https', 'localhost', port, 'GET', '/nic/update', {},
+                     tls=dyndnsupdate.TLSOptions(cafile=CERTFILE), timings=timings)
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+    assert sorted(timings) == ['connect', 'first_byte', 'handshake', 'read', 'resolve', 'send']
+    assert timings['handshake'] > 0
+    assert all(value >= 0 for value in timings.values())